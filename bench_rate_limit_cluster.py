@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""
+Benchmark del rate limit con varios workers.
+
+Simula W workers (instancias del limitador en un mismo loop) que reciben
+peticiones repartidas en round-robin: una clave "caliente" (un scraper) y
+muchas claves frías. Compara:
+  local  → RateLimiter por proceso (el límite efectivo se multiplica por W)
+  shared → SharedRateLimiter con pre-agregación local y sync cada RATE_LIMIT_SYNC_MS
+  naive  → un round trip al store compartido por petición
+El store es LocalKV con --rtt-ms de latencia simulada por round trip (o Redis
+real con --redis-url). Reporta latencia agregada por petición y cuántas
+peticiones de la clave caliente se admitieron por ventana frente al límite.
+
+Uso: python bench_rate_limit_cluster.py [--workers 1,4,16] [--rps 2000] [--seconds 3] [--rtt-ms 0.5]
+"""
+import os
+import time
+import asyncio
+import argparse
+
+# main crea el cliente de OpenAI al importarse; no se hace ninguna llamada real
+os.environ.setdefault("OPENAI_API_KEY", "bench")
+
+from main import (  # noqa: E402
+    LocalKV, KVRateLimitStore, RateLimiter, SharedRateLimiter, redis_from_url, RATE_LIMIT_SYNC_MS,
+)
+
+LIMIT = 100
+WINDOW = 1.0
+
+
+class SlowKV:
+    """LocalKV con latencia de red simulada por round trip (pipeline = 1 round trip)."""
+
+    def __init__(self, rtt: float):
+        self.kv = LocalKV()
+        self.rtt = rtt
+
+    def pipeline(self, transaction: bool = False):
+        pipe = self.kv.pipeline()
+        execute = pipe.execute
+
+        async def slow_execute():
+            await asyncio.sleep(self.rtt)
+            return await execute()
+        pipe.execute = slow_execute
+        return pipe
+
+
+class NaiveLimiter:
+    """Ventana fija en el store compartido, un INCRBY por petición."""
+
+    def __init__(self, store: KVRateLimitStore):
+        self.store = store
+
+    async def check(self, key: str, limit: int, window: float) -> bool:
+        now_ms = int(time.time() * 1000)
+        slot = now_ms - now_ms % int(window * 1000)
+        totals = await self.store.add([(key, slot, 1, int(window * 2) + 1)])
+        return totals[(key, slot)] <= limit
+
+
+def pct(values: list[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0.0
+
+
+async def run(mode: str, workers: int, rps: int, seconds: float, kv) -> dict:
+    store = KVRateLimitStore(kv)
+    if mode == "local":
+        limiters = [RateLimiter() for _ in range(workers)]
+    elif mode == "shared":
+        limiters = [SharedRateLimiter(store, workers=workers) for _ in range(workers)]
+    else:
+        limiters = [NaiveLimiter(store) for _ in range(workers)]
+    syncers = [asyncio.create_task(lim.run()) for lim in limiters if isinstance(lim, SharedRateLimiter)]
+
+    latencies: list[float] = []
+    hot_admitted = 0
+    total = int(rps * seconds)
+    interval = 1.0 / rps
+    start = time.perf_counter()
+    for i in range(total):
+        lim = limiters[i % workers]
+        key = "ip:hot" if i % 2 == 0 else f"ip:{i % 1000}"
+        t0 = time.perf_counter()
+        if mode == "naive":
+            allowed = await lim.check(key, LIMIT, WINDOW)
+        else:
+            allowed = lim.check(key, LIMIT, WINDOW).allowed
+        latencies.append((time.perf_counter() - t0) * 1e6)
+        if allowed and key == "ip:hot":
+            hot_admitted += 1
+        # Mantiene el ritmo objetivo sin dormir en cada petición
+        ahead = (i + 1) * interval - (time.perf_counter() - start)
+        if ahead > 0.001:
+            await asyncio.sleep(ahead)
+    elapsed = time.perf_counter() - start
+    for task in syncers:
+        task.cancel()
+    return {
+        "p50_us": pct(latencies, 0.5),
+        "p99_us": pct(latencies, 0.99),
+        "hot_per_window": hot_admitted / max(1.0, elapsed / WINDOW),
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--workers", default="1,4,16")
+    ap.add_argument("--rps", type=int, default=2000)
+    ap.add_argument("--seconds", type=float, default=3.0)
+    ap.add_argument("--rtt-ms", type=float, default=0.5)
+    ap.add_argument("--redis-url", default="")
+    args = ap.parse_args()
+
+    print(f"limit={LIMIT}/{WINDOW:.0f}s rps={args.rps} (50% clave caliente) rtt_ms={args.rtt_ms} "
+          f"sync_ms={RATE_LIMIT_SYNC_MS} store={'redis' if args.redis_url else 'local'}")
+    print(f"{'workers':>7} {'mode':<7} {'p50 µs':>9} {'p99 µs':>9} {'caliente/ventana':>17}")
+    for w in (int(x) for x in args.workers.split(",")):
+        for mode in ("local", "shared", "naive"):
+            kv = redis_from_url(args.redis_url) if args.redis_url else SlowKV(args.rtt_ms / 1000)
+            r = asyncio.run(run(mode, w, args.rps, args.seconds, kv))
+            print(f"{w:>7} {mode:<7} {r['p50_us']:>9.1f} {r['p99_us']:>9.1f} {r['hot_per_window']:>17.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+Benchmark de memoria de las sesiones en proceso.
+
+Compara bytes por sesión con el formato anterior (dicts para cada mensaje y
+para contact_flow) contra los registros con __slots__ (ChatMessage/ContactFlow).
+Cada sesión simulada tiene su dict de sesión, un flujo y --messages mensajes.
+Mide con tracemalloc; no necesita DB ni OpenAI.
+
+Uso: python bench_session_memory.py [--sizes 1000,10000,100000] [--messages 6]
+"""
+import os
+import gc
+import argparse
+import tracemalloc
+
+# main crea el cliente de OpenAI al importarse; no se hace ninguna llamada real
+os.environ.setdefault("OPENAI_API_KEY", "bench")
+
+from main import ChatMessage, ContactFlow, Role, now_ms  # noqa: E402
+
+TEXTS = [
+    "Hola, ¿tienen disponible el modelo grande?",
+    "Sí, tenemos existencias. ¿Te comparto precios?",
+    "¿Cuánto cuesta el envío a Monterrey?",
+    "El envío cuesta $150 y llega en 2-3 días hábiles.",
+]
+
+
+def build_dicts(n: int, per_session: int) -> tuple[dict, dict]:
+    sessions, messages = {}, {}
+    for i in range(n):
+        sid = f"wa:52155{i:08d}"
+        sessions[sid] = {
+            "startedAt": now_ms(), "status": "active", "lastActiveAt": now_ms(),
+            "contact_flow": {
+                "stage": None, "name": None, "method": None, "contact": None,
+                "booking_fields": [], "booking_answers": {}, "booking_index": 0,
+            },
+        }
+        messages[sid] = [
+            {"role": "user" if j % 2 == 0 else "assistant", "content": TEXTS[j % len(TEXTS)], "ts": now_ms() + j}
+            for j in range(per_session)
+        ]
+    return sessions, messages
+
+
+def build_records(n: int, per_session: int) -> tuple[dict, dict]:
+    sessions, messages = {}, {}
+    for i in range(n):
+        sid = f"wa:52155{i:08d}"
+        sessions[sid] = {
+            "startedAt": now_ms(), "status": "active", "lastActiveAt": now_ms(),
+            "contact_flow": ContactFlow(),
+        }
+        messages[sid] = [
+            ChatMessage(Role.USER if j % 2 == 0 else Role.ASSISTANT, TEXTS[j % len(TEXTS)], now_ms() + j)
+            for j in range(per_session)
+        ]
+    return sessions, messages
+
+
+def measure(builder, n: int, per_session: int) -> float:
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    data = builder(n, per_session)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del data
+    gc.collect()
+    return (after - before) / n
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--sizes", default="1000,10000,100000")
+    ap.add_argument("--messages", type=int, default=6)
+    args = ap.parse_args()
+
+    print(f"mensajes por sesión={args.messages}")
+    print(f"{'sesiones':>9} {'dicts B/ses':>12} {'slots B/ses':>12} {'ahorro':>7}")
+    for n in (int(x) for x in args.sizes.split(",")):
+        old = measure(build_dicts, n, args.messages)
+        new = measure(build_records, n, args.messages)
+        print(f"{n:>9} {old:>12.0f} {new:>12.0f} {(1 - new / old) * 100:>6.1f}%")
+
+
+if __name__ == "__main__":
+    main()
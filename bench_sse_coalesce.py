@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+Benchmark del framing SSE de /v1/chat/stream.
+
+Compara un evento `delta` por fragmento del LLM (comportamiento anterior) contra
+los deltas agrupados con coalesce_deltas. Simula N streams concurrentes con un
+upstream falso (fragmentos de ~4 caracteres cada --inter-chunk-ms) y mide CPU por
+respuesta, TTFT y eventos/bytes escritos. No llama a OpenAI ni necesita DB.
+
+Uso: python bench_sse_coalesce.py [--streams 200] [--chunks 300] [--inter-chunk-ms 2]
+"""
+import os
+import time
+import json
+import asyncio
+import argparse
+
+# main crea el cliente de OpenAI al importarse; no se hace ninguna llamada real
+os.environ.setdefault("OPENAI_API_KEY", "bench")
+
+from main import sse_event, coalesce_deltas, SSE_COALESCE_MS, SSE_COALESCE_CHARS  # noqa: E402
+
+
+async def fake_llm(chunks: int, inter_chunk: float):
+    for i in range(chunks):
+        if inter_chunk:
+            await asyncio.sleep(inter_chunk)
+        yield f"t{i % 10}o "
+
+
+class Sink:
+    """Imita el send() de ASGI: serializa a bytes y cede el loop."""
+
+    def __init__(self):
+        self.events = 0
+        self.bytes = 0
+        self.first_at = 0.0
+
+    async def send(self, frame: str):
+        if not self.first_at:
+            self.first_at = time.perf_counter()
+        self.events += 1
+        self.bytes += len(frame.encode("utf-8"))
+        await asyncio.sleep(0)
+
+
+async def run_stream(mode: str, chunks: int, inter_chunk: float) -> tuple[float, Sink]:
+    sink = Sink()
+    start = time.perf_counter()
+    pieces = fake_llm(chunks, inter_chunk)
+    if mode == "coalesced":
+        pieces = coalesce_deltas(pieces)
+    async for piece in pieces:
+        await sink.send(sse_event(json.dumps({"content": piece}), event="delta"))
+    return sink.first_at - start, sink
+
+
+async def run(mode: str, streams: int, chunks: int, inter_chunk: float) -> dict:
+    cpu0 = time.process_time()
+    wall0 = time.perf_counter()
+    results = await asyncio.gather(*[run_stream(mode, chunks, inter_chunk) for _ in range(streams)])
+    wall = time.perf_counter() - wall0
+    cpu = time.process_time() - cpu0
+    ttfts = sorted(r[0] for r in results)
+    return {
+        "mode": mode,
+        "cpu_ms_per_answer": cpu * 1000 / streams,
+        "ttft_ms_p50": ttfts[len(ttfts) // 2] * 1000,
+        "ttft_ms_p95": ttfts[min(len(ttfts) - 1, int(len(ttfts) * 0.95))] * 1000,
+        "events_per_answer": sum(r[1].events for r in results) / streams,
+        "bytes_per_answer": sum(r[1].bytes for r in results) / streams,
+        "wall_s": wall,
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--streams", type=int, default=200)
+    ap.add_argument("--chunks", type=int, default=300)
+    ap.add_argument("--inter-chunk-ms", type=float, default=2.0)
+    args = ap.parse_args()
+    inter_chunk = args.inter_chunk_ms / 1000.0
+
+    print(f"streams={args.streams} chunks={args.chunks} inter_chunk_ms={args.inter_chunk_ms} "
+          f"SSE_COALESCE_MS={SSE_COALESCE_MS} SSE_COALESCE_CHARS={SSE_COALESCE_CHARS}")
+    print(f"{'mode':<10} {'cpu ms/ans':>11} {'ttft p50':>9} {'ttft p95':>9} {'events':>8} {'bytes':>8} {'wall s':>7}")
+    for mode in ("per-chunk", "coalesced"):
+        r = asyncio.run(run(mode, args.streams, args.chunks, inter_chunk))
+        print(f"{r['mode']:<10} {r['cpu_ms_per_answer']:>11.2f} {r['ttft_ms_p50']:>9.2f} {r['ttft_ms_p95']:>9.2f} "
+              f"{r['events_per_answer']:>8.0f} {r['bytes_per_answer']:>8.0f} {r['wall_s']:>7.2f}")
+
+
+if __name__ == "__main__":
+    main()
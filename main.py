@@ -1,5 +1,8 @@
-import os, uuid, time, asyncio, json, logging, re, secrets, hashlib, base64
-from collections import OrderedDict
+import os, sys, uuid, time, asyncio, json, logging, re, secrets, hashlib, base64, heapq
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field, fields
+from enum import StrEnum
 from typing import Optional, Dict, Any, List
 from datetime import datetime, timedelta, timezone
 from fastapi import FastAPI, HTTPException, Request, Header, Depends, Query, Body
@@ -8,9 +11,10 @@ from fastapi.staticfiles import StaticFiles
 from starlette.responses import StreamingResponse, Response
 from dotenv import load_dotenv
 from pydantic import BaseModel, Field, EmailStr
-from openai import OpenAI, OpenAIError
+from openai import AsyncOpenAI, OpenAIError
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncEngine
 from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError, InterfaceError, OperationalError
 from urllib.parse import urlparse, parse_qsl, urlencode, urlunparse, quote_plus, quote
 from zoneinfo import ZoneInfo
 import csv, io
@@ -37,7 +41,6 @@ log = logging.getLogger("zia")
 log.setLevel(_log_level)
 
 app = FastAPI(title="ZIA Backend", version="1.1")
-client = OpenAI()  # usa OPENAI_API_KEY del entorno
 
 # Ensure correct MIME types for static assets on some platforms
 mimetypes.add_type("application/javascript", ".js")
@@ -159,7 +162,8 @@ ADMIN_EMAIL = os.getenv("ADMIN_EMAIL", "info@acidia.app").strip()
 META_DRY_RUN = as_bool(os.getenv("META_DRY_RUN"), False)
 META_DEFAULT_TENANT = os.getenv("META_DEFAULT_TENANT", "").strip()
 META_SEEN_TTL = env_int("META_SEEN_TTL_SECONDS", 300)
-META_SEEN_MAX = env_int("META_SEEN_MAX", 500)
+META_SEEN_MAX = env_int("META_SEEN_MAX", 50_000)
+META_DEDUPE_BACKEND = (os.getenv("META_DEDUPE_BACKEND") or "memory").strip().lower()  # memory | postgres | redis | local
 #stripe keys 
 STRIPE_SECRET_KEY = os.getenv("STRIPE_SECRET_KEY", "")
 STRIPE_WEBHOOK_SECRET = os.getenv("STRIPE_WEBHOOK_SECRET", "")
@@ -182,7 +186,6 @@ MAX_TEXT_LENGTH = 2000  # Longitud máxima de texto en respuestas
 MAX_MESSAGE_CONTENT_LENGTH = 4000  # Longitud máxima de contenido de mensaje en DB
 CATALOG_MAX_ITEMS = 14  # Máximo de productos en catálogo
 CATALOG_MAX_DESC_LENGTH = 120  # Máximo de caracteres en descripción de producto
-CHAT_MAX_HISTORY_PAIRS = 8  # Máximo de pares de mensajes en historial de chat
 OPENAI_RETRY_DELAY = 0.7  # Segundos de espera entre reintentos de OpenAI
 CATALOG_FETCH_TIMEOUT = 6  # Timeout en segundos para fetch de catálogo
 DB_CONNECT_TIMEOUT = 5  # Timeout en segundos para conexión a DB
@@ -223,6 +226,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Retry-After", "X-RateLimit-Limit", "X-RateLimit-Remaining", "X-RateLimit-Reset"],
 )
 
 # Static assets for the embeddable widget - with custom MIME types
@@ -308,6 +312,75 @@ async def require_admin(x_api_key: str = Header(default="")):
         raise HTTPException(status_code=401, detail="Unauthorized")
 
 
+# Caché del principal ya resuelto (usuario + fb_user_id del tenant) por hash del
+# token: el polling del dashboard no vuelve a decodificar el JWT ni a consultar
+# users/tenants. Cada entrada vive hasta min(exp del token, PRINCIPAL_CACHE_TTL_SECONDS)
+# y se invalida por tenant (invalidate_tenant, también vía NOTIFY), por email
+# (invalidate_principal) o completa (reset de usuarios).
+PRINCIPAL_CACHE_TTL_SECONDS = env_int("PRINCIPAL_CACHE_TTL_SECONDS", 60)
+PRINCIPAL_CACHE_MAX = env_int("PRINCIPAL_CACHE_MAX", 10_000)
+
+
+class PrincipalCache:
+    def __init__(self, ttl_seconds: int, max_entries: int):
+        self.ttl = ttl_seconds
+        self.max_entries = max_entries
+        self.entries: "OrderedDict[str, tuple[float, dict]]" = OrderedDict()
+        self.stats = {"hits": 0, "misses": 0, "expired": 0, "invalidated": 0, "evicted": 0}
+
+    @staticmethod
+    def key(token: str) -> str:
+        return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[dict]:
+        hit = self.entries.get(key)
+        if hit is None:
+            self.stats["misses"] += 1
+            return None
+        expires_at, user = hit
+        if time.time() >= expires_at:
+            self.entries.pop(key, None)
+            self.stats["expired"] += 1
+            self.stats["misses"] += 1
+            return None
+        self.entries.move_to_end(key)
+        self.stats["hits"] += 1
+        return dict(user)
+
+    def put(self, key: str, user: dict, token_exp: float) -> None:
+        if self.ttl <= 0:
+            return
+        self.entries[key] = (min(float(token_exp), time.time() + self.ttl), dict(user))
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.stats["evicted"] += 1
+
+    def drop_where(self, pred) -> int:
+        keys = [k for k, (_, user) in self.entries.items() if pred(user)]
+        for k in keys:
+            self.entries.pop(k, None)
+        self.stats["invalidated"] += len(keys)
+        return len(keys)
+
+    def clear(self) -> None:
+        self.stats["invalidated"] += len(self.entries)
+        self.entries.clear()
+
+    def snapshot(self) -> dict:
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return {
+            "entries": len(self.entries),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl,
+            "hit_rate": round(self.stats["hits"] / lookups, 4) if lookups else 0.0,
+            **self.stats,
+        }
+
+
+PRINCIPAL_CACHE = PrincipalCache(PRINCIPAL_CACHE_TTL_SECONDS, PRINCIPAL_CACHE_MAX)
+
+
 async def require_user(request: Request) -> dict:
     auth_header = request.headers.get("Authorization", "")
     token = ""
@@ -315,6 +388,11 @@ async def require_user(request: Request) -> dict:
         token = auth_header[7:].strip()
     if not token:
         raise HTTPException(status_code=401, detail="Missing authorization")
+    cache_key = PrincipalCache.key(token)
+    user = PRINCIPAL_CACHE.get(cache_key)
+    if user is not None:
+        request.state.user = user
+        return user
     payload = decode_access_token(token)
     user = await fetch_user_by_id(int(payload.get("sub", 0)))
     if not user or user.get("tenant_slug") != payload.get("tenant"):
@@ -324,6 +402,7 @@ async def require_user(request: Request) -> dict:
         tenant_fb_user_id = (tenant.get("settings") or {}).get("fb_user_id")
         if tenant_fb_user_id:
             user["fb_user_id"] = tenant_fb_user_id
+    PRINCIPAL_CACHE.put(cache_key, user, payload.get("exp") or 0)
     request.state.user = user
     return user
 
@@ -338,26 +417,511 @@ def sse_event(data: str, event: Optional[str] = None) -> str:
         return f"event: {event}\ndata: {data}\n\n"
     return f"data: {data}\n\n"
 
-# ── Rate limit (en memoria) ────────────────────────────────────────────
-RATELIMIT: Dict[str, list[float]] = {}
-def is_rate_limited(key: str, limit: int = RATE_LIMIT, window: int = RATE_WINDOW_SECONDS) -> bool:
-    now = time.time()
-    bucket = [ts for ts in RATELIMIT.get(key, []) if ts > now - window]
-    if len(bucket) >= limit:
-        RATELIMIT[key] = bucket
+# Agrupa los fragmentos del LLM en menos eventos `delta`: el primero sale de
+# inmediato (TTFT) y luego se junta hasta SSE_COALESCE_CHARS caracteres o hasta
+# que pasen SSE_COALESCE_MS desde el primer fragmento pendiente. Una task por
+# stream lee el upstream y un timer (call_later) despierta al consumidor al vencer
+# la ventana, así lo pendiente sale a tiempo aunque el upstream se detenga.
+# 0 desactiva el agrupado.
+SSE_COALESCE_MS = env_int("SSE_COALESCE_MS", 40)
+SSE_COALESCE_CHARS = env_int("SSE_COALESCE_CHARS", 96)
+
+async def coalesce_deltas(pieces, window_ms: int = SSE_COALESCE_MS, max_chars: int = SSE_COALESCE_CHARS):
+    it = pieces.__aiter__()
+    window = window_ms / 1000.0
+    if window <= 0 or max_chars <= 0:
+        try:
+            async for piece in it:
+                yield piece
+        finally:
+            await it.aclose()
+        return
+
+    # El primer fragmento se lee y envía directo: TTFT igual que sin agrupar
+    try:
+        first_piece = await it.__anext__()
+    except StopAsyncIteration:
+        await it.aclose()
+        return
+    try:
+        yield first_piece
+    except BaseException:
+        await it.aclose()
+        raise
+
+    loop = asyncio.get_running_loop()
+    buf: list[str] = []
+    size = 0
+    finished = False
+    error: Optional[BaseException] = None
+    timer: Optional[asyncio.TimerHandle] = None
+    wake = asyncio.Event()
+
+    async def pump():
+        nonlocal size, finished, error, timer
+        try:
+            async for piece in it:
+                buf.append(piece)
+                size += len(piece)
+                if size >= max_chars:
+                    wake.set()
+                    await asyncio.sleep(0)  # deja enviar antes de seguir leyendo
+                elif timer is None:
+                    timer = loop.call_later(window, wake.set)
+        except Exception as e:
+            error = e
+        finally:
+            finished = True
+            wake.set()
+
+    reader = asyncio.ensure_future(pump())
+    try:
+        while True:
+            await wake.wait()
+            wake.clear()
+            if timer is not None:
+                timer.cancel()
+                timer = None
+            if buf:
+                chunk = "".join(buf)
+                buf.clear()
+                size = 0
+                yield chunk
+            if finished and not buf:
+                break
+        if error is not None:
+            raise error
+    finally:
+        if timer is not None:
+            timer.cancel()
+        await _cancel_quietly(reader)
+        await it.aclose()
+
+# ── KV compartido (Redis / stand-in local) ────────────────────────────
+def redis_from_url(url: str):
+    """Cliente redis.asyncio o None si el paquete `redis` no está instalado."""
+    try:
+        import redis.asyncio as aioredis
+    except ImportError:
+        return None
+    return aioredis.from_url(url or "redis://localhost:6379/0", decode_responses=True)
+
+
+class LocalKV:
+    """Stand-in en memoria del subconjunto de Redis que usan los stores compartidos."""
+
+    def __init__(self):
+        self._data: Dict[str, tuple[str, float]] = {}
+
+    async def get(self, key: str) -> Optional[str]:
+        item = self._data.get(key)
+        if item is None:
+            return None
+        if item[1] and item[1] < time.time():
+            self._data.pop(key, None)
+            return None
+        return item[0]
+
+    async def mget(self, *keys: str) -> list[Optional[str]]:
+        return [await self.get(k) for k in keys]
+
+    async def set(self, key: str, value: str, ex: Optional[int] = None, nx: bool = False) -> Optional[bool]:
+        if nx and await self.get(key) is not None:
+            return None
+        self._data[key] = (value, time.time() + ex if ex else 0.0)
         return True
-    bucket.append(now)
-    if bucket:
-        RATELIMIT[key] = bucket
-    else:
-        RATELIMIT.pop(key, None)
-    return False
+
+    async def delete(self, *keys: str) -> int:
+        return sum(1 for k in keys if self._data.pop(k, None) is not None)
+
+    async def incrby(self, key: str, amount: int) -> int:
+        current = await self.get(key)
+        value = int(current or 0) + amount
+        expires = self._data[key][1] if current is not None else 0.0
+        self._data[key] = (str(value), expires)
+        return value
+
+    async def expire(self, key: str, seconds: int) -> bool:
+        item = self._data.get(key)
+        if item is None:
+            return False
+        self._data[key] = (item[0], time.time() + seconds)
+        return True
+
+    def pipeline(self, transaction: bool = False) -> "LocalKVPipeline":
+        return LocalKVPipeline(self)
+
+
+class LocalKVPipeline:
+    """Encola comandos como redis.asyncio.Pipeline y los corre en execute()."""
+
+    def __init__(self, kv: LocalKV):
+        self.kv = kv
+        self.calls: list[tuple[str, tuple]] = []
+
+    def __getattr__(self, name: str):
+        def queue(*args):
+            self.calls.append((name, args))
+            return self
+        return queue
+
+    async def execute(self) -> list:
+        calls, self.calls = self.calls, []
+        return [await getattr(self.kv, name)(*args) for name, args in calls]
+
+
+# ── Rate limit (en memoria) ────────────────────────────────────────────
+# GCRA: por clave se guarda solo el "theoretical arrival time" (TAT); cada
+# chequeo es O(1) y permite ráfagas de hasta `limit` peticiones por `window`.
+# Una clave con TAT en el pasado está en reposo (equivale a no existir) y se
+# elimina; el dict de TATs está en orden de último uso, así que la limpieza solo mira
+# el frente. Políticas por ruta (RATE_LIMIT_POLICIES, JSON {"ruta": [limit, window]})
+# y por tenant (settings.rate_limits con el mismo formato). El límite por ruta se
+# aplica antes de cargar nada; el del tenant es un segundo bucket que solo puede
+# endurecerlo, y se chequea cuando el tenant ya está cargado.
+RATE_LIMIT_POLICIES: Dict[str, tuple[int, int]] = {
+    "chat": (RATE_LIMIT, RATE_WINDOW_SECONDS),
+    "chat_stream": (RATE_LIMIT, RATE_WINDOW_SECONDS),
+    "events": (env_int("RATE_LIMIT_EVENTS", 60), RATE_WINDOW_SECONDS),
+    "auth_login": (env_int("RATE_LIMIT_LOGIN", 10), 300),
+}
+try:
+    RATE_LIMIT_POLICIES.update({k: (int(v[0]), int(v[1])) for k, v in json.loads(os.getenv("RATE_LIMIT_POLICIES") or "{}").items()})
+except (ValueError, TypeError, IndexError, AttributeError) as e:
+    log.warning(f"[ratelimit] RATE_LIMIT_POLICIES inválido, uso defaults: {e}")
+RATELIMIT_MAX_KEYS = env_int("RATELIMIT_MAX_KEYS", 200_000)
+RATELIMIT_EVICT_BATCH = 64
+
+
+class RateLimitDecision:
+    __slots__ = ("allowed", "limit", "remaining", "reset_after", "retry_after")
+
+    def __init__(self, allowed: bool, limit: int, remaining: int, reset_after: float, retry_after: float):
+        self.allowed = allowed
+        self.limit = limit
+        self.remaining = remaining
+        self.reset_after = reset_after
+        self.retry_after = retry_after
+
+    def headers(self) -> Dict[str, str]:
+        h = {
+            "X-RateLimit-Limit": str(self.limit),
+            "X-RateLimit-Remaining": str(self.remaining),
+            "X-RateLimit-Reset": str(max(0, int(self.reset_after + 0.999))),
+        }
+        if not self.allowed:
+            h["Retry-After"] = str(max(1, int(self.retry_after + 0.999)))
+        return h
+
+
+class RateLimiter:
+    def __init__(self, max_keys: int = RATELIMIT_MAX_KEYS):
+        self.tat: "OrderedDict[str, float]" = OrderedDict()
+        self.max_keys = max_keys
+        self.stats = {"allowed": 0, "limited": 0, "evicted": 0}
+
+    def check(self, key: str, limit: int, window: float, now: Optional[float] = None,
+              peek: bool = False) -> RateLimitDecision:
+        """peek=True responde si se admitiría una petición más sin contarla."""
+        now = time.monotonic() if now is None else now
+        limit = max(1, int(limit))
+        interval = window / limit
+        tat = max(self.tat.get(key, now), now)
+        new_tat = tat + interval
+        allow_at = new_tat - window
+        if now < allow_at:
+            self.stats["limited"] += 1
+            return RateLimitDecision(False, limit, 0, tat - now, allow_at - now)
+        if peek:
+            return RateLimitDecision(True, limit, int((now - allow_at) / interval), tat - now, 0.0)
+        self.tat[key] = new_tat
+        self.tat.move_to_end(key)
+        self.stats["allowed"] += 1
+        self._evict(now)
+        return RateLimitDecision(True, limit, int((now - allow_at) / interval), new_tat - now, 0.0)
+
+    def _evict(self, now: float) -> None:
+        # Claves en reposo al frente (las menos usadas) + tope duro de claves
+        for _ in range(RATELIMIT_EVICT_BATCH):
+            if not self.tat:
+                return
+            key, tat = next(iter(self.tat.items()))
+            if tat > now and len(self.tat) <= self.max_keys:
+                return
+            self.tat.popitem(last=False)
+            self.stats["evicted"] += 1
+
+    def snapshot(self) -> dict:
+        return {"keys": len(self.tat), **self.stats}
+
+
+# Con varios workers cada proceso tendría su propio límite (N workers = N× el
+# límite). RATE_LIMIT_BACKEND=postgres|redis|local usa contadores de ventana
+# deslizante (dos ventanas) compartidos. El chequeo sigue siendo local: cada
+# worker acumula sus hits y cada RATE_LIMIT_SYNC_MS los suma al store en un solo
+# round trip, recibiendo de vuelta el total global de cada clave. Entre syncs cada
+# worker admite a lo sumo su parte del margen restante (margen / RATE_LIMIT_WORKERS,
+# mínimo 1), así que el exceso por ventana queda acotado a RATE_LIMIT_WORKERS - 1.
+RATE_LIMIT_BACKEND = (os.getenv("RATE_LIMIT_BACKEND") or "memory").strip().lower()
+RATE_LIMIT_STORE_URL = os.getenv("RATE_LIMIT_STORE_URL", "") or os.getenv("SESSION_STORE_URL", "")
+RATE_LIMIT_SYNC_MS = env_int("RATE_LIMIT_SYNC_MS", 100)
+RATE_LIMIT_WORKERS = max(1, env_int("RATE_LIMIT_WORKERS", env_int("WEB_CONCURRENCY", 1)))  # procesos en todo el cluster
+RATE_LIMIT_PURGE_SECONDS = 60
+
+
+class _WindowCounter:
+    __slots__ = ("window_ms", "slot", "prev", "cur", "pending")
+
+    def __init__(self, window_ms: int, slot: int):
+        self.window_ms = window_ms
+        self.slot = slot
+        self.prev = 0      # total global de la ventana anterior
+        self.cur = 0       # total global de la ventana actual (último sync)
+        self.pending = 0   # hits locales aún no enviados
+
+
+class PostgresRateLimitStore:
+    name = "postgres"
+
+    async def add(self, batch: list[tuple[str, int, int, int]]) -> Dict[tuple[str, int], int]:
+        """batch: (clave, inicio_ventana_ms, hits, ttl_s) sin duplicados → {(clave, ventana): total}."""
+        if not db_engine or not batch:
+            return {}
+        async with db_engine.begin() as conn:
+            rows = (await conn.execute(
+                text("""INSERT INTO rate_limit_counters (key, window_start, hits)
+                        SELECT * FROM unnest(CAST(:keys AS TEXT[]), CAST(:slots AS BIGINT[]), CAST(:hits AS INTEGER[]))
+                        ON CONFLICT (key, window_start) DO UPDATE
+                        SET hits = rate_limit_counters.hits + EXCLUDED.hits
+                        RETURNING key, window_start, hits"""),
+                {"keys": [b[0] for b in batch], "slots": [b[1] for b in batch], "hits": [b[2] for b in batch]},
+            )).all()
+        return {(r[0], int(r[1])): int(r[2]) for r in rows}
+
+    async def purge(self, before_ms: int) -> None:
+        if not db_engine:
+            return
+        async with db_engine.begin() as conn:
+            await conn.execute(text("DELETE FROM rate_limit_counters WHERE window_start < :before"), {"before": before_ms})
+
+
+class KVRateLimitStore:
+    name = "redis"
+
+    def __init__(self, kv):
+        self.kv = kv
+
+    async def add(self, batch: list[tuple[str, int, int, int]]) -> Dict[tuple[str, int], int]:
+        if not batch:
+            return {}
+        pipe = self.kv.pipeline(transaction=False)
+        for key, slot, hits, ttl in batch:
+            pipe.incrby(f"zia:rl:{key}:{slot}", hits)
+            pipe.expire(f"zia:rl:{key}:{slot}", ttl)
+        results = await pipe.execute()
+        return {(b[0], b[1]): int(results[i * 2]) for i, b in enumerate(batch)}
+
+    async def purge(self, before_ms: int) -> None:
+        return None  # las claves expiran solas
+
+
+class SharedRateLimiter:
+    """Misma interfaz que RateLimiter, con contadores agregados entre workers."""
+
+    def __init__(self, store, max_keys: int = RATELIMIT_MAX_KEYS, workers: int = RATE_LIMIT_WORKERS):
+        self.store = store
+        self.workers = max(1, workers)
+        self.counters: "OrderedDict[str, _WindowCounter]" = OrderedDict()
+        self.dirty: set[str] = set()
+        self.carry: list[tuple[str, int, int, int]] = []   # hits de ventanas ya cerradas sin enviar
+        self.max_keys = max_keys
+        self.stats = {"allowed": 0, "limited": 0, "share_limited": 0, "evicted": 0,
+                      "syncs": 0, "sync_errors": 0, "sync_ms_last": 0.0}
+        self._last_purge = time.monotonic()
+
+    def check(self, key: str, limit: int, window: float, now: Optional[float] = None,
+              peek: bool = False) -> RateLimitDecision:
+        now_ms_ = int((time.time() if now is None else now) * 1000)
+        limit = max(1, int(limit))
+        window_ms = max(1, int(window * 1000))
+        slot = now_ms_ - now_ms_ % window_ms
+        c = self.counters.get(key)
+        if c is None or c.window_ms != window_ms:
+            c = self.counters[key] = _WindowCounter(window_ms, slot)
+        elif c.slot != slot:
+            if c.pending:
+                self.carry.append((key, c.slot, c.pending, 2 * window_ms // 1000 + 1))
+            c.prev = c.cur + c.pending if slot - c.slot == window_ms else 0
+            c.slot, c.cur, c.pending = slot, 0, 0
+        self.counters.move_to_end(key)
+        self.dirty.add(key)
+
+        elapsed = now_ms_ - slot
+        in_window = c.cur + c.pending
+        synced = c.prev * (window_ms - elapsed) / window_ms + c.cur
+        estimate = synced + c.pending
+        reset_after = (slot + window_ms - now_ms_) / 1000
+        if estimate + 1 > limit:
+            self.stats["limited"] += 1
+            if in_window + 1 > limit or not c.prev:
+                retry = reset_after
+            else:
+                retry = (estimate + 1 - limit) * window_ms / c.prev / 1000
+            return RateLimitDecision(False, limit, 0, reset_after, min(retry, reset_after))
+        # Los demás workers pueden estar admitiendo lo mismo hasta el próximo sync
+        if c.pending + 1 > max(1.0, (limit - synced) / self.workers):
+            self.stats["limited"] += 1
+            self.stats["share_limited"] += 1
+            return RateLimitDecision(False, limit, 0, reset_after, min(RATE_LIMIT_SYNC_MS / 1000, reset_after))
+        if peek:
+            return RateLimitDecision(True, limit, int(limit - estimate - 1), reset_after, 0.0)
+        c.pending += 1
+        self.stats["allowed"] += 1
+        self._evict(now_ms_)
+        return RateLimitDecision(True, limit, int(limit - estimate - 1), reset_after, 0.0)
+
+    def _evict(self, now_ms_: int) -> None:
+        for _ in range(RATELIMIT_EVICT_BATCH):
+            if not self.counters:
+                return
+            key, c = next(iter(self.counters.items()))
+            idle = c.slot + 2 * c.window_ms <= now_ms_ and not c.pending
+            if not idle and len(self.counters) <= self.max_keys:
+                return
+            self.counters.popitem(last=False)
+            self.dirty.discard(key)
+            self.stats["evicted"] += 1
+
+    async def sync(self) -> None:
+        """Envía los hits acumulados y trae los totales globales (incluye claves solo consultadas)."""
+        merged: Dict[tuple[str, int], list[int]] = {}
+        for key, slot, hits, ttl in self.carry:
+            merged.setdefault((key, slot), [0, ttl])[0] += hits
+        self.carry = []
+        for key in self.dirty:
+            c = self.counters.get(key)
+            if c is None:
+                continue
+            entry = merged.setdefault((key, c.slot), [0, 2 * c.window_ms // 1000 + 1])
+            entry[0] += c.pending
+            c.cur += c.pending
+            c.pending = 0
+        self.dirty = set()
+        if not merged:
+            return
+        batch = [(k, slot, v[0], v[1]) for (k, slot), v in merged.items()]
+        t0 = time.perf_counter()
+        try:
+            totals = await self.store.add(batch)
+        except Exception as e:
+            self.stats["sync_errors"] += 1
+            log.warning(f"[ratelimit] sync falló ({len(batch)} claves): {e}")
+            self.carry.extend(b for b in batch if b[2])
+            return
+        self.stats["syncs"] += 1
+        self.stats["sync_ms_last"] = round((time.perf_counter() - t0) * 1000, 2)
+        for (key, slot), total in totals.items():
+            c = self.counters.get(key)
+            if c is None:
+                continue
+            if c.slot == slot:
+                c.cur = max(c.cur, total)
+            elif c.slot - slot == c.window_ms:
+                c.prev = max(c.prev, total)
+        if time.monotonic() - self._last_purge >= RATE_LIMIT_PURGE_SECONDS:
+            self._last_purge = time.monotonic()
+            longest = max((c.window_ms for c in self.counters.values()), default=0)
+            await self.store.purge(int(time.time() * 1000) - 2 * max(longest, 3_600_000))
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(RATE_LIMIT_SYNC_MS / 1000)
+            try:
+                await self.sync()
+            except Exception as e:
+                log.error(f"[ratelimit] sync loop: {e}")
+
+    def snapshot(self) -> dict:
+        return {"backend": self.store.name, "keys": len(self.counters), **self.stats}
+
+
+def make_rate_limiter():
+    if RATE_LIMIT_BACKEND == "postgres":
+        return SharedRateLimiter(PostgresRateLimitStore())
+    if RATE_LIMIT_BACKEND == "local":
+        store = KVRateLimitStore(LocalKV())
+        store.name = "local"
+        return SharedRateLimiter(store)
+    if RATE_LIMIT_BACKEND == "redis":
+        kv = redis_from_url(RATE_LIMIT_STORE_URL)
+        if kv is not None:
+            return SharedRateLimiter(KVRateLimitStore(kv))
+        log.warning("[ratelimit] RATE_LIMIT_BACKEND=redis sin el paquete redis; límite por proceso")
+    return RateLimiter()
+
+
+RATE_LIMITER = make_rate_limiter()
+
+
+def tenant_rate_limit_policy(route: str, tenant: Optional[dict]) -> Optional[tuple[int, int]]:
+    custom = (((tenant or {}).get("settings") or {}).get("rate_limits") or {}).get(route)
+    if custom:
+        try:
+            return int(custom[0]), int(custom[1])
+        except (TypeError, ValueError, IndexError):
+            pass
+    return None
+
+
+def _apply_rate_limit(bucket: str, limit: int, window: int, response: Optional[Response], peek: bool = False) -> Dict[str, str]:
+    decision = RATE_LIMITER.check(bucket, limit, window, peek=peek)
+    headers = decision.headers()
+    if not decision.allowed:
+        raise HTTPException(status_code=429, detail="Too many requests", headers=headers)
+    if response is not None:
+        response.headers.update(headers)
+    return headers
+
+
+def enforce_rate_limit(route: str, key: str, response: Optional[Response] = None, peek: bool = False) -> Dict[str, str]:
+    """Límite por ruta (IP/sesión), sin tocar la DB. 429 con Retry-After si se excede.
+
+    No se separa por el ?tenant= de la URL: rotarlo no debe dar buckets nuevos.
+    """
+    limit, window = RATE_LIMIT_POLICIES.get(route, (RATE_LIMIT, RATE_WINDOW_SECONDS))
+    return _apply_rate_limit(f"{route}:{key}", limit, window, response, peek)
+
+
+def enforce_tenant_rate_limit(route: str, key: str, tenant: Optional[dict],
+                              response: Optional[Response] = None) -> Dict[str, str]:
+    """Segundo bucket si el tenant define su propio límite para la ruta; si no, no hace nada."""
+    policy = tenant_rate_limit_policy(route, tenant)
+    if policy is None:
+        return {}
+    return _apply_rate_limit(f"{route}:{tenant['slug']}:{key}:tenant", policy[0], policy[1], response)
+
+
+def count_rate_limit_hit(route: str, key: str) -> None:
+    """Suma un intento al bucket sin cortar la petición (p. ej. solo logins fallidos)."""
+    limit, window = RATE_LIMIT_POLICIES.get(route, (RATE_LIMIT, RATE_WINDOW_SECONDS))
+    RATE_LIMITER.check(f"{route}:{key}", limit, window)
 
 # ── Token rough count (opcional) ───────────────────────────────────────
+# Aproxima un tokenizador BPE sin dependencias: palabras cortas ≈ 1 token,
+# palabras largas se parten cada ~4 caracteres, cada signo/emoji cuenta aparte.
+_TOKEN_PIECE_RE = re.compile(r"\w+|[^\w\s]")
+LLM_TOKENS_PER_MESSAGE = 4  # overhead de formato por mensaje (role, separadores)
+
 def rough_token_count(text: str) -> int:
     if not text:
         return 0
-    return max(1, len(text) // 4)
+    n = 0
+    for piece in _TOKEN_PIECE_RE.findall(text):
+        if len(piece) == 1:
+            n += 2 if ord(piece) > 0xFFFF else 1
+        else:
+            n += 1 + max(0, len(piece) - 6) // 4
+    return max(1, n)
 
 # ── Utils de contacto ──────────────────────────────────────────────────
 def clean_phone_for_wa(phone: Optional[str]) -> Optional[str]:
@@ -407,6 +971,11 @@ def wants_quote(text: str) -> bool:
     keys = ["cotiza", "cotización", "cotizar", "presupuesto", "precio", "quote"]
     return any(k in t for k in keys)
 
+def wants_purchase(text: str) -> bool:
+    t = (text or "").lower()
+    keys = ["compr", "compra", "adquir", "pagar", "pago", "orden", "checkout", "suscrib"]
+    return any(k in t for k in keys)
+
 def wants_booking(text: str) -> bool:
     t = (text or "").lower()
     keys = ["agendar", "agenda", "cita", "reunión", "reunion", "demo", "llamada", "calendar"]
@@ -854,6 +1423,7 @@ async def merge_tenant_settings(slug: str, patch: dict):
             """),
             {"slug": slug, "patch": json.dumps(patch)}
         )
+    await invalidate_tenant(slug)
 
 async def find_tenant_by_acct(acct_id: str) -> Optional[str]:
     if not (db_engine and acct_id):
@@ -1018,6 +1588,131 @@ async def _create_checkout_for_any(
 
 
 
+# ── Supervisor de tareas en background ───────────────────────────────
+# Todas las tareas fire-and-forget pasan por TASKS.spawn(kind, coro): guarda una
+# referencia fuerte (asyncio solo guarda referencias débiles y la tarea puede ser
+# recolectada a medio camino), limita la concurrencia por tipo, registra y cuenta
+# fallos y en shutdown espera a las pendientes hasta TASK_DRAIN_SECONDS. Los loops
+# de larga vida se lanzan con daemon=True: no se esperan, se cancelan al final.
+TASK_DRAIN_SECONDS = env_int("TASK_DRAIN_SECONDS", 20)
+TASK_DEFAULT_CONCURRENCY = env_int("TASK_DEFAULT_CONCURRENCY", 64)
+TASK_CONCURRENCY: Dict[str, int] = {
+    "summarize_session": env_int("TASK_SUMMARY_CONCURRENCY", 8),
+    "provision_tenant": env_int("TASK_PROVISION_CONCURRENCY", 4),
+    "persist_paused": env_int("TASK_PERSIST_PAUSED_CONCURRENCY", 32),
+}
+
+
+class _TaskKind:
+    __slots__ = ("sem", "queued", "in_flight", "completed", "failed", "cancelled", "durations")
+
+    def __init__(self, limit: int):
+        self.sem = asyncio.Semaphore(limit) if limit > 0 else None
+        self.queued = 0
+        self.in_flight = 0
+        self.completed = 0
+        self.failed = 0
+        self.cancelled = 0
+        self.durations: deque = deque(maxlen=500)
+
+
+class TaskSupervisor:
+    def __init__(self):
+        self.tasks: set[asyncio.Task] = set()
+        self.daemons: set[asyncio.Task] = set()
+        self.kinds: Dict[str, _TaskKind] = {}
+        self.closing = False
+
+    def _kind(self, kind: str) -> _TaskKind:
+        k = self.kinds.get(kind)
+        if k is None:
+            k = self.kinds[kind] = _TaskKind(TASK_CONCURRENCY.get(kind, TASK_DEFAULT_CONCURRENCY))
+        return k
+
+    def spawn(self, kind: str, coro, daemon: bool = False) -> asyncio.Task:
+        if daemon:
+            task = asyncio.create_task(self._run_daemon(kind, coro), name=kind)
+            self.daemons.add(task)
+            task.add_done_callback(self.daemons.discard)
+            return task
+        if self.closing:
+            log.warning(f"[tasks] {kind} lanzada durante el shutdown")
+        task = asyncio.create_task(self._run(kind, self._kind(kind), coro), name=kind)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def _run(self, kind: str, k: _TaskKind, coro) -> None:
+        k.queued += 1
+        try:
+            if k.sem is not None:
+                await k.sem.acquire()
+        except asyncio.CancelledError:
+            k.queued -= 1
+            k.cancelled += 1
+            coro.close()
+            raise
+        k.queued -= 1
+        k.in_flight += 1
+        t0 = time.perf_counter()
+        try:
+            await coro
+            k.completed += 1
+        except asyncio.CancelledError:
+            k.cancelled += 1
+            raise
+        except Exception as e:
+            k.failed += 1
+            log.exception(f"[tasks] {kind} falló: {e}")
+        finally:
+            k.in_flight -= 1
+            k.durations.append(time.perf_counter() - t0)
+            if k.sem is not None:
+                k.sem.release()
+
+    async def _run_daemon(self, kind: str, coro) -> None:
+        try:
+            await coro
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self._kind(kind).failed += 1
+            log.exception(f"[tasks] loop {kind} terminó con error: {e}")
+
+    async def drain(self, timeout: float) -> None:
+        """Espera las tareas pendientes hasta `timeout` s, cancela las que queden y los loops."""
+        self.closing = True
+        pending = set(self.tasks)
+        if pending:
+            log.info(f"[tasks] esperando {len(pending)} tareas en background")
+            _, pending = await asyncio.wait(pending, timeout=timeout)
+        for task in pending:
+            log.warning(f"[tasks] {task.get_name()} cancelada por shutdown")
+            task.cancel()
+        for task in list(self.daemons):
+            task.cancel()
+        leftovers = pending | self.daemons
+        if leftovers:
+            await asyncio.gather(*leftovers, return_exceptions=True)
+
+    def snapshot(self) -> dict:
+        out = {}
+        for name, k in self.kinds.items():
+            durations = sorted(k.durations)
+            out[name] = {
+                "queued": k.queued,
+                "in_flight": k.in_flight,
+                "completed": k.completed,
+                "failed": k.failed,
+                "cancelled": k.cancelled,
+                "duration_ms_p95": round(durations[min(len(durations) - 1, int(0.95 * len(durations)))] * 1000, 1) if durations else 0.0,
+            }
+        return {"pending": len(self.tasks), "daemons": len(self.daemons), "kinds": out}
+
+
+TASKS = TaskSupervisor()
+
+
 ASYNC_DB_URL = to_sqlalchemy_url(DATABASE_URL, DB_DRIVER)
 db_engine: Optional[AsyncEngine] = None
 
@@ -1149,6 +1844,41 @@ async def on_startup():
                 await conn.execute(text(
                     "CREATE INDEX IF NOT EXISTS idx_messages_tenant ON messages(tenant_slug, created_at DESC)"
                 ))
+                await conn.execute(text(
+                    "CREATE INDEX IF NOT EXISTS idx_messages_session ON messages(session_id, id DESC)"
+                ))
+                await conn.execute(text("""
+                    CREATE TABLE IF NOT EXISTS session_summaries (
+                        session_id TEXT PRIMARY KEY,
+                        tenant_slug TEXT NOT NULL,
+                        summary TEXT NOT NULL,
+                        summary_until_ts BIGINT NOT NULL,
+                        updated_at TIMESTAMPTZ DEFAULT NOW()
+                    );
+                """))
+                await conn.execute(text("""
+                    CREATE UNLOGGED TABLE IF NOT EXISTS meta_dedupe (
+                        key TEXT PRIMARY KEY,
+                        expires_at TIMESTAMPTZ NOT NULL
+                    );
+                """))
+                await conn.execute(text("""
+                    CREATE UNLOGGED TABLE IF NOT EXISTS rate_limit_counters (
+                        key TEXT NOT NULL,
+                        window_start BIGINT NOT NULL,
+                        hits INTEGER NOT NULL DEFAULT 0,
+                        PRIMARY KEY (key, window_start)
+                    );
+                """))
+                await conn.execute(text("""
+                    CREATE TABLE IF NOT EXISTS chat_sessions (
+                        session_id TEXT PRIMARY KEY,
+                        rev TEXT NOT NULL DEFAULT '',
+                        state JSONB NOT NULL DEFAULT '{}'::jsonb,
+                        paused BOOLEAN NOT NULL DEFAULT FALSE,
+                        updated_at TIMESTAMPTZ DEFAULT NOW()
+                    );
+                """))
 
             log.info("Postgres listo ✅")
 
@@ -1166,40 +1896,284 @@ async def on_startup():
         except Exception as e:
             log.warning(f"Twilio no inicializado: {e}")
 
+    if db_engine:
+        n_ids = await refresh_business_ids()
+        TASKS.spawn("business_ids_refresher", business_ids_refresher(), daemon=True)
+        log.info(f"Índice de páginas/cuentas de negocio: {n_ids} IDs, {len(ACTIVE_PAGES)} páginas activas ✅")
+
+    if db_engine:
+        WRITE_BEHIND.start()
+        if TENANT_CACHE_TTL_MS > 0 or PRINCIPAL_CACHE_TTL_SECONDS > 0:
+            TASKS.spawn("tenant_cache_listener", tenant_cache_listener(), daemon=True)
+
     # Iniciar tarea de limpieza de sesiones en background
-    asyncio.create_task(cleanup_old_sessions())
+    TASKS.spawn("cleanup_sessions", cleanup_old_sessions(), daemon=True)
     log.info("🧹 Tarea de limpieza de sesiones iniciada")
 
+    if SESSION_STORE.shared:
+        TASKS.spawn("session_store_flusher", session_store_flusher(), daemon=True)
+        log.info(f"Store de sesiones: {SESSION_STORE.name} ✅")
+    if isinstance(RATE_LIMITER, SharedRateLimiter):
+        TASKS.spawn("rate_limit_sync", RATE_LIMITER.run(), daemon=True)
+        log.info(f"Rate limit compartido: {RATE_LIMITER.store.name} ✅")
+
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    # Primero las tareas en background (aprovisionamientos, resúmenes...), que
+    # pueden escribir sesiones o eventos; luego los flushes finales.
+    await TASKS.drain(TASK_DRAIN_SECONDS)
+    # Último flush para no perder turnos al reiniciar/escalar workers
+    await flush_dirty_sessions()
+    await WRITE_BEHIND.close()
+    if isinstance(RATE_LIMITER, SharedRateLimiter):
+        await RATE_LIMITER.sync()
+
+
+# ── Escritura diferida de events / messages ────────────────────────────
+# store_event y log_message ya no abren una transacción por fila: encolan la fila
+# y WRITE_BEHIND la inserta en lotes (un INSERT multi-fila por tabla y una sola
+# transacción por flush) cada WRITE_BEHIND_FLUSH_MS o al juntar
+# WRITE_BEHIND_BATCH_ROWS filas. Si la cola está llena, quien escribe espera
+# (backpressure) hasta WRITE_BEHIND_PUT_TIMEOUT_MS y después la fila se descarta
+# y se cuenta. Errores transitorios (conexión, timeout) se reintentan con backoff;
+# si la DB rechaza el lote por datos, se reintenta por tabla y luego fila por
+# fila, así solo se pierde la fila mala. En shutdown se vacía la cola antes de salir.
+WRITE_BEHIND_MAX_QUEUE = env_int("WRITE_BEHIND_MAX_QUEUE", 10_000)
+WRITE_BEHIND_BATCH_ROWS = env_int("WRITE_BEHIND_BATCH_ROWS", 500)
+WRITE_BEHIND_FLUSH_MS = env_int("WRITE_BEHIND_FLUSH_MS", 200)
+WRITE_BEHIND_SHUTDOWN_SECONDS = env_int("WRITE_BEHIND_SHUTDOWN_SECONDS", 10)
+WRITE_BEHIND_PUT_TIMEOUT_MS = env_int("WRITE_BEHIND_PUT_TIMEOUT_MS", 2000)
+WRITE_BEHIND_RETRIES = env_int("WRITE_BEHIND_RETRIES", 5)
+WRITE_BEHIND_RETRY_MS = env_int("WRITE_BEHIND_RETRY_MS", 200)   # se duplica en cada intento
+
+WRITE_BEHIND_COLUMNS: Dict[str, tuple[str, ...]] = {
+    "events": ("tenant_slug", "session_id", "type", "payload"),
+    "messages": ("tenant_slug", "session_id", "channel", "direction", "author", "content", "payload", "page_id"),
+}
+WRITE_BEHIND_JSONB = {"payload"}
 
-async def store_event(tenant_slug: str, sid: str, etype: str, payload: dict | None = None):
-    if not db_engine:
-        return
-    async with db_engine.begin() as conn:
-        await conn.execute(
-            text("""INSERT INTO events (tenant_slug, session_id, type, payload)
-                    VALUES (:tenant, :sid, :type, CAST(:payload AS JSONB))"""),
-            {"tenant": tenant_slug or "public", "sid": sid, "type": etype, "payload": json.dumps(payload or {})}
-        )
 
+def _multi_row_insert(table: str, rows: list[dict]) -> tuple[str, dict]:
+    cols = WRITE_BEHIND_COLUMNS[table]
+    params: dict = {}
+    values = []
+    for i, row in enumerate(rows):
+        placeholders = []
+        for c in cols:
+            params[f"{c}_{i}"] = row.get(c)
+            placeholders.append(f"CAST(:{c}_{i} AS JSONB)" if c in WRITE_BEHIND_JSONB else f":{c}_{i}")
+        values.append("(" + ", ".join(placeholders) + ")")
+    return f"INSERT INTO {table} ({', '.join(cols)}) VALUES " + ", ".join(values), params
 
-async def log_message(tenant_slug: str, sid: str, channel: str, direction: str, content: str, author: Optional[str] = None, payload: Optional[dict] = None, page_id: Optional[str] = None):
-    if not db_engine:
-        return
-    async with db_engine.begin() as conn:
-        await conn.execute(
-            text("""INSERT INTO messages (tenant_slug, session_id, channel, direction, author, content, payload, page_id)
-                    VALUES (:tenant, :sid, :channel, :direction, :author, :content, CAST(:payload AS JSONB), :page_id)"""),
-            {
-                "tenant": tenant_slug or "public",
-                "sid": sid,
-                "channel": channel,
-                "direction": direction,
-                "author": author,
-                "content": content[:MAX_MESSAGE_CONTENT_LENGTH] if content else None,
-                "payload": json.dumps(payload or {}),
-                "page_id": page_id,
-            }
-        )
+
+def _is_transient_db_error(e: BaseException) -> bool:
+    """Conexión caída / timeout: vale reintentar. Errores de datos (constraint, tipo) no."""
+    if isinstance(e, DBAPIError) and e.connection_invalidated:
+        return True
+    return isinstance(e, (OperationalError, InterfaceError, ConnectionError, TimeoutError, asyncio.TimeoutError))
+
+
+class WriteBehindWriter:
+    def __init__(self):
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=WRITE_BEHIND_MAX_QUEUE)
+        self.task: Optional[asyncio.Task] = None
+        self.stats = {
+            "enqueued": 0, "rows_written": 0, "flushes": 0, "dropped": 0, "errors": 0, "retries": 0,
+            "rows_isolated": 0, "backpressure_waits": 0, "backpressure_dropped": 0, "restarts": 0,
+            "flush_ms_last": 0.0, "flush_ms_max": 0.0, "rows_last_flush": 0,
+        }
+        self.closing = False
+
+    def start(self) -> None:
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    def _ensure_running(self) -> None:
+        """Si el writer murió (excepción inesperada), lo relanza para no encolar en el vacío."""
+        if self.closing:
+            return
+        if self.task is None:
+            self.start()
+            return
+        if not self.task.done():
+            return
+        reason = "cancelado" if self.task.cancelled() else repr(self.task.exception())
+        log.error(f"[write-behind] el writer se detuvo ({reason}); relanzando")
+        self.stats["restarts"] += 1
+        self.task = asyncio.create_task(self.run())
+
+    async def put(self, table: str, row: dict) -> bool:
+        """Encola la fila; False si se descartó (sin DB, o cola llena más allá del plazo)."""
+        if not db_engine:
+            return False
+        self._ensure_running()
+        if self.queue.full():
+            self.stats["backpressure_waits"] += 1
+            try:
+                await asyncio.wait_for(self.queue.put((table, row)), WRITE_BEHIND_PUT_TIMEOUT_MS / 1000)
+            except asyncio.TimeoutError:
+                self.stats["backpressure_dropped"] += 1
+                self.stats["dropped"] += 1
+                log.warning(f"[write-behind] cola llena ({self.queue.qsize()}), fila de {table} descartada")
+                return False
+        else:
+            self.queue.put_nowait((table, row))
+        self.stats["enqueued"] += 1
+        return True
+
+    async def write_now(self, table: str, row: dict) -> None:
+        """Inserta sin pasar por la cola (cuando quien llama relee la fila enseguida). Propaga el error."""
+        if not db_engine:
+            return
+        err = await self._execute({table: [row]})
+        if err is not None:
+            raise err
+        self.stats["rows_written"] += 1
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            item = await self.queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = loop.time() + WRITE_BEHIND_FLUSH_MS / 1000
+            while len(batch) < WRITE_BEHIND_BATCH_ROWS:
+                try:
+                    item = self.queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(self.queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self.flush(batch)
+        # Vaciar lo que quede (shutdown)
+        rest = []
+        while not self.queue.empty():
+            item = self.queue.get_nowait()
+            if item is not None:
+                rest.append(item)
+        for i in range(0, len(rest), WRITE_BEHIND_BATCH_ROWS):
+            await self.flush(rest[i:i + WRITE_BEHIND_BATCH_ROWS])
+
+    async def _execute(self, by_table: Dict[str, list[dict]]) -> Optional[Exception]:
+        """Una transacción con todas las tablas; reintenta lo transitorio. Devuelve el error final o None."""
+        delay = WRITE_BEHIND_RETRY_MS / 1000
+        for attempt in range(WRITE_BEHIND_RETRIES + 1):
+            try:
+                async with db_engine.begin() as conn:
+                    for table, rows in by_table.items():
+                        sql, params = _multi_row_insert(table, rows)
+                        await conn.execute(text(sql), params)
+                return None
+            except Exception as e:
+                if not _is_transient_db_error(e) or attempt == WRITE_BEHIND_RETRIES:
+                    return e
+                self.stats["retries"] += 1
+                log.warning(f"[write-behind] error transitorio, reintento {attempt + 1} en {delay:.1f}s: {e}")
+                await asyncio.sleep(delay)
+                delay *= 2
+        return None
+
+    async def flush(self, batch: list[tuple[str, dict]]) -> None:
+        if not batch or not db_engine:
+            return
+        by_table: Dict[str, list[dict]] = {}
+        for table, row in batch:
+            by_table.setdefault(table, []).append(row)
+        t0 = time.perf_counter()
+        err = await self._execute(by_table)
+        written = len(batch)
+        if err is not None:
+            self.stats["errors"] += 1
+            if _is_transient_db_error(err):
+                # La DB no volvió tras todos los reintentos
+                self.stats["dropped"] += len(batch)
+                log.error(f"[write-behind] flush de {len(batch)} filas falló tras {WRITE_BEHIND_RETRIES} reintentos: {err}")
+                return
+            log.warning(f"[write-behind] lote rechazado ({err}); reintento por tabla y por fila")
+            written = await self._flush_isolating(by_table)
+        elapsed = (time.perf_counter() - t0) * 1000
+        self.stats["flushes"] += 1
+        self.stats["rows_written"] += written
+        self.stats["rows_last_flush"] = written
+        self.stats["flush_ms_last"] = round(elapsed, 2)
+        self.stats["flush_ms_max"] = round(max(self.stats["flush_ms_max"], elapsed), 2)
+
+    async def _flush_isolating(self, by_table: Dict[str, list[dict]]) -> int:
+        """Tabla por tabla y, en la que falle, fila por fila: solo se descartan las filas malas."""
+        written = 0
+        for table, rows in by_table.items():
+            if len(by_table) > 1 and await self._execute({table: rows}) is None:
+                written += len(rows)
+                continue
+            for row in rows:
+                err = await self._execute({table: [row]})
+                if err is None:
+                    written += 1
+                    self.stats["rows_isolated"] += 1
+                    continue
+                self.stats["dropped"] += 1
+                log.error(f"[write-behind] fila descartada en {table} sid={row.get('session_id')}: {err}")
+        return written
+
+    async def close(self) -> None:
+        self.closing = True
+        if self.task is None or self.task.done():
+            return
+        try:
+            await asyncio.wait_for(self.queue.put(None), WRITE_BEHIND_SHUTDOWN_SECONDS)
+            await asyncio.wait_for(self.task, WRITE_BEHIND_SHUTDOWN_SECONDS)
+        except asyncio.TimeoutError:
+            log.warning(f"[write-behind] shutdown sin terminar, {self.queue.qsize()} filas pendientes")
+            self.task.cancel()
+
+    def snapshot(self) -> dict:
+        flushes = self.stats["flushes"] or 1
+        return {
+            "queue_depth": self.queue.qsize(),
+            "max_queue": WRITE_BEHIND_MAX_QUEUE,
+            "rows_per_flush": round(self.stats["rows_written"] / flushes, 1),
+            **self.stats,
+        }
+
+
+WRITE_BEHIND = WriteBehindWriter()
+
+
+async def store_event(tenant_slug: str, sid: str, etype: str, payload: dict | None = None) -> bool:
+    return await WRITE_BEHIND.put("events", {
+        "tenant_slug": tenant_slug or "public",
+        "session_id": sid,
+        "type": etype,
+        "payload": json.dumps(payload or {}),
+    })
+
+
+async def log_message(tenant_slug: str, sid: str, channel: str, direction: str, content: str, author: Optional[str] = None, payload: Optional[dict] = None, page_id: Optional[str] = None, sync: bool = False):
+    row = {
+        "tenant_slug": tenant_slug or "public",
+        "session_id": sid,
+        "channel": channel,
+        "direction": direction,
+        "author": author,
+        "content": content[:MAX_MESSAGE_CONTENT_LENGTH] if content else None,
+        "payload": json.dumps(payload or {}),
+        "page_id": page_id,
+    }
+    if sync:
+        await WRITE_BEHIND.write_now("messages", row)
+    else:
+        await WRITE_BEHIND.put("messages", row)
 
 def _twilio_req_is_valid(request: Request, auth_token: str) -> bool:
     """Valida la firma de Twilio en webhooks para prevenir solicitudes falsificadas."""
@@ -1337,6 +2311,7 @@ async def refresh_page_token_for_tenant(slug: str) -> dict:
             """),
             {"slug": slug, "p": json.dumps(patch)}
         )
+    await invalidate_tenant(slug)
     return {"ok": True, "page_id": page_id}
 
 # ── Modelos ────────────────────────────────────────────────────────────
@@ -1476,44 +2451,262 @@ def _mask(value: Optional[str], show: int = 4) -> Optional[str]:
     return "*" * (len(s) - show) + s[-show:]
 
 # ── Sesiones en memoria ────────────────────────────────────────────────
-SESSIONS: Dict[str, dict] = {}
-MESSAGES: Dict[str, list[dict]] = {}
-
-# Constantes para cleanup de sesiones
-SESSION_MAX_AGE_HOURS = 24
-SESSION_CLEANUP_INTERVAL_SECONDS = 3600  # 1 hora
+# Caché acotada: SESSIONS está en orden LRU (la sesión tocada va al final), cada
+# sesión expira tras SESSION_IDLE_MINUTES sin actividad (heap de vencimientos,
+# sin barridos completos), hay un tope duro de sesiones y de mensajes por sesión.
+# El historial completo sigue en la tabla `messages` (ver rehidratación).
+class _SlotRecord:
+    """Acceso estilo dict sobre registros con __slots__ (compatibilidad con el código de flujos)."""
+    __slots__ = ()
+
+    def __getitem__(self, key: str):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def __setitem__(self, key: str, value) -> None:
+        setattr(self, key, value)
+
+    def get(self, key: str, default=None):
+        value = getattr(self, key, None)
+        return default if value is None else value
+
+    def setdefault(self, key: str, default=None):
+        value = getattr(self, key, None)
+        if value is None:
+            setattr(self, key, default)
+            return default
+        return value
+
+    def update(self, values: dict) -> None:
+        for k, v in values.items():
+            setattr(self, k, v)
+
+    def as_dict(self) -> dict:
+        return {f.name: getattr(self, f.name) for f in fields(self) if f.init}
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        names = {f.name for f in fields(cls) if f.init}
+        return cls(**{k: v for k, v in (data or {}).items() if k in names})
+
+
+class Role(StrEnum):
+    SYSTEM = "system"
+    USER = "user"
+    ASSISTANT = "assistant"
+
+
+@dataclass(slots=True)
+class ChatMessage(_SlotRecord):
+    role: Role
+    content: str
+    ts: int
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "ChatMessage":
+        return cls(Role(data.get("role") or "user"), data.get("content") or "", int(data.get("ts") or 0))
+
+
+@dataclass(slots=True)
+class ContactFlow(_SlotRecord):
+    stage: Optional[str] = None
+    name: Optional[str] = None
+    method: Optional[str] = None
+    contact: Optional[str] = None
+    booking_fields: Optional[list] = None      # se crean al entrar al flujo
+    booking_answers: Optional[dict] = None
+    booking_index: int = 0
+    available_slots: Optional[list] = None
+    _sid: Optional[str] = field(default=None, init=False, repr=False, compare=False)  # no se serializa
+
+    def __setattr__(self, name: str, value) -> None:
+        # Toda escritura al flujo marca la sesión dueña para el próximo flush
+        object.__setattr__(self, name, value)
+        sid = getattr(self, "_sid", None)
+        if sid and name != "_sid":
+            mark_session_dirty(sid)
+
+
+def _record_json_default(obj):
+    if isinstance(obj, _SlotRecord):
+        return obj.as_dict()
+    return str(obj)
+
+
+SESSIONS: "OrderedDict[str, dict]" = OrderedDict()
+MESSAGES: Dict[str, list[ChatMessage]] = {}
+
+SESSION_MAX_AGE_HOURS = 24  # retención en el store compartido
+SESSION_IDLE_MINUTES = env_int("SESSION_IDLE_MINUTES", SESSION_MAX_AGE_HOURS * 60)
+SESSION_MAX_ENTRIES = env_int("SESSION_MAX_ENTRIES", 20000)
+SESSION_MAX_MESSAGES = env_int("SESSION_MAX_MESSAGES", 40)
+SESSION_CLEANUP_INTERVAL_SECONDS = 30
+SESSION_STORE_EXPIRE_INTERVAL_SECONDS = 3600
+
+MESSAGE_OVERHEAD_BYTES = 96  # ChatMessage con slots + ts, aproximado
+SESSION_EXPIRY_HEAP: list[tuple[int, int, str]] = []  # (vence_ms, seq, sid)
+SESSION_EXPIRY_SEQ: Dict[str, int] = {}  # sid -> seq de su entrada vigente; las demás se descartan al salir
+SESSION_BYTES: Dict[str, int] = {}         # mensajes + registro de sesión, por sid
+SESSION_RECORD_BYTES: Dict[str, int] = {}  # parte del registro (resumen, flujo) en SESSION_BYTES
+SESSION_CACHE_STATS: Dict[str, int] = {"bytes": 0, "created": 0, "expired_idle": 0, "evicted_lru": 0, "trimmed_messages": 0}
+_session_seq = 0
 
 now_ms = lambda: int(time.time() * 1000)
 
+
+def _message_bytes(m: ChatMessage) -> int:
+    return sys.getsizeof(m.content) + MESSAGE_OVERHEAD_BYTES
+
+
+def _deep_sizeof(obj) -> int:
+    """sys.getsizeof no sigue referencias: suma también el contenido anidado (resumen, flujo, respuestas)."""
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(_deep_sizeof(k) + _deep_sizeof(v) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set)):
+        size += sum(_deep_sizeof(v) for v in obj)
+    elif isinstance(obj, _SlotRecord):
+        size += sum(_deep_sizeof(getattr(obj, f.name)) for f in fields(obj))
+    return size
+
+
+def _record_bytes_delta(sid: str) -> int:
+    """Re-mide el registro de la sesión; devuelve cuánto cambió desde la última medición."""
+    size = _deep_sizeof(SESSIONS[sid])
+    delta = size - SESSION_RECORD_BYTES.get(sid, 0)
+    SESSION_RECORD_BYTES[sid] = size
+    return delta
+
+
+def _schedule_expiry(sid: str, deadline: int) -> None:
+    global _session_seq
+    _session_seq += 1
+    SESSION_EXPIRY_SEQ[sid] = _session_seq
+    heapq.heappush(SESSION_EXPIRY_HEAP, (deadline, _session_seq, sid))
+
+
+def _compact_expiry_heap() -> None:
+    """Las sesiones desalojadas dejan su entrada en el heap; se purgan cuando superan a las vivas."""
+    if len(SESSION_EXPIRY_HEAP) <= 2 * len(SESSIONS):
+        return
+    SESSION_EXPIRY_HEAP[:] = [e for e in SESSION_EXPIRY_HEAP if SESSION_EXPIRY_SEQ.get(e[2]) == e[1]]
+    heapq.heapify(SESSION_EXPIRY_HEAP)
+
+
+def _new_session(sid: str) -> dict:
+    now = now_ms()
+    sess = {"startedAt": now, "status": "active", "lastActiveAt": now}
+    SESSIONS[sid] = sess
+    MESSAGES[sid] = []
+    SESSION_BYTES[sid] = _record_bytes_delta(sid)
+    SESSION_CACHE_STATS["bytes"] += SESSION_BYTES[sid]
+    SESSION_CACHE_STATS["created"] += 1
+    _schedule_expiry(sid, now + SESSION_IDLE_MINUTES * 60_000)
+    parked = EVICTED_SESSIONS.pop(sid, None)
+    if parked is not None:
+        _restore_evicted_session(sid, parked)
+    while len(SESSIONS) > SESSION_MAX_ENTRIES:
+        old_sid = next(iter(SESSIONS))
+        drop_session(old_sid)
+        SESSION_CACHE_STATS["evicted_lru"] += 1
+    expire_idle_sessions(now)
+    return sess
+
+
+def _session_record(sid: str) -> dict:
+    return SESSIONS.get(sid) or _new_session(sid)
+
+
+def touch_session(sid: str) -> None:
+    sess = SESSIONS.get(sid)
+    if sess is not None:
+        sess["lastActiveAt"] = now_ms()
+        SESSIONS.move_to_end(sid)
+
+
+def drop_session(sid: str) -> None:
+    if sid in DIRTY_SESSIONS and sid in SESSIONS:
+        park_evicted_session(sid)
+    SESSIONS.pop(sid, None)
+    MESSAGES.pop(sid, None)
+    SESSION_CACHE_STATS["bytes"] -= SESSION_BYTES.pop(sid, 0)
+    SESSION_RECORD_BYTES.pop(sid, None)
+    DIRTY_SESSIONS.pop(sid, None)
+    SESSION_SAVED_DIGEST.pop(sid, None)
+    SESSION_REVS.pop(sid, None)
+    SESSION_BASE.pop(sid, None)
+    SESSION_LOADED_AT.pop(sid, None)
+    SESSION_EXPIRY_SEQ.pop(sid, None)
+    _compact_expiry_heap()
+
+
+def recount_session_bytes(sid: str) -> None:
+    """Recalcula el gauge de una sesión cuyo historial se reemplazó entero."""
+    msgs = MESSAGES.get(sid) or []
+    if len(msgs) > SESSION_MAX_MESSAGES:
+        SESSION_CACHE_STATS["trimmed_messages"] += len(msgs) - SESSION_MAX_MESSAGES
+        del msgs[:-SESSION_MAX_MESSAGES]
+    SESSION_RECORD_BYTES.pop(sid, None)
+    size = sum(_message_bytes(m) for m in msgs) + _record_bytes_delta(sid)
+    SESSION_CACHE_STATS["bytes"] += size - SESSION_BYTES.get(sid, 0)
+    SESSION_BYTES[sid] = size
+
+
+def expire_idle_sessions(now: Optional[int] = None) -> int:
+    """Saca del heap solo lo vencido; las sesiones con actividad reciente se reprograman."""
+    now = now or now_ms()
+    idle_ms = SESSION_IDLE_MINUTES * 60_000
+    expired = 0
+    while SESSION_EXPIRY_HEAP and SESSION_EXPIRY_HEAP[0][0] <= now:
+        _, seq, sid = heapq.heappop(SESSION_EXPIRY_HEAP)
+        if SESSION_EXPIRY_SEQ.get(sid) != seq:
+            continue  # ya eliminada o reemplazada
+        deadline = SESSIONS[sid].get("lastActiveAt", 0) + idle_ms
+        if deadline > now:
+            _schedule_expiry(sid, deadline)
+            continue
+        drop_session(sid)
+        expired += 1
+    SESSION_CACHE_STATS["expired_idle"] += expired
+    return expired
+
+
 async def cleanup_old_sessions():
-    """Limpia sesiones antiguas de la memoria para prevenir memory leaks."""
+    """Expira sesiones inactivas de la memoria y purga el store compartido."""
+    last_store_expire = time.time()
     while True:
         try:
             await asyncio.sleep(SESSION_CLEANUP_INTERVAL_SECONDS)
-
-            cutoff_ms = now_ms() - (SESSION_MAX_AGE_HOURS * 3600 * 1000)
-            to_delete = [
-                sid for sid, session in SESSIONS.items()
-                if session.get("startedAt", 0) < cutoff_ms
-            ]
-
-            for sid in to_delete:
-                SESSIONS.pop(sid, None)
-                MESSAGES.pop(sid, None)
-
-            if to_delete:
-                log.info(f"🧹 Limpiadas {len(to_delete)} sesiones antiguas (>{SESSION_MAX_AGE_HOURS}h)")
+            expired = expire_idle_sessions()
+            if expired:
+                log.info(f"🧹 Expiradas {expired} sesiones inactivas (>{SESSION_IDLE_MINUTES} min)")
+            if time.time() - last_store_expire >= SESSION_STORE_EXPIRE_INTERVAL_SECONDS:
+                last_store_expire = time.time()
+                await SESSION_STORE.expire(SESSION_STORE_TTL_SECONDS)
         except Exception as e:
             log.error(f"Error en cleanup de sesiones: {e}")
 
+
+def session_cache_stats() -> dict:
+    return {
+        "entries": len(SESSIONS),
+        "messages": sum(len(m) for m in MESSAGES.values()),
+        "heap": len(SESSION_EXPIRY_HEAP),
+        "max_entries": SESSION_MAX_ENTRIES,
+        **SESSION_CACHE_STATS,
+    }
+
 def new_session_id() -> str:
     return f"sess_{uuid.uuid4().hex}"
 
 def ensure_session(session_id: Optional[str]) -> str:
     sid = session_id or new_session_id()
     if sid not in SESSIONS:
-        SESSIONS[sid] = {"startedAt": now_ms(), "status": "active"}
-        MESSAGES[sid] = []
+        _new_session(sid)
+    else:
+        touch_session(sid)
     return sid
 
 def session_tenant_from_sid(sid: str) -> Optional[str]:
@@ -1534,53 +2727,614 @@ def set_session_paused(sid: str, paused: bool) -> None:
         PAUSED_SESSIONS.add(sid)
     else:
         PAUSED_SESSIONS.discard(sid)
+    if SESSION_STORE.shared:
+        TASKS.spawn("persist_paused", persist_session_paused(sid, paused))
 
 def add_message(sid: str, role: str, content: str):
-    MESSAGES[sid].append({"role": role, "content": content, "ts": now_ms()})
-
-def get_flow(sid: str) -> dict:
-    return SESSIONS.setdefault(sid, {}).setdefault(
-        "contact_flow",
-        {
-            "stage": None,
-            "name": None,
-            "method": None,
-            "contact": None,
-            "booking_fields": [],
-            "booking_answers": {},
-            "booking_index": 0,
-        }
-    )
+    _session_record(sid)
+    msgs = MESSAGES[sid]
+    msg = ChatMessage(Role(role), content, now_ms())
+    msgs.append(msg)
+    added = _message_bytes(msg)
+    if len(msgs) > SESSION_MAX_MESSAGES:
+        dropped = msgs[:-SESSION_MAX_MESSAGES]
+        del msgs[:-SESSION_MAX_MESSAGES]
+        added -= sum(_message_bytes(m) for m in dropped)
+        SESSION_CACHE_STATS["trimmed_messages"] += len(dropped)
+    added += _record_bytes_delta(sid)  # el flujo y el resumen cambian entre turnos
+    SESSION_BYTES[sid] = SESSION_BYTES.get(sid, 0) + added
+    SESSION_CACHE_STATS["bytes"] += added
+    touch_session(sid)
+    mark_session_dirty(sid)
+
+def get_flow(sid: str) -> ContactFlow:
+    # El flujo queda ligado a su sesión: sus setters la marcan sucia al mutarlo
+    sess = _session_record(sid)
+    flow = sess.get("contact_flow")
+    if flow is None:
+        flow = sess["contact_flow"] = ContactFlow()
+    if flow._sid != sid:
+        flow._sid = sid
+    return flow
 
 def reset_contact_flow(sid: str) -> None:
-    SESSIONS.setdefault(sid, {})["contact_flow"] = {
-        "stage": None,
-        "name": None,
-        "method": None,
-        "contact": None,
-        "booking_fields": [],
-        "booking_answers": {},
-        "booking_index": 0,
-    }
-    SESSIONS[sid].pop("last_lead_id", None)
+    sess = _session_record(sid)
+    sess["contact_flow"] = ContactFlow()
+    sess.pop("last_lead_id", None)
+    mark_session_dirty(sid)
+
+
+# ── Store de sesiones compartido ───────────────────────────────────────
+# SESSIONS / MESSAGES / PAUSED_SESSIONS son la caché local (read-through) de
+# este proceso; el store es el estado compartido entre workers y nodos:
+#   memory   → solo este proceso (default, como antes)
+#   postgres → tabla chat_sessions en la misma DB
+#   redis    → SESSION_STORE_URL=redis://... (requiere el paquete `redis`)
+#   local    → stand-in en memoria del protocolo Redis (pruebas/bench)
+# Cada escritura es compare-and-set sobre una rev entera monótona: se guarda con
+# rev+1 solo si el store sigue en la rev que este worker cargó o guardó. Si otro
+# worker escribió antes, se relee y se mezcla (three-way contra la última versión
+# común en SESSION_BASE) y la mezcla sale en el flush siguiente. Las mutaciones
+# (add_message, setters del flujo, reset_contact_flow) marcan la sesión sucia;
+# solo se escribe si el JSON cambió. La pausa del bot se escribe al instante.
+# hydrate_session() relee del store si la copia local tiene más de
+# SESSION_CACHE_TTL_MS y otro worker la modificó (rev distinta).
+SESSION_STORE_BACKEND = (os.getenv("SESSION_STORE_BACKEND") or "memory").strip().lower()
+SESSION_STORE_URL = os.getenv("SESSION_STORE_URL", "")
+SESSION_STORE_FLUSH_MS = env_int("SESSION_STORE_FLUSH_MS", 250)
+SESSION_STORE_SETTLE_MS = env_int("SESSION_STORE_SETTLE_MS", 5000)
+SESSION_STORE_MAX_MESSAGES = env_int("SESSION_STORE_MAX_MESSAGES", 100)
+SESSION_CACHE_TTL_MS = env_int("SESSION_CACHE_TTL_MS", 500)
+SESSION_STORE_TTL_SECONDS = SESSION_MAX_AGE_HOURS * 3600
+
+DIRTY_SESSIONS: Dict[str, int] = {}      # sid -> último toque local (ms)
+SESSION_SAVED_DIGEST: Dict[str, int] = {}
+SESSION_REVS: Dict[str, int] = {}         # sid -> rev guardada/cargada por este proceso
+SESSION_BASE: Dict[str, str] = {}         # sid -> JSON de esa rev (base para mezclar)
+SESSION_LOADED_AT: Dict[str, int] = {}
+# Sesiones desalojadas de memoria con cambios sin guardar: sid -> (rev, base, JSON) hasta el próximo flush
+EVICTED_SESSIONS: "OrderedDict[str, tuple[int, str, str]]" = OrderedDict()
+SESSION_STORE_STATS = {"local_hits": 0, "loads": 0, "remote_updates": 0, "saves": 0, "flushes": 0,
+                       "conflicts": 0, "merges": 0, "errors": 0, "evicted_saved": 0, "evicted_lost": 0}
+
+
+def _parse_rev(rev) -> int:
+    """Revs viejas (hex aleatorio) o vacías cuentan como 0."""
+    rev = str(rev or "")
+    return int(rev) if rev.isdigit() else 0
+
+
+class SessionStore:
+    """Backend en memoria: no comparte nada, todas las operaciones son no-op."""
+    name = "memory"
+    shared = False
+
+    async def load(self, sid: str) -> Optional[dict]:
+        """Devuelve {"rev", "state", "paused"} o None si la sesión no existe."""
+        return None
 
-async def save_lead(tenant_slug: str, sid: str, name: str, method: str, contact: str, meta: dict | None = None) -> dict:
-    if not db_engine:
-        log.warning("DB no configurada: lead no persistido")
-        return {"id": None, "tenant_slug": tenant_slug, "session_id": sid, "name": name, "method": method, "contact": contact}
-    async with db_engine.begin() as conn:
-        row = (await conn.execute(
-            text("""INSERT INTO leads (tenant_slug, session_id, name, method, contact, meta)
-                    VALUES (:tenant_slug, :sid, :name, :method, :contact, CAST(:meta AS JSONB))
-                    RETURNING id, tenant_slug, session_id, name, method, contact, meta, created_at"""),
-            {"tenant_slug": tenant_slug, "sid": sid, "name": name, "method": method, "contact": contact, "meta": json.dumps(meta or {})}
-        )).first()
-    return dict(row._mapping)
+    async def save_many(self, items: list[tuple[str, int, str]]) -> list[str]:
+        """items: (sid, rev esperada, state_json); guarda con rev+1.
 
-# ── Tenant + prompts ───────────────────────────────────────────────────
-async def fetch_tenant(slug: str) -> Optional[dict]:
-    if not db_engine or not slug:
+        Devuelve los sids en conflicto (el store ya no estaba en la rev esperada).
+        """
+        return []
+
+    async def set_paused(self, sid: str, paused: bool) -> None:
         return None
+
+    async def expire(self, max_age_seconds: int) -> int:
+        return 0
+
+
+class PostgresSessionStore(SessionStore):
+    name = "postgres"
+    shared = True
+
+    async def load(self, sid: str) -> Optional[dict]:
+        if not db_engine:
+            return None
+        async with db_engine.connect() as conn:
+            row = (await conn.execute(
+                text("SELECT rev, state, paused FROM chat_sessions WHERE session_id = :sid"),
+                {"sid": sid},
+            )).mappings().first()
+        if not row:
+            return None
+        state = row["state"]
+        return {
+            "rev": _parse_rev(row["rev"]),
+            "state": json.loads(state) if isinstance(state, str) else (state or {}),
+            "paused": bool(row["paused"]),
+        }
+
+    async def save_many(self, items: list[tuple[str, int, str]]) -> list[str]:
+        if not db_engine or not items:
+            return []
+        async with db_engine.begin() as conn:
+            rows = (await conn.execute(
+                text("""INSERT INTO chat_sessions (session_id, rev, state, updated_at)
+                        SELECT sid, rev, CAST(state AS JSONB), NOW()
+                        FROM unnest(CAST(:sids AS TEXT[]), CAST(:revs AS TEXT[]), CAST(:states AS TEXT[]))
+                             AS t(sid, rev, state)
+                        ON CONFLICT (session_id) DO UPDATE
+                        SET rev = EXCLUDED.rev, state = EXCLUDED.state, updated_at = NOW()
+                        WHERE (CASE WHEN chat_sessions.rev ~ '^[0-9]+$' THEN chat_sessions.rev::bigint ELSE 0 END)
+                              = EXCLUDED.rev::bigint - 1
+                        RETURNING session_id"""),
+                {"sids": [i[0] for i in items], "revs": [str(i[1] + 1) for i in items], "states": [i[2] for i in items]},
+            )).all()
+        saved = {r[0] for r in rows}
+        return [sid for sid, _, _ in items if sid not in saved]
+
+    async def set_paused(self, sid: str, paused: bool) -> None:
+        if not db_engine:
+            return
+        async with db_engine.begin() as conn:
+            await conn.execute(
+                text("""INSERT INTO chat_sessions (session_id, rev, state, paused, updated_at)
+                        VALUES (:sid, '', '{}'::jsonb, :paused, NOW())
+                        ON CONFLICT (session_id) DO UPDATE
+                        SET paused = EXCLUDED.paused, updated_at = NOW()"""),
+                {"sid": sid, "paused": paused},
+            )
+
+    async def expire(self, max_age_seconds: int) -> int:
+        if not db_engine:
+            return 0
+        async with db_engine.begin() as conn:
+            res = await conn.execute(
+                text("DELETE FROM chat_sessions WHERE updated_at < NOW() - make_interval(secs => :secs) AND NOT paused"),
+                {"secs": max_age_seconds},
+            )
+        return res.rowcount or 0
+
+
+# KEYS[1]=zia:sess:{sid}  ARGV: rev esperada, valor nuevo ("rev:json"), ttl
+SESSION_CAS_LUA = """
+local cur = redis.call('GET', KEYS[1])
+local rev = 0
+if cur then rev = tonumber(string.match(cur, '^(%d+):')) or 0 end
+if rev ~= tonumber(ARGV[1]) then return 0 end
+redis.call('SET', KEYS[1], ARGV[2], 'EX', tonumber(ARGV[3]))
+return 1
+"""
+
+
+class RedisSessionStore(SessionStore):
+    """Sesiones y pausas con TTL en cada escritura: Redis las expira solo, expire() no hace nada."""
+    name = "redis"
+    shared = True
+
+    def __init__(self, kv):
+        self.kv = kv
+
+    async def load(self, sid: str) -> Optional[dict]:
+        raw, paused = await self.kv.mget(f"zia:sess:{sid}", f"zia:paused:{sid}")
+        if raw is None:
+            return {"rev": 0, "state": {}, "paused": True} if paused else None
+        rev, _, state = raw.partition(":")
+        return {"rev": _parse_rev(rev), "state": json.loads(state), "paused": bool(paused)}
+
+    async def _cas(self, key: str, expected: int, value: str) -> bool:
+        if isinstance(self.kv, LocalKV):
+            # LocalKV no cede el loop entre get y set: la comparación es atómica en el proceso
+            raw = await self.kv.get(key)
+            if _parse_rev((raw or "").partition(":")[0]) != expected:
+                return False
+            await self.kv.set(key, value, ex=SESSION_STORE_TTL_SECONDS)
+            return True
+        return bool(await self.kv.eval(SESSION_CAS_LUA, 1, key, expected, value, SESSION_STORE_TTL_SECONDS))
+
+    async def save_many(self, items: list[tuple[str, int, str]]) -> list[str]:
+        conflicts = []
+        for sid, rev, state in items:
+            if not await self._cas(f"zia:sess:{sid}", rev, f"{rev + 1}:{state}"):
+                conflicts.append(sid)
+        return conflicts
+
+    async def set_paused(self, sid: str, paused: bool) -> None:
+        if paused:
+            await self.kv.set(f"zia:paused:{sid}", "1", ex=SESSION_STORE_TTL_SECONDS)
+        else:
+            await self.kv.delete(f"zia:paused:{sid}")
+
+
+def make_session_store() -> SessionStore:
+    if SESSION_STORE_BACKEND == "postgres":
+        return PostgresSessionStore()
+    if SESSION_STORE_BACKEND == "local":
+        store = RedisSessionStore(LocalKV())
+        store.name = "local"
+        return store
+    if SESSION_STORE_BACKEND == "redis":
+        kv = redis_from_url(SESSION_STORE_URL)
+        if kv is None:
+            log.warning("[session] SESSION_STORE_BACKEND=redis sin el paquete redis; uso memoria")
+            return SessionStore()
+        return RedisSessionStore(kv)
+    return SessionStore()
+
+
+SESSION_STORE = make_session_store()
+
+
+def mark_session_dirty(sid: str) -> None:
+    if SESSION_STORE.shared:
+        DIRTY_SESSIONS[sid] = now_ms()
+
+
+def session_state_json(sid: str) -> str:
+    return json.dumps(
+        {"session": SESSIONS[sid], "messages": MESSAGES.get(sid, [])[-SESSION_STORE_MAX_MESSAGES:]},
+        ensure_ascii=False, default=_record_json_default,
+    )
+
+
+def _message_key(m: dict) -> tuple:
+    return (int(m.get("ts") or 0), str(m.get("role") or ""), m.get("content") or "")
+
+
+def merge_session_state(base: dict, local: dict, remote: dict) -> dict:
+    """Mezcla three-way: lo que este worker cambió respecto de base gana, el resto viene de remote.
+
+    El flujo de contacto se mezcla campo a campo; los mensajes son la unión ordenada por ts.
+    """
+    def merge_keys(b: dict, l: dict, r: dict) -> dict:
+        out = {}
+        for k in {*l, *r}:
+            if l.get(k) != b.get(k):
+                if k in l:
+                    out[k] = l[k]
+            elif k in r:
+                out[k] = r[k]
+        return out
+
+    b_sess, l_sess, r_sess = base.get("session") or {}, local.get("session") or {}, remote.get("session") or {}
+    session = merge_keys(b_sess, l_sess, r_sess)
+    flows = [s.get("contact_flow") for s in (b_sess, l_sess, r_sess)]
+    if isinstance(flows[1], dict) and isinstance(flows[2], dict):
+        session["contact_flow"] = merge_keys(flows[0] if isinstance(flows[0], dict) else {}, flows[1], flows[2])
+
+    seen = {}
+    for m in (local.get("messages") or []) + (remote.get("messages") or []):
+        seen.setdefault(_message_key(m), m)
+    messages = sorted(seen.values(), key=lambda m: int(m.get("ts") or 0))
+    return {"session": session, "messages": messages[-SESSION_MAX_MESSAGES:]}
+
+
+def _apply_session_state(sid: str, state: dict) -> None:
+    # Actualiza en sitio: las referencias vivas (p. ej. get_flow) siguen siendo válidas
+    sess = _session_record(sid)
+    sess.clear()
+    sess.update(state["session"])
+    if isinstance(sess.get("contact_flow"), dict):
+        sess["contact_flow"] = ContactFlow.from_dict(sess["contact_flow"])
+    MESSAGES[sid][:] = [ChatMessage.from_dict(m) for m in state.get("messages") or []]
+    recount_session_bytes(sid)
+    touch_session(sid)
+
+
+def _local_session_state(sid: str) -> dict:
+    """Estado local completo (sin recortar mensajes) como JSON plano, para mezclar."""
+    return json.loads(json.dumps(
+        {"session": SESSIONS[sid], "messages": MESSAGES.get(sid, [])},
+        ensure_ascii=False, default=_record_json_default,
+    ))
+
+
+def _adopt_remote_session(sid: str, rev: int, state: dict) -> None:
+    """Toma la rev remota; si hay cambios locales sin guardar los mezcla y deja la sesión sucia."""
+    unsaved = sid in SESSIONS and hash(session_state_json(sid)) != SESSION_SAVED_DIGEST.get(sid)
+    if unsaved:
+        base = json.loads(SESSION_BASE.get(sid) or "{}")
+        _apply_session_state(sid, merge_session_state(base, _local_session_state(sid), state))
+        SESSION_STORE_STATS["merges"] += 1
+    else:
+        _apply_session_state(sid, state)
+    SESSION_REVS[sid] = rev
+    SESSION_BASE[sid] = json.dumps(state, ensure_ascii=False)
+    if unsaved:
+        SESSION_SAVED_DIGEST.pop(sid, None)
+        DIRTY_SESSIONS[sid] = now_ms()
+    else:
+        SESSION_SAVED_DIGEST[sid] = hash(session_state_json(sid))
+
+
+def park_evicted_session(sid: str) -> None:
+    """La sesión sale de memoria (LRU, inactividad) sucia: se guarda su JSON para el próximo flush."""
+    state = session_state_json(sid)
+    if hash(state) == SESSION_SAVED_DIGEST.get(sid):
+        return
+    EVICTED_SESSIONS[sid] = (SESSION_REVS.get(sid, 0), SESSION_BASE.get(sid) or "{}", state)
+    EVICTED_SESSIONS.move_to_end(sid)
+    while len(EVICTED_SESSIONS) > SESSION_MAX_ENTRIES:
+        lost, _ = EVICTED_SESSIONS.popitem(last=False)
+        SESSION_STORE_STATS["evicted_lost"] += 1
+        log.warning(f"[session] cambios sin guardar descartados sid={lost} (store sin responder)")
+
+
+def _restore_evicted_session(sid: str, parked: tuple[int, str, str]) -> None:
+    # Volvió antes del flush: se recupera lo que no llegó al store y sigue sucia
+    rev, base, state = parked
+    _apply_session_state(sid, json.loads(state))
+    SESSION_REVS[sid] = rev
+    SESSION_BASE[sid] = base
+    DIRTY_SESSIONS[sid] = now_ms()
+
+
+async def _resolve_evicted_conflict(sid: str) -> None:
+    """Conflicto de una sesión ya desalojada: se mezcla contra lo remoto y se reintenta en el próximo flush."""
+    SESSION_STORE_STATS["conflicts"] += 1
+    try:
+        data = await SESSION_STORE.load(sid)
+    except Exception as e:
+        SESSION_STORE_STATS["errors"] += 1
+        log.warning(f"[session] recarga tras conflicto falló sid={sid}: {e}")
+        return
+    parked = EVICTED_SESSIONS.get(sid)
+    if parked is None:
+        return
+    _, base, state = parked
+    if data is None or "session" not in (data["state"] or {}):
+        EVICTED_SESSIONS[sid] = (data["rev"] if data else 0, "{}", state)
+        return
+    merged = merge_session_state(json.loads(base), json.loads(state), data["state"])
+    EVICTED_SESSIONS[sid] = (data["rev"], json.dumps(data["state"], ensure_ascii=False),
+                             json.dumps(merged, ensure_ascii=False, default=_record_json_default))
+    SESSION_STORE_STATS["merges"] += 1
+
+
+async def hydrate_session(sid: Optional[str]) -> None:
+    """Refresca la copia local de la sesión si otro worker la cambió."""
+    if not sid or not SESSION_STORE.shared:
+        return
+    now = now_ms()
+    if sid in SESSIONS and now - SESSION_LOADED_AT.get(sid, 0) < SESSION_CACHE_TTL_MS:
+        SESSION_STORE_STATS["local_hits"] += 1
+        return
+    SESSION_STORE_STATS["loads"] += 1
+    try:
+        data = await SESSION_STORE.load(sid)
+    except Exception as e:
+        SESSION_STORE_STATS["errors"] += 1
+        log.warning(f"[session] load falló sid={sid}: {e}")
+        return
+    SESSION_LOADED_AT[sid] = now_ms()
+    if data is None:
+        return
+    if data["paused"]:
+        PAUSED_SESSIONS.add(sid)
+    else:
+        PAUSED_SESSIONS.discard(sid)
+    state = data["state"] or {}
+    if not data["rev"] or data["rev"] == SESSION_REVS.get(sid) or "session" not in state:
+        return
+    _adopt_remote_session(sid, data["rev"], state)
+    SESSION_STORE_STATS["remote_updates"] += 1
+
+
+async def persist_session_paused(sid: str, paused: bool) -> None:
+    try:
+        await SESSION_STORE.set_paused(sid, paused)
+    except Exception as e:
+        SESSION_STORE_STATS["errors"] += 1
+        log.warning(f"[session] set_paused falló sid={sid}: {e}")
+
+
+async def resolve_session_conflict(sid: str) -> None:
+    """Otro worker guardó primero: relee, mezcla y deja la sesión para el próximo flush."""
+    SESSION_STORE_STATS["conflicts"] += 1
+    try:
+        data = await SESSION_STORE.load(sid)
+    except Exception as e:
+        SESSION_STORE_STATS["errors"] += 1
+        log.warning(f"[session] recarga tras conflicto falló sid={sid}: {e}")
+        DIRTY_SESSIONS.setdefault(sid, now_ms())
+        return
+    if sid not in SESSIONS:
+        return
+    if data is None or "session" not in (data["state"] or {}):
+        # La fila se expiró o solo tiene la pausa: se reintenta sobre esa rev
+        SESSION_REVS[sid] = data["rev"] if data else 0
+        SESSION_SAVED_DIGEST.pop(sid, None)
+        DIRTY_SESSIONS[sid] = now_ms()
+        return
+    _adopt_remote_session(sid, data["rev"], data["state"])
+    SESSION_LOADED_AT[sid] = now_ms()
+
+
+async def flush_dirty_sessions() -> int:
+    if not DIRTY_SESSIONS and not EVICTED_SESSIONS:
+        return 0
+    now = now_ms()
+    batch: list[tuple[str, int, str]] = []
+    digests: Dict[str, int] = {}
+    for sid, touched in list(DIRTY_SESSIONS.items()):
+        if sid not in SESSIONS:
+            DIRTY_SESSIONS.pop(sid, None)
+            continue
+        state = session_state_json(sid)
+        digest = hash(state)
+        if digest != SESSION_SAVED_DIGEST.get(sid):
+            batch.append((sid, SESSION_REVS.get(sid, 0), state))
+            digests[sid] = digest
+        if now - touched > SESSION_STORE_SETTLE_MS:
+            DIRTY_SESSIONS.pop(sid, None)
+    evicted = [(sid, rev, state) for sid, (rev, _, state) in EVICTED_SESSIONS.items() if sid not in SESSIONS]
+    batch += evicted
+    if not batch:
+        return 0
+    try:
+        conflicts = set(await SESSION_STORE.save_many(batch))
+    except Exception as e:
+        SESSION_STORE_STATS["errors"] += 1
+        log.warning(f"[session] flush falló ({len(batch)} sesiones): {e}")
+        for sid, _, _ in batch:
+            if sid not in EVICTED_SESSIONS:
+                DIRTY_SESSIONS.setdefault(sid, now)
+        return 0
+    saved = 0
+    for sid, rev, state in batch:
+        if sid in conflicts:
+            continue
+        saved += 1
+        if sid not in digests:
+            SESSION_STORE_STATS["evicted_saved"] += 1
+        if sid not in SESSIONS:
+            # Sigue fuera de memoria: si se volvió a aparcar con otro estado, parte de la rev nueva
+            parked = EVICTED_SESSIONS.get(sid)
+            if parked is not None and parked[2] == state:
+                EVICTED_SESSIONS.pop(sid)
+            elif parked is not None:
+                EVICTED_SESSIONS[sid] = (rev + 1, state, parked[2])
+            continue
+        SESSION_REVS[sid] = rev + 1
+        SESSION_BASE[sid] = state
+        if sid in digests:
+            SESSION_SAVED_DIGEST[sid] = digests[sid]
+    for sid in conflicts:
+        if sid in SESSIONS:
+            await resolve_session_conflict(sid)
+        else:
+            await _resolve_evicted_conflict(sid)
+    SESSION_STORE_STATS["saves"] += saved
+    SESSION_STORE_STATS["flushes"] += 1
+    return saved
+
+
+async def session_store_flusher():
+    while True:
+        await asyncio.sleep(SESSION_STORE_FLUSH_MS / 1000)
+        try:
+            await flush_dirty_sessions()
+        except Exception as e:
+            log.error(f"[session] flusher: {e}")
+
+
+def session_store_stats() -> dict:
+    return {"backend": SESSION_STORE.name, "dirty": len(DIRTY_SESSIONS), "local_sessions": len(SESSIONS),
+            "evicted_pending": len(EVICTED_SESSIONS),
+            **SESSION_STORE_STATS}
+
+async def save_lead(tenant_slug: str, sid: str, name: str, method: str, contact: str, meta: dict | None = None) -> dict:
+    if not db_engine:
+        log.warning("DB no configurada: lead no persistido")
+        return {"id": None, "tenant_slug": tenant_slug, "session_id": sid, "name": name, "method": method, "contact": contact}
+    async with db_engine.begin() as conn:
+        row = (await conn.execute(
+            text("""INSERT INTO leads (tenant_slug, session_id, name, method, contact, meta)
+                    VALUES (:tenant_slug, :sid, :name, :method, :contact, CAST(:meta AS JSONB))
+                    RETURNING id, tenant_slug, session_id, name, method, contact, meta, created_at"""),
+            {"tenant_slug": tenant_slug, "sid": sid, "name": name, "method": method, "contact": contact, "meta": json.dumps(meta or {})}
+        )).first()
+    return dict(row._mapping)
+
+# ── Tenant + prompts ───────────────────────────────────────────────────
+# ── Caché de tenants ───────────────────────────────────────────────────
+# fetch_tenant es read-through sobre TENANT_CACHE (TTL corto, LRU acotado). Los
+# misses concurrentes del mismo slug comparten una sola consulta. Cada escritura
+# a tenants llama invalidate_tenant(slug), que limpia este worker y emite
+# NOTIFY en TENANT_NOTIFY_CHANNEL; tenant_cache_listener (LISTEN) limpia el resto.
+# Si el listener se cae, el TTL acota lo viejo que puede estar un tenant.
+TENANT_CACHE_TTL_MS = env_int("TENANT_CACHE_TTL_MS", 30_000)
+TENANT_CACHE_MAX = env_int("TENANT_CACHE_MAX", 5000)
+TENANT_NOTIFY_CHANNEL = os.getenv("TENANT_NOTIFY_CHANNEL", "tenant_changed")
+WORKER_ID = uuid.uuid4().hex[:12]  # identifica los NOTIFY propios (Postgres también se los entrega al emisor)
+TENANT_LISTEN_RETRY_SECONDS = env_int("TENANT_LISTEN_RETRY_SECONDS", 5)
+
+
+class TenantCache:
+    def __init__(self, ttl_ms: int, max_entries: int):
+        self.ttl_ms = ttl_ms
+        self.max_entries = max_entries
+        self.entries: "OrderedDict[str, tuple[int, Optional[dict]]]" = OrderedDict()
+        self.inflight: Dict[str, asyncio.Future] = {}
+        self.versions: Dict[str, int] = {}
+        self.listening = False
+        self.stats = {
+            "hits": 0, "misses": 0, "coalesced": 0, "expired": 0,
+            "invalidations": 0, "remote_invalidations": 0, "full_flushes": 0,
+            "served_age_ms_max": 0, "notify_lag_ms_last": 0,
+        }
+        self._served_age_total = 0
+
+    async def get(self, slug: str, loader) -> Optional[dict]:
+        now = now_ms()
+        hit = self.entries.get(slug)
+        if hit is not None:
+            loaded_at, value = hit
+            age = now - loaded_at
+            if age < self.ttl_ms:
+                self.entries.move_to_end(slug)
+                self.stats["hits"] += 1
+                self._served_age_total += age
+                if age > self.stats["served_age_ms_max"]:
+                    self.stats["served_age_ms_max"] = age
+                return dict(value) if value is not None else None
+            self.entries.pop(slug, None)
+            self.stats["expired"] += 1
+        fut = self.inflight.get(slug)
+        if fut is not None:
+            self.stats["coalesced"] += 1
+        else:
+            self.stats["misses"] += 1
+            # La consulta corre en su propia tarea: si quien la inició se cancela
+            # (cliente desconectado), los demás que esperan el mismo slug no se enteran
+            fut = self.inflight[slug] = asyncio.ensure_future(self._load(slug, loader))
+            fut.add_done_callback(_consume_exception)
+        value = await asyncio.shield(fut)
+        return dict(value) if value is not None else None
+
+    async def _load(self, slug: str, loader) -> Optional[dict]:
+        version = self.versions.get(slug, 0)
+        try:
+            value = await loader(slug)
+        finally:
+            self.inflight.pop(slug, None)
+        # Si hubo una invalidación durante la consulta, el resultado puede ser viejo
+        if self.versions.get(slug, 0) == version:
+            self.entries[slug] = (now_ms(), value)
+            self.entries.move_to_end(slug)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return value
+
+    def peek(self, slug: str) -> Optional[dict]:
+        """Entrada vigente sin cargar ni contar como lookup (None si no está o venció)."""
+        hit = self.entries.get(slug)
+        if hit is None or hit[1] is None or now_ms() - hit[0] >= self.ttl_ms:
+            return None
+        return hit[1]
+
+    def invalidate(self, slug: str, remote: bool = False) -> None:
+        self.entries.pop(slug, None)
+        self.versions[slug] = self.versions.get(slug, 0) + 1
+        self.stats["remote_invalidations" if remote else "invalidations"] += 1
+
+    def clear(self) -> None:
+        for slug in list(self.entries):
+            self.versions[slug] = self.versions.get(slug, 0) + 1
+        self.entries.clear()
+        self.stats["full_flushes"] += 1
+
+    def snapshot(self) -> dict:
+        lookups = self.stats["hits"] + self.stats["misses"] + self.stats["coalesced"]
+        return {
+            "entries": len(self.entries),
+            "max_entries": self.max_entries,
+            "ttl_ms": self.ttl_ms,
+            "listening": self.listening,
+            "hit_rate": round((self.stats["hits"] + self.stats["coalesced"]) / lookups, 4) if lookups else 0.0,
+            "served_age_ms_avg": round(self._served_age_total / self.stats["hits"], 1) if self.stats["hits"] else 0.0,
+            **self.stats,
+        }
+
+
+TENANT_CACHE = TenantCache(TENANT_CACHE_TTL_MS, TENANT_CACHE_MAX)
+
+
+async def _load_tenant(slug: str) -> Optional[dict]:
     async with db_engine.connect() as conn:
         row = (await conn.execute(
             text("SELECT slug, name, whatsapp, settings FROM tenants WHERE slug=:slug"),
@@ -1588,6 +3342,127 @@ async def fetch_tenant(slug: str) -> Optional[dict]:
         )).first()
     return dict(row._mapping) if row else None
 
+
+async def fetch_tenant(slug: str) -> Optional[dict]:
+    if not db_engine or not slug:
+        return None
+    if TENANT_CACHE_TTL_MS <= 0:
+        return await _load_tenant(slug)
+    return await TENANT_CACHE.get(slug, _load_tenant)
+
+
+# Payload del NOTIFY: {"kind": ..., "key": ..., "ts": ms, "src": WORKER_ID}
+#   tenant    → key = slug: su entrada en TENANT_CACHE, sus principals y su caché LLM
+#   principal → key = email: solo los principals de ese usuario
+#   pages     → recargar el índice de páginas (cambió facebook_pages)
+#   all       → vaciar TENANT_CACHE y PRINCIPAL_CACHE (reset de usuarios)
+TENANT_NOTIFY_KINDS = ("tenant", "principal", "pages", "all")
+
+
+def _drop_tenant_local(kind: str, key: str = "", remote: bool = False) -> None:
+    if kind == "tenant":
+        TENANT_CACHE.invalidate(key, remote=remote)
+        PRINCIPAL_CACHE.drop_where(lambda u: u.get("tenant_slug") == key)
+        llm_cache_invalidate_tenant(key)
+    elif kind == "principal":
+        PRINCIPAL_CACHE.drop_where(lambda u: (u.get("email") or "").lower() == key)
+    elif kind == "pages":
+        # El worker que escribió ya recargó su índice antes de avisar
+        if remote:
+            mark_page_index_stale()
+            TASKS.spawn("page_index_refresh", refresh_business_ids())
+    elif kind == "all":
+        TENANT_CACHE.clear()
+        PRINCIPAL_CACHE.clear()
+    else:
+        log.warning(f"[tenant-cache] invalidación desconocida kind={kind!r}")
+
+
+async def publish_invalidation(kind: str, key: str = "") -> None:
+    """Aplica la invalidación en este worker y avisa al resto vía NOTIFY."""
+    _drop_tenant_local(kind, key)
+    if not db_engine:
+        return
+    payload = json.dumps({"kind": kind, "key": key, "ts": now_ms(), "src": WORKER_ID})
+    try:
+        async with db_engine.begin() as conn:
+            await conn.execute(text("SELECT pg_notify(:ch, :payload)"), {"ch": TENANT_NOTIFY_CHANNEL, "payload": payload})
+    except Exception as e:
+        log.warning(f"[tenant-cache] NOTIFY falló para {kind}:{key}: {e}")
+
+
+async def invalidate_tenant(slug: str) -> None:
+    """Invalida el tenant (y sus principals) en este worker y en los demás."""
+    if slug:
+        await publish_invalidation("tenant", slug)
+
+
+async def invalidate_principal(email: str) -> None:
+    """Olvida los principals cacheados de un usuario en todos los workers."""
+    if email:
+        await publish_invalidation("principal", email.strip().lower())
+
+
+async def invalidate_all_tenants() -> None:
+    await publish_invalidation("all")
+
+
+def _on_tenant_notify(payload: str) -> None:
+    try:
+        msg = json.loads(payload or "")
+        kind, key = msg["kind"], str(msg.get("key") or "")
+        ts = int(msg.get("ts") or 0)
+        if msg.get("src") == WORKER_ID:
+            return  # ya se aplicó localmente al publicar
+    except (ValueError, TypeError, KeyError) as e:
+        # Formato desconocido (p. ej. un worker de otra versión): lo seguro es vaciar todo
+        log.warning(f"[tenant-cache] NOTIFY ilegible ({e}), vacío cachés: {payload[:200]!r}")
+        kind, key, ts = "all", "", 0
+    if kind not in TENANT_NOTIFY_KINDS or (kind in ("tenant", "principal") and not key):
+        log.warning(f"[tenant-cache] NOTIFY inválido: {payload[:200]!r}")
+        return
+    _drop_tenant_local(kind, key, remote=True)
+    if ts:
+        TENANT_CACHE.stats["notify_lag_ms_last"] = max(0, now_ms() - ts)
+
+
+def _on_listen_started() -> None:
+    # Mientras no escuchábamos se pudieron perder avisos: lo cacheado y el índice
+    # de páginas dejan de ser confiables hasta recargarse
+    TENANT_CACHE.clear()
+    TENANT_CACHE.listening = True
+    mark_page_index_stale()
+    TASKS.spawn("page_index_refresh", refresh_business_ids())
+
+
+async def tenant_cache_listener():
+    """LISTEN en una conexión dedicada del pool; reconecta si se cae."""
+    while True:
+        try:
+            async with db_engine.connect() as conn:
+                raw = (await conn.get_raw_connection()).driver_connection
+                try:
+                    if DB_DRIVER == "psycopg":
+                        await raw.set_autocommit(True)
+                        await raw.execute(f'LISTEN "{TENANT_NOTIFY_CHANNEL}"')
+                        _on_listen_started()
+                        async for n in raw.notifies():
+                            _on_tenant_notify(n.payload)
+                    else:
+                        await raw.add_listener(TENANT_NOTIFY_CHANNEL, lambda *args: _on_tenant_notify(args[-1]))
+                        _on_listen_started()
+                        while not raw.is_closed():
+                            await asyncio.sleep(TENANT_LISTEN_RETRY_SECONDS)
+                finally:
+                    TENANT_CACHE.listening = False
+                    # La conexión quedó en modo LISTEN/autocommit: no regresa al pool
+                    await conn.invalidate()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.warning(f"[tenant-cache] listener caído, reintento en {TENANT_LISTEN_RETRY_SECONDS}s: {e}")
+        await asyncio.sleep(TENANT_LISTEN_RETRY_SECONDS)
+
 async def resolve_tenant_by_page_or_ig_id(page_or_ig_id: str) -> str:
     """Resuelve el tenant_slug desde una page_id o ig_user_id.
 
@@ -1597,6 +3472,20 @@ async def resolve_tenant_by_page_or_ig_id(page_or_ig_id: str) -> str:
     if not db_engine or not page_or_ig_id:
         return ""
 
+    key = str(page_or_ig_id)
+    pages = PAGE_ROUTES.get(key)
+    if pages:
+        BUSINESS_IDS_STATS["route_hits"] += 1
+        return pages[0]["tenant_slug"]
+    legacy_slug = LEGACY_PAGE_TENANTS.get(key)
+    if legacy_slug:
+        BUSINESS_IDS_STATS["route_hits"] += 1
+        return legacy_slug
+    BUSINESS_IDS_STATS["route_misses"] += 1
+    if page_index_authoritative():
+        return ""
+    BUSINESS_IDS_STATS["db_fallbacks"] += 1
+
     async with db_engine.connect() as conn:
         # Primero: buscar en facebook_pages (modelo nuevo multi-tenant)
         row = (await conn.execute(
@@ -1711,6 +3600,15 @@ async def get_facebook_page_by_id(page_id: str, tenant_slug: str) -> Optional[di
     if not db_engine or not page_id or not tenant_slug:
         return None
 
+    for page in PAGE_ROUTES.get(str(page_id)) or ():
+        if page["tenant_slug"] == tenant_slug:
+            BUSINESS_IDS_STATS["route_hits"] += 1
+            return {k: v for k, v in page.items() if k != "tenant_slug"}
+    BUSINESS_IDS_STATS["route_misses"] += 1
+    if page_index_authoritative():
+        return None
+    BUSINESS_IDS_STATS["db_fallbacks"] += 1
+
     async with db_engine.connect() as conn:
         # Buscar por page_id O por ig_user_id (para webhooks de Instagram)
         result = await conn.execute(
@@ -1742,6 +3640,15 @@ async def get_active_facebook_page(tenant_slug: str) -> Optional[dict]:
     if not db_engine or not tenant_slug:
         return None
 
+    page = ACTIVE_PAGES.get(tenant_slug)
+    if page is not None:
+        BUSINESS_IDS_STATS["route_hits"] += 1
+        return {k: v for k, v in page.items() if k != "tenant_slug"}
+    BUSINESS_IDS_STATS["route_misses"] += 1
+    if page_index_authoritative():
+        return None
+    BUSINESS_IDS_STATS["db_fallbacks"] += 1
+
     async with db_engine.connect() as conn:
         result = await conn.execute(
             text("""
@@ -1765,6 +3672,134 @@ async def get_active_facebook_page(tenant_slug: str) -> Optional[dict]:
         "page_settings": row[4] or {}
     }
 
+# ── Índice de páginas / cuentas de negocio conectadas ──────────────────
+# Una sola carga de facebook_pages (y de los IDs del modelo antiguo en
+# tenants.settings) arma, con reemplazo atómico:
+#   BUSINESS_IDS  id -> {"tenant_slug", "page_name"}   (anti-loop de DMs)
+#   PAGE_ROUTES   id -> [registros de página]          (page_id e ig_user_id)
+#   ACTIVE_PAGES  tenant -> registro de la página activa
+#   LEGACY_PAGE_TENANTS  id -> slug (fb_page_id / ig_user_id(s) en settings)
+# Así resolver tenant y página de un webhook de Meta es un lookup en memoria.
+# Se carga al arrancar, se recarga tras connect/disconnect/activate/assign y
+# cambios de page_settings (notify_pages_changed avisa al resto de workers por
+# NOTIFY) y cada BUSINESS_IDS_REFRESH_SECONDS. Con el listener caído, o si no
+# hubo una recarga exitosa después del último aviso (o re-suscripción), un miss
+# todavía consulta la DB por si otro worker conectó la página.
+BUSINESS_IDS_REFRESH_SECONDS = env_int("BUSINESS_IDS_REFRESH_SECONDS", 300)
+BUSINESS_IDS: Dict[str, dict] = {}  # id -> {"tenant_slug", "page_name"}
+PAGE_ROUTES: Dict[str, list[dict]] = {}
+ACTIVE_PAGES: Dict[str, dict] = {}
+LEGACY_PAGE_TENANTS: Dict[str, str] = {}
+BUSINESS_IDS_STATS: Dict[str, Any] = {
+    "loads": 0, "errors": 0, "lookups": 0, "matches": 0, "loaded_at": 0,
+    "route_hits": 0, "route_misses": 0, "db_fallbacks": 0,
+}
+# "wanted" sube con cada aviso de cambio de páginas (o re-suscripción del listener);
+# "loaded" es el "wanted" vigente al empezar la última carga exitosa. El índice
+# solo es autoritativo si ninguna carga exitosa quedó pendiente.
+PAGE_INDEX_GEN = {"wanted": 0, "loaded": 0}
+
+
+def mark_page_index_stale() -> None:
+    PAGE_INDEX_GEN["wanted"] += 1
+
+
+def _page_record(row) -> dict:
+    return {
+        "page_id": row[0],
+        "page_token": row[1],
+        "ig_user_id": row[2],
+        "page_name": row[3],
+        "page_settings": row[4] or {},
+    }
+
+
+async def refresh_business_ids() -> int:
+    global BUSINESS_IDS, PAGE_ROUTES, ACTIVE_PAGES, LEGACY_PAGE_TENANTS
+    if not db_engine:
+        return 0
+    gen = PAGE_INDEX_GEN["wanted"]
+    try:
+        async with db_engine.connect() as conn:
+            rows = (await conn.execute(text("""
+                SELECT page_id, page_token, ig_user_id, page_name, page_settings, tenant_slug, is_active
+                FROM facebook_pages
+                ORDER BY is_active DESC NULLS LAST, id
+            """))).all()
+            legacy_rows = (await conn.execute(text("""
+                SELECT slug, settings->>'fb_page_id', settings->>'ig_user_id', settings->'ig_user_ids'
+                FROM tenants
+                WHERE settings ?| array['fb_page_id', 'ig_user_id', 'ig_user_ids']
+            """))).all()
+    except Exception as e:
+        BUSINESS_IDS_STATS["errors"] += 1
+        log.warning(f"[business-ids] no se pudo cargar facebook_pages: {e}")
+        return len(BUSINESS_IDS)
+    index: Dict[str, dict] = {}
+    routes: Dict[str, list[dict]] = {}
+    active: Dict[str, dict] = {}
+    for row in rows:
+        page = _page_record(row)
+        tenant_slug, is_active = row[5], row[6]
+        page["tenant_slug"] = tenant_slug
+        info = {"tenant_slug": tenant_slug, "page_name": page["page_name"]}
+        for bid in (page["page_id"], page["ig_user_id"]):
+            if bid:
+                index[str(bid)] = info
+                routes.setdefault(str(bid), []).append(page)
+        if is_active and tenant_slug not in active:
+            active[tenant_slug] = page
+    legacy: Dict[str, str] = {}
+    for slug, fb_page_id, ig_user_id, ig_user_ids in legacy_rows:
+        if isinstance(ig_user_ids, str):
+            try:
+                ig_user_ids = json.loads(ig_user_ids)
+            except ValueError:
+                ig_user_ids = []
+        ids = [fb_page_id, ig_user_id] + (list(ig_user_ids) if isinstance(ig_user_ids, list) else [])
+        for lid in ids:
+            if lid:
+                legacy.setdefault(str(lid).strip(), slug)
+    # reemplazo atómico
+    BUSINESS_IDS, PAGE_ROUTES, ACTIVE_PAGES, LEGACY_PAGE_TENANTS = index, routes, active, legacy
+    BUSINESS_IDS_STATS["loads"] += 1
+    BUSINESS_IDS_STATS["loaded_at"] = now_ms()
+    PAGE_INDEX_GEN["loaded"] = max(PAGE_INDEX_GEN["loaded"], gen)
+    return len(index)
+
+
+def business_account_for(account_id: str) -> Optional[dict]:
+    BUSINESS_IDS_STATS["lookups"] += 1
+    info = BUSINESS_IDS.get(account_id) if account_id else None
+    if info is not None:
+        BUSINESS_IDS_STATS["matches"] += 1
+    return info
+
+
+def page_index_authoritative() -> bool:
+    """El índice está completo si cargó después del último aviso y el listener de NOTIFY está activo."""
+    return (bool(BUSINESS_IDS_STATS["loaded_at"]) and TENANT_CACHE.listening
+            and PAGE_INDEX_GEN["loaded"] >= PAGE_INDEX_GEN["wanted"])
+
+
+async def notify_pages_changed() -> None:
+    """Recarga el índice en este worker y pide a los demás que lo recarguen."""
+    mark_page_index_stale()
+    await refresh_business_ids()
+    await publish_invalidation("pages")
+
+
+async def business_ids_refresher():
+    last = time.monotonic()
+    while True:
+        await asyncio.sleep(TENANT_LISTEN_RETRY_SECONDS)
+        # Si una recarga tras un aviso falló, reintenta pronto en vez de esperar el ciclo entero
+        stale = PAGE_INDEX_GEN["loaded"] < PAGE_INDEX_GEN["wanted"]
+        if stale or time.monotonic() - last >= BUSINESS_IDS_REFRESH_SECONDS:
+            last = time.monotonic()
+            await refresh_business_ids()
+
+
 def fb_tokens_from_tenant(t: dict | None) -> tuple[str, str, str]:
     """Obtiene credenciales de Meta para el tenant exclusivamente desde DB.
 
@@ -1847,13 +3882,74 @@ async def meta_send_text(page_token: str, recipient_id: str, text: str, platform
         return r.json()
 
 
-SEEN_META_EVENTS: "OrderedDict[str, dict]" = OrderedDict()
-SEEN_META_MSGS: "OrderedDict[str, dict]" = OrderedDict()
+# Anti-loop: si un remitente manda LOOP_DETECTION_THRESHOLD+ DMs dentro de
+# LOOP_DETECTION_WINDOW_SECONDS probablemente es otro bot respondiendo al nuestro.
+# Por clave se guarda un deque acotado al umbral (O(1) por mensaje); las claves
+# están en orden de última actividad y se expiran por tiempo desde la cabeza.
+# Per-tenant: settings.loop_detection_threshold / loop_detection_window_seconds.
+LOOP_DETECTION_THRESHOLD = env_int("LOOP_DETECTION_THRESHOLD", 5)
+LOOP_DETECTION_WINDOW_SECONDS = env_int("LOOP_DETECTION_WINDOW_SECONDS", 30)
+LOOP_TRACK_MAX_KEYS = env_int("LOOP_TRACK_MAX_KEYS", 50_000)
+
+
+class LoopDetector:
+    def __init__(self, max_keys: int = LOOP_TRACK_MAX_KEYS):
+        self.recent: "OrderedDict[str, deque]" = OrderedDict()
+        self.max_keys = max_keys
+        self.stats = {"checks": 0, "blocked": 0, "evicted": 0}
+        self.blocked_by_tenant: Dict[str, int] = {}
+        self._max_window = LOOP_DETECTION_WINDOW_SECONDS
+
+    def hit(self, key: str, threshold: int, window: float, now: Optional[float] = None) -> int:
+        """Registra un mensaje; devuelve cuántos hubo en la ventana si se detecta loop, 0 si no."""
+        now = time.time() if now is None else now
+        threshold = max(2, threshold)
+        self._max_window = max(self._max_window, window)
+        self.stats["checks"] += 1
+        q = self.recent.get(key)
+        if q is None or q.maxlen != threshold:
+            q = self.recent[key] = deque(q or (), maxlen=threshold)
+        self.recent.move_to_end(key)
+        while q and now - q[0] >= window:
+            q.popleft()
+        q.append(now)
+        self._evict(now)
+        if len(q) >= threshold:
+            q.clear()  # reinicia el conteo tras bloquear
+            self.stats["blocked"] += 1
+            return threshold
+        return 0
+
+    def _evict(self, now: float) -> None:
+        recent = self.recent
+        while recent:
+            key, q = next(iter(recent.items()))
+            idle = not q or now - q[-1] >= self._max_window
+            if not idle and len(recent) <= self.max_keys:
+                return
+            recent.popitem(last=False)
+            self.stats["evicted"] += 1
+
+    def record_block(self, tenant_slug: str) -> None:
+        self.blocked_by_tenant[tenant_slug] = self.blocked_by_tenant.get(tenant_slug, 0) + 1
+
+    def snapshot(self) -> dict:
+        return {"keys": len(self.recent), **self.stats, "blocked_by_tenant": dict(self.blocked_by_tenant)}
+
+
+LOOP_DETECTOR = LoopDetector()
+
+
+def loop_detection_params(tenant: Optional[dict]) -> tuple[int, int]:
+    s = (tenant or {}).get("settings") or {}
+    try:
+        threshold = int(s.get("loop_detection_threshold") or LOOP_DETECTION_THRESHOLD)
+        window = int(s.get("loop_detection_window_seconds") or LOOP_DETECTION_WINDOW_SECONDS)
+    except (TypeError, ValueError):
+        threshold, window = LOOP_DETECTION_THRESHOLD, LOOP_DETECTION_WINDOW_SECONDS
+    return max(2, threshold), max(1, window)
+
 
-# Anti-loop: Track recent messages per session to detect loops
-RECENT_MESSAGES: "OrderedDict[str, list]" = OrderedDict()
-MAX_RECENT_MESSAGES = 10
-LOOP_DETECTION_THRESHOLD = 5  # If 5+ messages in 30 seconds, likely a loop
 # Pausas de bot por conversación (en memoria)
 PAUSED_SESSIONS: set[str] = set()
 
@@ -1862,42 +3958,103 @@ def _seen_key(obj: str, owner: str, field: str, verb: str, cid: str) -> str:
     return "|".join([obj or "", owner or "", field or "", verb or "", cid or ""])
 
 
-def meta_event_seen(key: str) -> bool:
-    now = time.time()
-    # Purga eventos caducos
-    drop: list[str] = []
-    for k, v in SEEN_META_EVENTS.items():
-        if now - v["at"] > META_SEEN_TTL:
-            drop.append(k)
-    for k in drop:
-        SEEN_META_EVENTS.pop(k, None)
-
-    if key in SEEN_META_EVENTS:
-        return True
+# ── Dedupe de webhooks de Meta ─────────────────────────────────────────
+# Meta reintenta entregas: cada evento/mid se recuerda META_SEEN_TTL segundos.
+# Como el TTL es fijo, el orden de inserción es el orden de vencimiento y basta
+# con expirar desde la cabeza del OrderedDict (O(1) amortizado). Con
+# META_DEDUPE_BACKEND compartido, la primera vez que un worker ve una clave la
+# reclama de forma atómica en el store (SET NX / INSERT ... ON CONFLICT), así los
+# reintentos se descartan también entre workers y tras reinicios.
+class TTLDedupe:
+    def __init__(self, name: str, ttl: int = META_SEEN_TTL, capacity: int = META_SEEN_MAX, backend: str = META_DEDUPE_BACKEND):
+        self.name = name
+        self.ttl = ttl
+        self.capacity = capacity
+        self.entries: "OrderedDict[str, float]" = OrderedDict()  # clave -> vence (time.time())
+        self.stats = {"hits": 0, "misses": 0, "shared_hits": 0, "expired": 0, "evicted": 0, "errors": 0}
+        self.backend = backend
+        self.kv = None
+        if backend == "local":
+            self.kv = LocalKV()
+        elif backend == "redis":
+            self.kv = redis_from_url(os.getenv("META_DEDUPE_URL", "") or os.getenv("SESSION_STORE_URL", ""))
+            if self.kv is None:
+                log.warning(f"[dedupe] {name}: backend redis sin el paquete redis; solo memoria")
+                self.backend = "memory"
+        self._last_purge = time.time()
+
+    def _expire(self, now: float) -> None:
+        entries = self.entries
+        while entries:
+            key, expires = next(iter(entries.items()))
+            if expires > now:
+                break
+            entries.popitem(last=False)
+            self.stats["expired"] += 1
+
+    def seen_local(self, key: str) -> bool:
+        """Marca la clave en memoria; True si ya estaba vigente."""
+        now = time.time()
+        self._expire(now)
+        if key in self.entries:
+            self.stats["hits"] += 1
+            return True
+        while len(self.entries) >= self.capacity > 0:
+            self.entries.popitem(last=False)
+            self.stats["evicted"] += 1
+        self.entries[key] = now + self.ttl
+        self.stats["misses"] += 1
+        return False
 
-    while len(SEEN_META_EVENTS) >= META_SEEN_MAX > 0:
-        SEEN_META_EVENTS.popitem(last=False)
+    async def seen(self, key: str) -> bool:
+        if not key:
+            return False
+        if self.seen_local(key):
+            return True
+        try:
+            claimed = await self._claim(key)
+        except Exception as e:
+            self.stats["errors"] += 1
+            log.warning(f"[dedupe] {self.name}: store no disponible, solo memoria: {e}")
+            return False
+        if not claimed:
+            self.stats["shared_hits"] += 1
+        return not claimed
+
+    async def _claim(self, key: str) -> bool:
+        skey = f"zia:seen:{self.name}:{key}"
+        if self.kv is not None:
+            return bool(await self.kv.set(skey, "1", ex=self.ttl, nx=True))
+        if self.backend != "postgres" or not db_engine:
+            return True
+        async with db_engine.begin() as conn:
+            row = (await conn.execute(
+                text("""INSERT INTO meta_dedupe (key, expires_at)
+                        VALUES (:key, NOW() + make_interval(secs => :ttl))
+                        ON CONFLICT (key) DO UPDATE SET expires_at = EXCLUDED.expires_at
+                        WHERE meta_dedupe.expires_at < NOW()
+                        RETURNING key"""),
+                {"key": skey, "ttl": self.ttl},
+            )).first()
+            if time.time() - self._last_purge > self.ttl:
+                self._last_purge = time.time()
+                await conn.execute(text("DELETE FROM meta_dedupe WHERE expires_at < NOW()"))
+        return row is not None
 
-    SEEN_META_EVENTS[key] = {"at": now}
-    return False
+    def snapshot(self) -> dict:
+        return {"backend": self.backend, "size": len(self.entries), "capacity": self.capacity, **self.stats}
 
 
-def meta_message_seen(mid: str) -> bool:
-    if not mid:
-        return False
-    now = time.time()
-    drop: list[str] = []
-    for k, v in SEEN_META_MSGS.items():
-        if now - v["at"] > META_SEEN_TTL:
-            drop.append(k)
-    for k in drop:
-        SEEN_META_MSGS.pop(k, None)
-    if mid in SEEN_META_MSGS:
-        return True
-    while len(SEEN_META_MSGS) >= META_SEEN_MAX > 0:
-        SEEN_META_MSGS.popitem(last=False)
-    SEEN_META_MSGS[mid] = {"at": now}
-    return False
+SEEN_META_EVENTS = TTLDedupe("event")
+SEEN_META_MSGS = TTLDedupe("mid")
+
+
+async def meta_event_seen(key: str) -> bool:
+    return await SEEN_META_EVENTS.seen(key)
+
+
+async def meta_message_seen(mid: str) -> bool:
+    return await SEEN_META_MSGS.seen(mid)
 
 
 async def fb_reply_comment(page_token: str, comment_id: str, message: str) -> dict:
@@ -1946,12 +4103,13 @@ def get_twilio_client_for_tenant(t: dict | None):
         return None
     return TwilioClient(sid, tok)
 
-def build_system_for_tenant(tenant: Optional[dict], page_settings: Optional[dict] = None) -> str:
+def build_system_for_tenant(tenant: Optional[dict], page_settings: Optional[dict] = None, include_faq: bool = True) -> str:
     """Construye el prompt del sistema personalizado para un tenant.
 
     Args:
         tenant: Tenant data with settings
         page_settings: Optional page-specific settings that override tenant settings
+        include_faq: False cuando el FAQ lo agrega build_messages_with_history según presupuesto
     """
     # Prefer page_settings over tenant settings for multi-page accounts
     s = page_settings or (tenant or {}).get("settings", {}) or {}
@@ -1981,18 +4139,26 @@ def build_system_for_tenant(tenant: Optional[dict], page_settings: Optional[dict
     if prices and isinstance(prices, dict):
         price_txt = "; ".join(f"{k}: {v}" for k, v in prices.items())
         extras.append(f"Precios conocidos (orientativos): {price_txt}.")
-    if faq:
-        def fmt(item):
-            if isinstance(item, dict):
-                q = item.get("q", "")
-                a = item.get("a", "")
-                return f"Q: {q} | A: {a}"
-            return str(item)
-        faq_txt = " | ".join(fmt(x) for x in faq[:8])
+    if faq and include_faq:
+        faq_txt = " | ".join(tenant_faq_entries(tenant, page_settings))
         extras.append(f"FAQ internas (usa si aplica, concisas): {faq_txt}.")
 
     return (base + "\n" + " ".join(extras)).strip()
 
+
+def tenant_faq_entries(tenant: Optional[dict], page_settings: Optional[dict] = None, limit: int = 8) -> list[str]:
+    s = page_settings or (tenant or {}).get("settings", {}) or {}
+    faq = s.get("faq", []) or []
+    if not isinstance(faq, list):
+        return []
+    out: list[str] = []
+    for item in faq[:limit]:
+        if isinstance(item, dict):
+            out.append(f"Q: {item.get('q', '')} | A: {item.get('a', '')}")
+        else:
+            out.append(str(item))
+    return out
+
 # ── Catálogo externo (por tenant) ─────────────────────────────────────
 CATALOG_CACHE: Dict[str, dict] = {}
 CATALOG_TTL_SECONDS = 300  # 5 minutos
@@ -2087,19 +4253,21 @@ async def fetch_catalog_for_tenant(t: dict | None) -> list[dict]:
     CATALOG_CACHE[slug] = {"at": now, "items": normd}
     return normd
 
+CATALOG_PROMPT_HEADER = "Catálogo del cliente (resumen, usa como base para respuestas y links):"
+
+def catalog_item_prompt_line(it: dict, max_desc: int = CATALOG_MAX_DESC_LENGTH) -> str:
+    name = (it.get("name") or "").strip()
+    pid  = (it.get("product_id") or "").strip()
+    desc = (it.get("description") or "").strip()
+    if len(desc) > max_desc:
+        desc = desc[:max_desc - 1].rstrip() + "…"
+    return f"• {name} — {desc} ({pid})" if pid else f"• {name} — {desc}"
+
 def summarize_catalog_for_prompt(items: list[dict], max_items: int = 14, max_desc: int = 120) -> str:
     if not items:
         return ""
-    parts: list[str] = []
-    for it in items[:max_items]:
-        name = (it.get("name") or "").strip()
-        pid  = (it.get("product_id") or "").strip()
-        desc = (it.get("description") or "").strip()
-        if len(desc) > max_desc:
-            desc = desc[:max_desc - 1].rstrip() + "…"
-        label = f"• {name} — {desc} ({pid})" if pid else f"• {name} — {desc}"
-        parts.append(label)
-    return ("Catálogo del cliente (resumen, usa como base para respuestas y links):\n" + "\n".join(parts)).strip()
+    parts = [catalog_item_prompt_line(it, max_desc) for it in items[:max_items]]
+    return (CATALOG_PROMPT_HEADER + "\n" + "\n".join(parts)).strip()
 
 def _match_catalog_item(user_text: str, items: list[dict]) -> dict | None:
     t = (user_text or "").lower()
@@ -2316,182 +4484,1236 @@ async def _create_checkout_for_item(t: dict | None, item: dict, qty: int = 1, mo
         raise HTTPException(502, "No se pudo crear la sesión de pago")
     return {"id": session.id, "url": session.url}
 
-def build_messages_with_history(sid: str, system_prompt: str, max_pairs: int = CHAT_MAX_HISTORY_PAIRS) -> list[dict]:
-    convo = MESSAGES.get(sid, [])
-    recent = convo[-2*max_pairs:]
-    history = [{"role": m["role"], "content": m["content"]} for m in recent]
-    return [{"role": "system", "content": system_prompt}] + history
+# ── Contexto con presupuesto de tokens ─────────────────────────────────
+# Prioridad al llenar la ventana: system prompt → turnos recientes →
+# catálogo/FAQ relevantes a la pregunta → turnos anteriores.
+LLM_CONTEXT_TOKEN_BUDGET = env_int("LLM_CONTEXT_TOKEN_BUDGET", 3000)
+LLM_CONTEXT_RECENT_TURNS = env_int("LLM_CONTEXT_RECENT_TURNS", 4)  # mensajes, no pares
+LLM_CONTEXT_MAX_MESSAGES = env_int("LLM_CONTEXT_MAX_MESSAGES", 40)  # tope de seguridad; manda el presupuesto
+LLM_CONTEXT_MODEL_BUDGETS: Dict[str, int] = {}  # overrides por modelo, ej. {"gpt-4o": 6000}
+CONTEXT_TOKEN_STATS: Dict[str, int] = {"requests": 0, "tokens_total": 0, "tokens_max": 0, "truncated": 0}
 
-def suggest_ui_for_text(user_text: str, tenant: Optional[dict]) -> dict:
-    text_ = (user_text or "").lower()
-    chips = []
-    if any(w in text_ for w in ["reserva", "reservar", "booking"]):
-        chips += ["Hacer reserva"]
-    if any(w in text_ for w in ["precio", "tarifa", "cotiza", "costo"]):
-        chips += ["Ver tarifas", "Solicitar cotización"]
-    if not chips:
-        chips = ["Probar funciones", "Integraciones", "Contactar por WhatsApp"]
-    wa_num = clean_phone_for_wa((tenant or {}).get("whatsapp"))
-    wa_link = f"https://wa.me/{wa_num}" if wa_num else None
-    show_bubble = any(w in text_ for w in ["whatsapp", "wasap", "contacto", "contact"])
-    if show_bubble:
-        chips = [c for c in chips if "whats" not in c.lower()]
-    return {
-        "chips": chips,
-        "whatsapp": wa_link if show_bubble and wa_link else None,
-        "showWhatsAppBubble": bool(show_bubble and wa_link),
+
+def context_budget_for(tenant: Optional[dict], model: str = OPENAI_MODEL) -> int:
+    s = (tenant or {}).get("settings") or {}
+    try:
+        v = int(s.get("context_token_budget") or 0)
+    except (TypeError, ValueError):
+        v = 0
+    return v if v > 0 else LLM_CONTEXT_MODEL_BUDGETS.get(model, LLM_CONTEXT_TOKEN_BUDGET)
+
+
+def _relevance_words(text_in: str) -> set[str]:
+    return {w for w in re.split(r"[^a-z0-9ñáéíóúü]+", (text_in or "").lower()) if len(w) >= 3}
+
+
+def _rank_knowledge(question: str, catalog_items: list[dict], faq: list[str]) -> list[tuple[str, str]]:
+    """Lista [(tipo, línea)] de catálogo y FAQ ordenada por relevancia con la pregunta."""
+    words = _relevance_words(question)
+    scored: list[tuple[float, int, str, str]] = []
+    for i, it in enumerate((catalog_items or [])[:CATALOG_MAX_ITEMS]):
+        name = (it.get("name") or "").lower()
+        desc = (it.get("description") or "").lower()
+        score = sum(1.5 if w in name else 0.5 if w in desc else 0.0 for w in words)
+        scored.append((score, i, "catalog", catalog_item_prompt_line(it)))
+    for i, line in enumerate(faq or []):
+        line_words = _relevance_words(line)
+        score = float(len(words & line_words))
+        scored.append((score, i, "faq", line))
+    scored.sort(key=lambda x: (-x[0], x[1]))
+    return [(kind, line) for _, _, kind, line in scored]
+
+
+# ── Rehidratación de historial ─────────────────────────────────────────
+# Tras un reinicio MESSAGES está vacío aunque cada turno ya esté en `messages`
+# (log_message). En el primer uso de una sesión se cargan los últimos turnos y
+# el resumen persistido; las cargas concurrentes de la misma sesión comparten
+# una sola consulta.
+HISTORY_REHYDRATE_MESSAGES = env_int("HISTORY_REHYDRATE_MESSAGES", LLM_CONTEXT_MAX_MESSAGES)
+HISTORY_REHYDRATIONS: Dict[str, asyncio.Future] = {}
+HISTORY_REHYDRATE_STATS: Dict[str, int] = {"loads": 0, "coalesced": 0, "rows": 0, "errors": 0}
+
+
+async def _load_history_rows(sid: str) -> tuple[list[ChatMessage], Optional[dict]]:
+    async with db_engine.connect() as conn:
+        rows = (await conn.execute(
+            text("""SELECT direction, content, (EXTRACT(EPOCH FROM created_at) * 1000)::BIGINT AS ts
+                    FROM messages
+                    WHERE session_id = :sid
+                    ORDER BY id DESC
+                    LIMIT :limit"""),
+            {"sid": sid, "limit": HISTORY_REHYDRATE_MESSAGES},
+        )).mappings().all()
+        summary = (await conn.execute(
+            text("SELECT summary, summary_until_ts FROM session_summaries WHERE session_id = :sid"),
+            {"sid": sid},
+        )).mappings().first()
+    history = [
+        ChatMessage(Role.USER if r["direction"] == "in" else Role.ASSISTANT, r["content"], int(r["ts"] or 0))
+        for r in reversed(rows) if r["content"]
+    ]
+    return history, (dict(summary) if summary else None)
+
+
+async def _rehydrate_history(sid: str) -> bool:
+    """True si el historial quedó cargado; False si la DB falló (se reintenta en el próximo turno)."""
+    HISTORY_REHYDRATE_STATS["loads"] += 1
+    try:
+        history, summary = await _load_history_rows(sid)
+    except Exception as e:
+        HISTORY_REHYDRATE_STATS["errors"] += 1
+        log.warning(f"[history] no se pudo rehidratar sid={sid}: {e}")
+        return False
+    sess = _session_record(sid)
+    local = MESSAGES[sid]
+    # Lo que ya está en memoria (el turno actual) puede haberse insertado ya en la DB
+    if local:
+        first = local[0]
+        history = [m for m in history if m.ts < first.ts]
+        if history and history[-1].role == first.role and history[-1].content == first.content:
+            history.pop()
+    if history:
+        local[:0] = history
+        recount_session_bytes(sid)
+        HISTORY_REHYDRATE_STATS["rows"] += len(history)
+    if summary and not sess.get("summary"):
+        sess["summary"] = summary["summary"]
+        sess["summary_until_ts"] = int(summary["summary_until_ts"] or 0)
+    mark_session_dirty(sid)
+    log.debug(f"[history] sid={sid} rehidratados={len(history)} resumen={'sí' if summary else 'no'}")
+    return True
+
+
+async def ensure_history_loaded(sid: str) -> None:
+    sess = SESSIONS.get(sid)
+    if not db_engine or sess is None or sess.get("history_loaded"):
+        return
+    fut = HISTORY_REHYDRATIONS.get(sid)
+    if fut is None:
+        fut = asyncio.ensure_future(_rehydrate_history(sid))
+        HISTORY_REHYDRATIONS[sid] = fut
+        fut.add_done_callback(lambda f, k=sid: HISTORY_REHYDRATIONS.pop(k, None))
+    else:
+        HISTORY_REHYDRATE_STATS["coalesced"] += 1
+    if await asyncio.shield(fut):
+        sess["history_loaded"] = True
+
+
+async def build_messages_with_history(
+    sid: str,
+    system_prompt: str,
+    max_messages: int = LLM_CONTEXT_MAX_MESSAGES,
+    *,
+    tenant: Optional[dict] = None,
+    catalog_items: Optional[list[dict]] = None,
+    faq: Optional[list[str]] = None,
+    model: str = OPENAI_MODEL,
+) -> list[dict]:
+    await ensure_history_loaded(sid)
+    budget = context_budget_for(tenant, model)
+    sess = SESSIONS.get(sid) or {}
+    summary = sess.get("summary") or ""
+    summary_until = sess.get("summary_until_ts") or 0
+    convo = [m for m in MESSAGES.get(sid, []) if m.ts > summary_until]
+    maybe_schedule_summary(sid, (tenant or {}).get("slug") or "public", len(convo))
+    if max_messages > 0:
+        convo = convo[-max_messages:]
+    costs = [rough_token_count(m.content) + LLM_TOKENS_PER_MESSAGE for m in convo]
+    if summary:
+        system_prompt = f"{system_prompt}\n\nResumen de la conversación previa con este cliente: {summary}"
+    used = rough_token_count(system_prompt) + LLM_TOKENS_PER_MESSAGE
+
+    # 1) Turnos recientes (la última pregunta siempre entra)
+    keep_from = len(convo)
+    recent_floor = max(0, len(convo) - LLM_CONTEXT_RECENT_TURNS)
+    while keep_from > recent_floor:
+        cost = costs[keep_from - 1]
+        if keep_from < len(convo) and used + cost > budget:
+            break
+        used += cost
+        keep_from -= 1
+
+    # 2) Catálogo / FAQ relevantes a la pregunta
+    question = convo[-1].content if convo and convo[-1].role is Role.USER else ""
+    picked: Dict[str, list[str]] = {"catalog": [], "faq": []}
+    headers = {"catalog": CATALOG_PROMPT_HEADER, "faq": "FAQ internas (usa si aplica, concisas):"}
+    truncated = False
+    for kind, line in _rank_knowledge(question, catalog_items or [], faq or []):
+        cost = rough_token_count(line) + (0 if picked[kind] else rough_token_count(headers[kind]))
+        if used + cost > budget:
+            truncated = True
+            continue
+        picked[kind].append(line)
+        used += cost
+
+    # 3) Turnos anteriores mientras quepan
+    while keep_from > 0 and used + costs[keep_from - 1] <= budget:
+        used += costs[keep_from - 1]
+        keep_from -= 1
+    if keep_from > 0:
+        truncated = True
+
+    system_parts = [system_prompt]
+    for kind in ("catalog", "faq"):
+        if picked[kind]:
+            system_parts.append(headers[kind] + "\n" + "\n".join(picked[kind]))
+    history = [{"role": m.role.value, "content": m.content} for m in convo[keep_from:]]
+
+    CONTEXT_TOKEN_STATS["requests"] += 1
+    CONTEXT_TOKEN_STATS["tokens_total"] += used
+    CONTEXT_TOKEN_STATS["tokens_max"] = max(CONTEXT_TOKEN_STATS["tokens_max"], used)
+    if truncated:
+        CONTEXT_TOKEN_STATS["truncated"] += 1
+    if sid in SESSIONS:
+        SESSIONS[sid]["last_context_tokens"] = used
+    log.debug(f"[ctx] sid={sid} tokens≈{used}/{budget} turns={len(history)} catalog={len(picked['catalog'])} faq={len(picked['faq'])}")
+
+    return [{"role": "system", "content": "\n\n".join(system_parts)}] + history
+
+
+# ── Resumen rodante de conversación ────────────────────────────────────
+# Cuando una sesión acumula más de LLM_SUMMARY_TRIGGER_MESSAGES mensajes sin
+# resumir, los turnos viejos se pliegan (en background) en un resumen corto que
+# viaja en el system prompt; solo se envían completos los últimos turnos.
+LLM_SUMMARY_TRIGGER_MESSAGES = env_int("LLM_SUMMARY_TRIGGER_MESSAGES", 16)
+LLM_SUMMARY_KEEP_RECENT = env_int("LLM_SUMMARY_KEEP_RECENT", 6)
+LLM_SUMMARY_MAX_CHARS = 1200
+SUMMARIES_IN_PROGRESS: set[str] = set()
+
+SUMMARY_PROMPT = (
+    "Resume la conversación entre un cliente y el asistente de un negocio en máximo 120 palabras, "
+    "en español y en tercera persona. Conserva datos útiles para continuar la atención: nombre, "
+    "productos o servicios de interés, cantidades, precios cotizados, fechas, pedidos, datos de "
+    "contacto compartidos y preguntas pendientes. No inventes nada."
+)
+
+
+def maybe_schedule_summary(sid: str, tenant_slug: str, unsummarized: int) -> None:
+    if USE_MOCK or unsummarized <= LLM_SUMMARY_TRIGGER_MESSAGES or sid in SUMMARIES_IN_PROGRESS:
+        return
+    SUMMARIES_IN_PROGRESS.add(sid)
+    TASKS.spawn("summarize_session", summarize_session(sid, tenant_slug))
+
+
+async def summarize_session(sid: str, tenant_slug: str) -> None:
+    try:
+        sess = SESSIONS.get(sid)
+        if sess is None:
+            return
+        until = sess.get("summary_until_ts") or 0
+        pending = [m for m in MESSAGES.get(sid, []) if m.ts > until]
+        to_fold = pending[:-LLM_SUMMARY_KEEP_RECENT] if LLM_SUMMARY_KEEP_RECENT else pending
+        if not to_fold:
+            return
+        transcript = "\n".join(
+            f"{'Cliente' if m.role is Role.USER else 'Asistente'}: {m.content}" for m in to_fold
+        )
+        previous = sess.get("summary") or ""
+        user_msg = (f"Resumen previo: {previous}\n\n" if previous else "") + f"Nuevos mensajes:\n{transcript}"
+        summary = (await llm_complete(
+            [{"role": "system", "content": SUMMARY_PROMPT}, {"role": "user", "content": user_msg}],
+            channel="summary",
+            tenant={"slug": tenant_slug},
+        )).strip()[:LLM_SUMMARY_MAX_CHARS]
+        if not summary:
+            return
+        new_until = to_fold[-1].ts
+        sess["summary"] = summary
+        sess["summary_until_ts"] = new_until
+        mark_session_dirty(sid)
+        log.debug(f"[summary] sid={sid} plegados={len(to_fold)} chars={len(summary)}")
+        await persist_session_summary(sid, tenant_slug, summary, new_until)
+    except Exception as e:
+        log.warning(f"[summary] no se pudo resumir sid={sid}: {e}")
+    finally:
+        SUMMARIES_IN_PROGRESS.discard(sid)
+
+
+async def persist_session_summary(sid: str, tenant_slug: str, summary: str, until_ts: int) -> None:
+    if not db_engine:
+        return
+    async with db_engine.begin() as conn:
+        await conn.execute(
+            text("""INSERT INTO session_summaries (session_id, tenant_slug, summary, summary_until_ts)
+                    VALUES (:sid, :tenant, :summary, :until)
+                    ON CONFLICT (session_id) DO UPDATE
+                    SET summary = EXCLUDED.summary,
+                        summary_until_ts = EXCLUDED.summary_until_ts,
+                        updated_at = NOW()"""),
+            {"sid": sid, "tenant": tenant_slug, "summary": summary, "until": until_ts}
+        )
+
+
+def context_token_stats() -> dict:
+    n = CONTEXT_TOKEN_STATS["requests"]
+    return {
+        **CONTEXT_TOKEN_STATS,
+        "tokens_avg": round(CONTEXT_TOKEN_STATS["tokens_total"] / n, 1) if n else 0.0,
+        "default_budget": LLM_CONTEXT_TOKEN_BUDGET,
+    }
+
+def suggest_ui_for_text(user_text: str, tenant: Optional[dict]) -> dict:
+    text_ = (user_text or "").lower()
+    chips = []
+    if any(w in text_ for w in ["reserva", "reservar", "booking"]):
+        chips += ["Hacer reserva"]
+    if any(w in text_ for w in ["precio", "tarifa", "cotiza", "costo"]):
+        chips += ["Ver tarifas", "Solicitar cotización"]
+    if not chips:
+        chips = ["Probar funciones", "Integraciones", "Contactar por WhatsApp"]
+    wa_num = clean_phone_for_wa((tenant or {}).get("whatsapp"))
+    wa_link = f"https://wa.me/{wa_num}" if wa_num else None
+    show_bubble = any(w in text_ for w in ["whatsapp", "wasap", "contacto", "contact"])
+    if show_bubble:
+        chips = [c for c in chips if "whats" not in c.lower()]
+    return {
+        "chips": chips,
+        "whatsapp": wa_link if show_bubble and wa_link else None,
+        "showWhatsAppBubble": bool(show_bubble and wa_link),
+    }
+
+# ── Endpoints utilitarios ──────────────────────────────────────────────
+@app.get("/health")
+async def health():
+    return {"ok": True, "mode": "mock" if USE_MOCK else "real"}
+
+# DB healthcheck (admin-only)
+@app.get("/db/health", dependencies=[Depends(require_admin)])
+async def db_health():
+    if not db_engine:
+        return {"ok": False, "configured": False, "message": "DATABASE_URL no configurado o DB no inicializada"}
+    try:
+        async with db_engine.connect() as conn:
+            # ping
+            pong = (await conn.execute(text("SELECT 1"))).scalar_one()
+            # check tables existence
+            row = (await conn.execute(text(
+                "SELECT "
+                "  to_regclass('public.tenants') IS NOT NULL AS tenants, "
+                "  to_regclass('public.leads')   IS NOT NULL AS leads, "
+                "  to_regclass('public.events')  IS NOT NULL AS events"
+            ))).first()
+        return {
+            "ok": True,
+            "configured": True,
+            "ping": (pong == 1),
+            "tables": {"tenants": bool(row.tenants), "leads": bool(row.leads), "events": bool(row.events)}
+        }
+    except Exception as e:
+        log.error(f"DB healthcheck failed: {e}")
+        return {"ok": False, "configured": True, "error": str(e)}
+
+# Métricas en memoria del proceso (admin-only)
+@app.get("/v1/admin/runtime/metrics", dependencies=[Depends(require_admin)])
+async def runtime_metrics():
+    return {
+        "llm_cache": llm_cache_stats(),
+        "llm_singleflight": llm_singleflight_stats(),
+        "llm_context": context_token_stats(),
+        "llm_admission": LLM_ADMISSION.stats(),
+        "llm_hedge": llm_hedge_stats(),
+        "llm_routes": LLM_ROUTE_STATS,
+        "rate_limit": RATE_LIMITER.snapshot(),
+        "inbound_mailbox": INBOUND_MAILBOX.snapshot(),
+        "loop_detection": LOOP_DETECTOR.snapshot(),
+        "business_ids": {
+            "ids": len(BUSINESS_IDS),
+            "active_pages": len(ACTIVE_PAGES),
+            "legacy_ids": len(LEGACY_PAGE_TENANTS),
+            "authoritative": page_index_authoritative(),
+            **BUSINESS_IDS_STATS,
+        },
+        "tenant_cache": TENANT_CACHE.snapshot(),
+        "principal_cache": PRINCIPAL_CACHE.snapshot(),
+        "write_behind": WRITE_BEHIND.snapshot(),
+        "background_tasks": TASKS.snapshot(),
+        "meta_dedupe": {"events": SEEN_META_EVENTS.snapshot(), "messages": SEEN_META_MSGS.snapshot()},
+        "session_cache": session_cache_stats(),
+        "session_store": session_store_stats(),
+        "history_rehydrate": HISTORY_REHYDRATE_STATS,
+    }
+
+@app.post("/v1/tenants", dependencies=[Depends(require_admin)])
+async def upsert_tenant(body: TenantIn):
+    if not db_engine:
+        raise HTTPException(503, "Database not configured")
+    async with db_engine.begin() as conn:
+        row = (await conn.execute(
+            text("""
+                INSERT INTO tenants (slug, name, whatsapp, settings)
+                VALUES (:slug, :name, :whatsapp, CAST(:settings AS JSONB))
+                ON CONFLICT (slug) DO UPDATE
+                  SET name = EXCLUDED.name,
+                      whatsapp = EXCLUDED.whatsapp,
+                      settings = EXCLUDED.settings,
+                      updated_at = NOW()
+                RETURNING id, slug, name, whatsapp, settings
+            """),
+            {"slug": body.slug, "name": body.name, "whatsapp": body.whatsapp, "settings": json.dumps(body.settings)}
+        )).first()
+    await invalidate_tenant(body.slug)
+    return dict(row._mapping)
+
+@app.get("/v1/widget/bootstrap")
+async def widget_bootstrap(tenant: str):
+    if tenant and not valid_slug(tenant):
+        raise HTTPException(400, "Invalid tenant")
+    if not db_engine:
+        # Modo sin DB: entregar algo básico
+        return {
+            "tenant": {"slug": tenant, "name": tenant or "zIA", "whatsapp": None, "settings": {}},
+            "ui": {"suggestions": ["Probar funciones","Integraciones","Contactar por WhatsApp"]}
+        }
+    async with db_engine.connect() as conn:
+        t = (await conn.execute(
+            text("SELECT id, slug, name, whatsapp, settings FROM tenants WHERE slug=:slug"),
+            {"slug": tenant}
+        )).first()
+    if not t:
+        raise HTTPException(404, f"Tenant '{tenant}' no encontrado")
+    tenant_obj = dict(t._mapping)
+    # Pre-carga de catálogo para que el frontend pueda mostrar chips/estado si quiere
+    try:
+        items = await fetch_catalog_for_tenant(tenant_obj)
+        has_catalog = bool(items)
+    except Exception:
+        has_catalog = False
+    settings = tenant_obj.get("settings") or {}
+    widget_chips = settings.get("widget_chips")
+    if not widget_chips:
+        widget_chips = []
+        if has_catalog:
+            widget_chips.append("Ver catálogo")
+        widget_chips.append("Solicitar cotización")
+        if tenant_obj.get("whatsapp"):
+            widget_chips.append("Contactar por WhatsApp")
+        if not widget_chips:
+            widget_chips = ["Solicitar cotización", "Más información"]
+    return {
+        "tenant": tenant_obj,
+        "ui": {
+            "suggestions": widget_chips
+        },
+        "catalog": {"present": has_catalog}
+    }
+
+@app.options("/v1/chat/stream")
+async def options_stream():
+    return Response(status_code=204)
+
+@app.options("/v1/widget/bootstrap")
+async def options_bootstrap():
+    return Response(status_code=204)
+
+@app.options("/v1/events")
+async def options_events():
+    return Response(status_code=204)
+
+# ── Servicio de completions (LLM async) ────────────────────────────────
+# Un solo cliente async con pool de conexiones compartido por todos los canales
+# (web, WhatsApp, Messenger/IG). Cada canal tiene su propio timeout.
+LLM_MAX_CONNECTIONS = env_int("LLM_MAX_CONNECTIONS", 100)
+LLM_MAX_KEEPALIVE = env_int("LLM_MAX_KEEPALIVE", 20)
+
+aclient = AsyncOpenAI(
+    http_client=httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=LLM_MAX_CONNECTIONS,
+            max_keepalive_connections=LLM_MAX_KEEPALIVE,
+        ),
+        timeout=httpx.Timeout(60.0, connect=DB_CONNECT_TIMEOUT),
+    )
+)
+
+LLM_CHANNEL_TIMEOUTS: Dict[str, float] = {
+    "web": float(env_int("LLM_TIMEOUT_WEB", 30)),
+    "web_stream": float(env_int("LLM_TIMEOUT_WEB_STREAM", 60)),
+    "whatsapp": float(env_int("LLM_TIMEOUT_WHATSAPP", 12)),
+    "facebook_dm": float(env_int("LLM_TIMEOUT_META_DM", 12)),
+    "instagram_dm": float(env_int("LLM_TIMEOUT_META_DM", 12)),
+    "facebook_comment": float(env_int("LLM_TIMEOUT_META_COMMENT", 10)),
+    "instagram_comment": float(env_int("LLM_TIMEOUT_META_COMMENT", 10)),
+    "summary": float(env_int("LLM_TIMEOUT_SUMMARY", 30)),
+}
+
+
+def llm_timeout_for(channel: str) -> float:
+    return LLM_CHANNEL_TIMEOUTS.get(channel, LLM_CHANNEL_TIMEOUTS["web"])
+
+
+# ── Cache de respuestas LLM (por tenant, opt-in) ───────────────────────
+# Se activa por tenant con settings.llm_cache_enabled (TTL opcional en
+# settings.llm_cache_ttl_seconds). Solo aplica a preguntas "sueltas": si la
+# conversación ya tiene historial, la respuesta depende del contexto y se omite.
+LLM_CACHE_MAX_ENTRIES = env_int("LLM_CACHE_MAX_ENTRIES", 2000)
+LLM_CACHE_TTL_SECONDS = env_int("LLM_CACHE_TTL_SECONDS", 600)
+LLM_CACHE_MAX_PRIOR_TURNS = env_int("LLM_CACHE_MAX_PRIOR_TURNS", 0)
+LLM_CACHE_REPLAY_CHUNK = 48  # caracteres por delta al reproducir un hit en SSE
+
+LLM_CACHE: "OrderedDict[str, tuple[float, str]]" = OrderedDict()  # key -> (expira_en, respuesta)
+LLM_CACHE_STATS: Dict[str, Dict[str, int]] = {}  # tenant -> {hits, misses, bypass}
+
+_CACHE_PUNCT_RE = re.compile(r"[¿?¡!.,;:\"'()\[\]]+")
+
+
+def normalize_question(text_in: str) -> str:
+    t = (text_in or "").strip().lower()
+    t = _CACHE_PUNCT_RE.sub(" ", t)
+    return " ".join(t.split())
+
+
+def llm_request_key(tenant_slug: str, messages: list[dict], model: str) -> Optional[str]:
+    """
+    Clave (tenant, modelo, hash del contexto, pregunta normalizada). El contexto es
+    todo lo previo a la última pregunta: system prompt + catálogo y el historial.
+    """
+    if not messages or messages[-1].get("role") != "user":
+        return None
+    question = normalize_question(messages[-1].get("content") or "")
+    if not question:
+        return None
+    context = "\n".join(f"{m.get('role')}:{m.get('content') or ''}" for m in messages[:-1])
+    prompt_hash = hashlib.sha256(context.encode("utf-8")).hexdigest()[:16]
+    return f"{tenant_slug}|{model}|{prompt_hash}|{question}"
+
+
+def _llm_cache_count(tenant_slug: str, field: str) -> None:
+    stats = LLM_CACHE_STATS.setdefault(tenant_slug, {"hits": 0, "misses": 0, "bypass": 0})
+    stats[field] += 1
+
+
+def llm_cache_key_for(tenant: Optional[dict], messages: list[dict], model: str) -> tuple[Optional[str], int]:
+    """Devuelve (clave, ttl) si el tenant tiene cache activo y la petición es cacheable."""
+    if not tenant:
+        return None, 0
+    settings = tenant.get("settings") or {}
+    if not as_bool(str(settings.get("llm_cache_enabled", "")), False):
+        return None, 0
+    slug = tenant.get("slug") or "public"
+    prior_turns = sum(1 for m in messages[:-1] if m.get("role") in ("user", "assistant"))
+    if prior_turns > LLM_CACHE_MAX_PRIOR_TURNS:
+        _llm_cache_count(slug, "bypass")
+        return None, 0
+    key = llm_request_key(slug, messages, model)
+    if not key:
+        return None, 0
+    try:
+        ttl = int(settings.get("llm_cache_ttl_seconds") or LLM_CACHE_TTL_SECONDS)
+    except (TypeError, ValueError):
+        ttl = LLM_CACHE_TTL_SECONDS
+    return key, ttl
+
+
+def llm_cache_get(key: str) -> Optional[str]:
+    slug = key.split("|", 1)[0]
+    entry = LLM_CACHE.get(key)
+    if entry is None or entry[0] < time.time():
+        if entry is not None:
+            LLM_CACHE.pop(key, None)
+        _llm_cache_count(slug, "misses")
+        return None
+    LLM_CACHE.move_to_end(key)
+    _llm_cache_count(slug, "hits")
+    return entry[1]
+
+
+def llm_cache_put(key: str, answer: str, ttl: int) -> None:
+    if not answer or ttl <= 0:
+        return
+    LLM_CACHE[key] = (time.time() + ttl, answer)
+    LLM_CACHE.move_to_end(key)
+    while len(LLM_CACHE) > LLM_CACHE_MAX_ENTRIES:
+        LLM_CACHE.popitem(last=False)
+
+
+def llm_cache_invalidate_tenant(tenant_slug: str) -> None:
+    prefix = f"{tenant_slug}|"
+    for k in [k for k in LLM_CACHE if k.startswith(prefix)]:
+        LLM_CACHE.pop(k, None)
+
+
+def llm_cache_stats() -> dict:
+    hits = sum(s["hits"] for s in LLM_CACHE_STATS.values())
+    misses = sum(s["misses"] for s in LLM_CACHE_STATS.values())
+    return {
+        "entries": len(LLM_CACHE),
+        "max_entries": LLM_CACHE_MAX_ENTRIES,
+        "hits": hits,
+        "misses": misses,
+        "hit_rate": round(hits / (hits + misses), 4) if (hits + misses) else 0.0,
+        "by_tenant": LLM_CACHE_STATS,
+    }
+
+
+# ── Single-flight de completions ───────────────────────────────────────
+# Peticiones idénticas concurrentes (mismo tenant, contexto y pregunta) comparten
+# una sola llamada upstream; los waiters en streaming reciben los mismos deltas.
+LLM_INFLIGHT: Dict[str, asyncio.Future] = {}
+LLM_STREAM_FLIGHTS: Dict[str, "LLMStreamFlight"] = {}
+LLM_SINGLEFLIGHT_STATS: Dict[str, int] = {"leaders": 0, "followers": 0}
+
+
+class LLMStreamFlight:
+    """Stream upstream compartido: guarda los fragmentos y despierta a los suscriptores."""
+
+    def __init__(self, key: str):
+        self.key = key
+        self.parts: list[str] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self.task: Optional[asyncio.Task] = None
+        self._changed = asyncio.Event()
+
+    def _notify(self) -> None:
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def push(self, piece: str) -> None:
+        self.parts.append(piece)
+        self._notify()
+
+    def finish(self, error: Optional[BaseException] = None) -> None:
+        self.done = True
+        self.error = error
+        self._notify()
+
+    async def follow(self):
+        i = 0
+        while True:
+            while i < len(self.parts):
+                yield self.parts[i]
+                i += 1
+            if self.done:
+                if self.error:
+                    raise self.error
+                return
+            await self._changed.wait()
+
+
+def _consume_exception(fut: asyncio.Future) -> None:
+    # Si todos los solicitantes se cancelaron nadie lee el error del líder:
+    # se consume aquí para evitar "Future exception was never retrieved".
+    if not fut.cancelled():
+        fut.exception()
+
+
+def llm_singleflight_stats() -> dict:
+    return {
+        **LLM_SINGLEFLIGHT_STATS,
+        "inflight": len(LLM_INFLIGHT),
+        "inflight_streams": len(LLM_STREAM_FLIGHTS),
     }
 
-# ── Endpoints utilitarios ──────────────────────────────────────────────
-@app.get("/health")
-async def health():
-    return {"ok": True, "mode": "mock" if USE_MOCK else "real"}
 
-# DB healthcheck (admin-only)
-@app.get("/db/health", dependencies=[Depends(require_admin)])
-async def db_health():
-    if not db_engine:
-        return {"ok": False, "configured": False, "message": "DATABASE_URL no configurado o DB no inicializada"}
+# ── Control de admisión de completions (concurrencia + fair queuing) ───
+# Tope global y por tenant de completions simultáneas. Cuando no hay cupo, las
+# peticiones esperan en colas por tenant atendidas por weighted fair queuing
+# (peso según el plan del tenant). Si la espera supera LLM_MAX_QUEUE_WAIT_MS o la
+# cola está llena se lanza LLMOverloadedError: la web responde 429 y los canales
+# de mensajería responden con un mensaje degradado.
+LLM_MAX_CONCURRENCY = env_int("LLM_MAX_CONCURRENCY", 32)
+LLM_TENANT_MAX_CONCURRENCY = env_int("LLM_TENANT_MAX_CONCURRENCY", 8)
+LLM_MAX_QUEUE = env_int("LLM_MAX_QUEUE", 200)
+LLM_MAX_QUEUE_WAIT_SECONDS = env_int("LLM_MAX_QUEUE_WAIT_MS", 8000) / 1000.0
+LLM_PLAN_WEIGHTS: Dict[str, int] = {
+    "starter": 1,
+    "addon-whatsapp": 2,
+    "addon-ecommerce": 2,
+    "meta": 2,
+    "pro": 3,
+    "enterprise": 4,
+}
+LLM_DEGRADED_REPLY = "Estamos recibiendo muchos mensajes en este momento. Te respondemos en breve 🙏"
+
+
+class LLMOverloadedError(Exception):
+    def __init__(self, retry_after: int):
+        super().__init__("LLM saturado")
+        self.retry_after = retry_after
+
+
+class LLMAdmission:
+    def __init__(self, max_concurrency: int, max_queue: int, max_wait: float):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.active = 0
+        self.active_by_tenant: Dict[str, int] = {}
+        self.queues: Dict[str, deque] = {}  # tenant -> deque[[tag, future, cap]]
+        self.last_tag: Dict[str, float] = {}
+        self.vtime = 0.0
+        self.queued = 0
+        self.counters = {"admitted": 0, "queued": 0, "rejected": 0, "timeouts": 0}
+        self.waits: deque = deque(maxlen=1000)
+
+    def retry_after(self) -> int:
+        return max(1, int(self.max_wait + 0.999))
+
+    def overloaded(self) -> bool:
+        return self.queued >= self.max_queue
+
+    def _grant(self, slug: str) -> None:
+        self.active += 1
+        self.active_by_tenant[slug] = self.active_by_tenant.get(slug, 0) + 1
+        self.counters["admitted"] += 1
+
+    def _dispatch(self) -> None:
+        while self.active < self.max_concurrency and self.queued:
+            best = None
+            for slug, q in self.queues.items():
+                if q and self.active_by_tenant.get(slug, 0) < q[0][2]:
+                    if best is None or q[0][0] < self.queues[best][0][0]:
+                        best = slug
+            if best is None:
+                return
+            tag, fut, _cap = self.queues[best].popleft()
+            if not self.queues[best]:
+                del self.queues[best]
+            self.queued -= 1
+            self.vtime = max(self.vtime, tag)
+            self._grant(best)
+            fut.set_result(True)
+
+    def _remove(self, slug: str, entry: list) -> None:
+        q = self.queues.get(slug)
+        if q and entry in q:
+            q.remove(entry)
+            self.queued -= 1
+            if not q:
+                del self.queues[slug]
+
+    async def acquire(self, slug: str, weight: float, cap: int) -> None:
+        if (self.active < self.max_concurrency
+                and self.active_by_tenant.get(slug, 0) < cap
+                and not self.queues.get(slug)):
+            self._grant(slug)
+            self.waits.append(0.0)
+            return
+        if self.queued >= self.max_queue:
+            self.counters["rejected"] += 1
+            raise LLMOverloadedError(self.retry_after())
+
+        tag = max(self.vtime, self.last_tag.get(slug, 0.0)) + 1.0 / max(weight, 0.1)
+        self.last_tag[slug] = tag
+        fut = asyncio.get_running_loop().create_future()
+        entry = [tag, fut, cap]
+        self.queues.setdefault(slug, deque()).append(entry)
+        self.queued += 1
+        self.counters["queued"] += 1
+        t0 = time.monotonic()
+        try:
+            await asyncio.wait_for(asyncio.shield(fut), timeout=self.max_wait)
+        except asyncio.TimeoutError:
+            if not fut.done():
+                self._remove(slug, entry)
+                fut.cancel()
+                self.counters["timeouts"] += 1
+                raise LLMOverloadedError(self.retry_after())
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self.release(slug)
+            else:
+                self._remove(slug, entry)
+                fut.cancel()
+            raise
+        self.waits.append(time.monotonic() - t0)
+
+    def release(self, slug: str) -> None:
+        self.active = max(0, self.active - 1)
+        n = self.active_by_tenant.get(slug, 0) - 1
+        if n > 0:
+            self.active_by_tenant[slug] = n
+        else:
+            self.active_by_tenant.pop(slug, None)
+        self._dispatch()
+
+    def stats(self) -> dict:
+        waits = sorted(self.waits)
+        def pct(p: float) -> float:
+            return round(waits[min(len(waits) - 1, int(p * len(waits)))] * 1000, 1) if waits else 0.0
+        return {
+            **self.counters,
+            "active": self.active,
+            "max_concurrency": self.max_concurrency,
+            "queue_depth": self.queued,
+            "queue_by_tenant": {k: len(v) for k, v in self.queues.items()},
+            "active_by_tenant": dict(self.active_by_tenant),
+            "wait_ms_p50": pct(0.50),
+            "wait_ms_p95": pct(0.95),
+            "wait_ms_max": round(waits[-1] * 1000, 1) if waits else 0.0,
+        }
+
+
+LLM_ADMISSION = LLMAdmission(LLM_MAX_CONCURRENCY, LLM_MAX_QUEUE, LLM_MAX_QUEUE_WAIT_SECONDS)
+
+
+def llm_admission_params(tenant: Optional[dict]) -> tuple[str, float, int]:
+    """(slug, peso, tope por tenant) a partir de settings.plan / llm_weight / llm_max_concurrency."""
+    s = (tenant or {}).get("settings") or {}
+    slug = (tenant or {}).get("slug") or "public"
+    try:
+        weight = float(s.get("llm_weight") or LLM_PLAN_WEIGHTS.get(str(s.get("plan") or "").lower(), 1))
+    except (TypeError, ValueError):
+        weight = 1.0
+    try:
+        cap = int(s.get("llm_max_concurrency") or LLM_TENANT_MAX_CONCURRENCY)
+    except (TypeError, ValueError):
+        cap = LLM_TENANT_MAX_CONCURRENCY
+    return slug, weight, max(1, cap)
+
+
+@asynccontextmanager
+async def llm_slot(tenant: Optional[dict]):
+    slug, weight, cap = llm_admission_params(tenant)
+    await LLM_ADMISSION.acquire(slug, weight, cap)
+    try:
+        yield
+    finally:
+        LLM_ADMISSION.release(slug)
+
+
+def llm_degraded_reply(tenant: Optional[dict]) -> str:
+    return ((tenant or {}).get("settings") or {}).get("busy_message") or LLM_DEGRADED_REPLY
+
+
+# ── Ruteo de modelo por petición ───────────────────────────────────────
+# Elige modelo, max_tokens y temperature según canal, intención detectada y
+# overrides del tenant en settings.llm_routing:
+#   {"model": "...", "channels": {"instagram_comment": {...}}, "intents": {"quote": {...}}}
+# Precedencia: canal < intención < tenant general < tenant por canal < tenant por intención.
+# None = no se envía el parámetro (default del proveedor). Solo los canales de
+# respuesta corta llevan tope de tokens; web y DMs quedan sin tope salvo override.
+LLM_FAST_MODEL = os.getenv("LLM_FAST_MODEL", "").strip() or OPENAI_MODEL
+LLM_DETAIL_MODEL = os.getenv("LLM_DETAIL_MODEL", "").strip() or OPENAI_MODEL
+
+LLM_CHANNEL_ROUTES: Dict[str, dict] = {
+    "facebook_comment": {"model": LLM_FAST_MODEL, "max_tokens": 120},
+    "instagram_comment": {"model": LLM_FAST_MODEL, "max_tokens": 120},
+    "summary": {"model": LLM_FAST_MODEL, "max_tokens": 250, "temperature": 0.2},
+}
+LLM_INTENT_ROUTES: Dict[str, dict] = {
+    "greeting": {"model": LLM_FAST_MODEL},
+    "quote": {"model": LLM_DETAIL_MODEL},
+    "purchase": {"model": LLM_DETAIL_MODEL},
+}
+LLM_SHORT_CHANNELS = {"facebook_comment", "instagram_comment", "summary"}
+LLM_ROUTE_STATS: Dict[str, int] = {}  # "canal|intención|modelo" -> peticiones
+
+_GREETING_WORDS = {"hola", "buenas", "buen", "buenos", "dias", "días", "tardes", "noches",
+                   "hey", "hi", "gracias", "ok", "vale", "saludos", "que", "tal", "qué"}
+
+
+def detect_intent(text_in: str) -> str:
+    if wants_purchase(text_in):
+        return "purchase"
+    if wants_quote(text_in):
+        return "quote"
+    if wants_booking(text_in):
+        return "booking"
+    words = normalize_question(text_in).split()
+    if words and len(words) <= 4 and all(w in _GREETING_WORDS for w in words):
+        return "greeting"
+    return "general"
+
+
+def route_llm_request(channel: str, messages: list[dict], tenant: Optional[dict] = None) -> dict:
+    last_user = next((m.get("content") or "" for m in reversed(messages) if m.get("role") == "user"), "")
+    # En canales de respuesta corta la intención no cambia el modelo
+    intent = "general" if channel in LLM_SHORT_CHANNELS else detect_intent(last_user)
+    route = {"model": OPENAI_MODEL, "max_tokens": None, "temperature": None}
+    route.update(LLM_CHANNEL_ROUTES.get(channel, {}))
+    route.update(LLM_INTENT_ROUTES.get(intent, {}))
+
+    cfg = ((tenant or {}).get("settings") or {}).get("llm_routing") or {}
+    if isinstance(cfg, dict):
+        route.update({k: v for k, v in cfg.items() if k in ("model", "max_tokens", "temperature") and v is not None})
+        for section, name in (("channels", channel), ("intents", intent)):
+            override = (cfg.get(section) or {}).get(name)
+            if isinstance(override, dict):
+                route.update({k: v for k, v in override.items() if k in ("model", "max_tokens", "temperature") and v is not None})
+
+    for k, cast in (("max_tokens", int), ("temperature", float)):
+        if route[k] is not None:
+            try:
+                route[k] = cast(route[k])
+            except (TypeError, ValueError):
+                route[k] = None
+    if route["max_tokens"] is not None and route["max_tokens"] <= 0:
+        route["max_tokens"] = None
+    route["intent"] = intent
+    stat_key = f"{channel}|{intent}|{route['model']}"
+    LLM_ROUTE_STATS[stat_key] = LLM_ROUTE_STATS.get(stat_key, 0) + 1
+    return route
+
+
+def llm_sampling_kwargs(route: dict) -> dict:
+    return {k: route[k] for k in ("max_tokens", "temperature") if route.get(k) is not None}
+
+
+def route_signature(route: dict) -> str:
+    return f"{route['model']}/{route['max_tokens']}/{route['temperature']}"
+
+
+async def _llm_complete_once(messages: list[dict], channel: str, tenant: Optional[dict], route: dict) -> str:
+    async with llm_slot(tenant):
+        resp = await aclient.with_options(timeout=llm_timeout_for(channel)).chat.completions.create(
+            model=route["model"],
+            messages=messages,
+            **llm_sampling_kwargs(route),
+        )
+    return resp.choices[0].message.content or ""
+
+
+async def _llm_stream_once(messages: list[dict], channel: str, tenant: Optional[dict], route: dict):
+    """Abre el stream (1 reintento) y cierra la conexión upstream al terminar o cancelar."""
+    async with llm_slot(tenant):
+        client_rt = aclient.with_options(timeout=llm_timeout_for(channel))
+        stream = None
+        for attempt in range(2):
+            try:
+                stream = await client_rt.chat.completions.create(
+                    model=route["model"],
+                    messages=messages,
+                    stream=True,
+                    **llm_sampling_kwargs(route),
+                )
+                break
+            except Exception as e:
+                if attempt == 1:
+                    raise
+                log.warning(f"[llm] reintento de stream ({channel}) tras error: {e}")
+                await asyncio.sleep(OPENAI_RETRY_DELAY)
+
+        if stream is None:
+            raise RuntimeError("No se pudo iniciar stream")
+
+        try:
+            async for chunk in stream:
+                if not chunk.choices:
+                    continue
+                piece = getattr(chunk.choices[0].delta, "content", None)
+                if piece:
+                    yield piece
+        finally:
+            await stream.close()
+
+
+# ── Hedging / fallback de modelo ───────────────────────────────────────
+# Si el primer token (o la respuesta, en no-streaming) no llega en
+# LLM_HEDGE_AFTER_MS[canal], se lanza una segunda petición (al modelo
+# LLM_HEDGE_MODEL si está definido); gana la primera que responda y la otra se
+# cancela. Si la primaria falla antes del primer token se usa la secundaria.
+LLM_HEDGE_ENABLED = as_bool(os.getenv("LLM_HEDGE_ENABLED"), False)
+LLM_HEDGE_MODEL = os.getenv("LLM_HEDGE_MODEL", "").strip()
+LLM_HEDGE_AFTER_MS: Dict[str, int] = {
+    "web": env_int("LLM_HEDGE_AFTER_MS_WEB", 4000),
+    "web_stream": env_int("LLM_HEDGE_AFTER_MS_WEB_STREAM", 2500),
+    "whatsapp": env_int("LLM_HEDGE_AFTER_MS_WHATSAPP", 4000),
+    "facebook_dm": env_int("LLM_HEDGE_AFTER_MS_META_DM", 4000),
+    "instagram_dm": env_int("LLM_HEDGE_AFTER_MS_META_DM", 4000),
+    "facebook_comment": env_int("LLM_HEDGE_AFTER_MS_META_COMMENT", 3000),
+    "instagram_comment": env_int("LLM_HEDGE_AFTER_MS_META_COMMENT", 3000),
+    "summary": 0,  # en background: sin hedge
+}
+LLM_HEDGE_STATS: Dict[str, Dict[str, int]] = {}
+
+
+def _hedge_count(channel: str, field: str) -> None:
+    stats = LLM_HEDGE_STATS.setdefault(channel, {
+        "requests": 0, "hedged": 0, "primary_wins": 0, "hedge_wins": 0, "fallback_on_error": 0,
+    })
+    stats[field] += 1
+
+
+def llm_hedge_stats() -> dict:
+    out = {}
+    for ch, st in LLM_HEDGE_STATS.items():
+        out[ch] = {**st, "hedge_rate": round(st["hedged"] / st["requests"], 4) if st["requests"] else 0.0}
+    return {"enabled": LLM_HEDGE_ENABLED, "fallback_model": LLM_HEDGE_MODEL or OPENAI_MODEL, "by_channel": out}
+
+
+def _hedge_delay(channel: str) -> float:
+    if not LLM_HEDGE_ENABLED:
+        return 0.0
+    return max(0, LLM_HEDGE_AFTER_MS.get(channel, 0)) / 1000.0
+
+
+async def _cancel_quietly(task: Optional[asyncio.Future]) -> None:
+    """Cancela la tarea perdedora sin tragarse una cancelación dirigida a quien llama."""
+    if task is None:
+        return
+    if task.done():
+        if not task.cancelled():
+            task.exception()  # ya se decidió el ganador; el error del perdedor no importa
+        return
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        current = asyncio.current_task()
+        if not task.cancelled() or (current is not None and current.cancelling()):
+            raise
+    except BaseException:
+        # Incluye StopAsyncIteration de un stream vacío
+        pass
+
+
+def _hedge_route(route: dict) -> dict:
+    return {**route, "model": LLM_HEDGE_MODEL or route["model"]}
+
+
+async def _llm_complete_upstream(messages: list[dict], channel: str, tenant: Optional[dict], route: dict) -> str:
+    delay = _hedge_delay(channel)
+    if not delay:
+        return await _llm_complete_once(messages, channel, tenant, route)
+    _hedge_count(channel, "requests")
+    primary = asyncio.ensure_future(_llm_complete_once(messages, channel, tenant, route))
+    done, _ = await asyncio.wait({primary}, timeout=delay)
+    if done and not primary.exception():
+        _hedge_count(channel, "primary_wins")
+        return primary.result()
+    if done:
+        _hedge_count(channel, "fallback_on_error")
+        log.warning(f"[llm] primaria falló ({channel}), usando fallback: {primary.exception()}")
+    _hedge_count(channel, "hedged")
+    secondary = asyncio.ensure_future(_llm_complete_once(messages, channel, tenant, _hedge_route(route)))
+    pending = {primary, secondary} - done
+    try:
+        while pending:
+            finished, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in finished:
+                if task.exception() is None:
+                    _hedge_count(channel, "primary_wins" if task is primary else "hedge_wins")
+                    return task.result()
+        # Ambas fallaron: propagar el error de la secundaria
+        return secondary.result()
+    finally:
+        for task in (primary, secondary):
+            await _cancel_quietly(task)
+
+
+async def _llm_stream_upstream(messages: list[dict], channel: str, tenant: Optional[dict], route: dict):
+    delay = _hedge_delay(channel)
+    primary = _llm_stream_once(messages, channel, tenant, route)
+    if not delay:
+        try:
+            async for piece in primary:
+                yield piece
+        finally:
+            await primary.aclose()
+        return
+
+    _hedge_count(channel, "requests")
+    secondary = None
+    first_p = asyncio.ensure_future(primary.__anext__())
+    first_s: Optional[asyncio.Future] = None
+    winner = None
+    first_piece = None
+    try:
+        done, _ = await asyncio.wait({first_p}, timeout=delay)
+        if done and isinstance(first_p.exception(), StopAsyncIteration):
+            # Stream vacío: respuesta completa y vacía, no es un error que amerite hedge
+            _hedge_count(channel, "primary_wins")
+            return
+        if done and first_p.exception() is None:
+            winner, first_piece = primary, first_p.result()
+            _hedge_count(channel, "primary_wins")
+        else:
+            if done:
+                _hedge_count(channel, "fallback_on_error")
+                log.warning(f"[llm] stream primario falló ({channel}), usando fallback: {first_p.exception()}")
+            _hedge_count(channel, "hedged")
+            secondary = _llm_stream_once(messages, channel, tenant, _hedge_route(route))
+            first_s = asyncio.ensure_future(secondary.__anext__())
+            pending = {first_p, first_s} - done
+            while pending and winner is None:
+                finished, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in (first_p, first_s):
+                    if task in finished and isinstance(task.exception(), StopAsyncIteration):
+                        _hedge_count(channel, "primary_wins" if task is first_p else "hedge_wins")
+                        return  # respuesta vacía; el finally cancela la otra
+                    if task in finished and task.exception() is None:
+                        winner = primary if task is first_p else secondary
+                        first_piece = task.result()
+                        _hedge_count(channel, "primary_wins" if task is first_p else "hedge_wins")
+                        break
+            if winner is None:
+                first_s.result()  # ambas fallaron: propaga el error
+
+        loser = secondary if winner is primary else primary
+        await _cancel_quietly(first_s if winner is primary else first_p)
+        if loser is not None:
+            await loser.aclose()
+
+        yield first_piece
+        async for piece in winner:
+            yield piece
+    except StopAsyncIteration:
+        return
+    finally:
+        await _cancel_quietly(first_p)
+        await _cancel_quietly(first_s)
+        await primary.aclose()
+        if secondary is not None:
+            await secondary.aclose()
+
+
+async def _run_stream_flight(flight: LLMStreamFlight, messages: list[dict], channel: str,
+                             tenant: Optional[dict], route: dict) -> None:
+    upstream = _llm_stream_upstream(messages, channel, tenant, route)
     try:
-        async with db_engine.connect() as conn:
-            # ping
-            pong = (await conn.execute(text("SELECT 1"))).scalar_one()
-            # check tables existence
-            row = (await conn.execute(text(
-                "SELECT "
-                "  to_regclass('public.tenants') IS NOT NULL AS tenants, "
-                "  to_regclass('public.leads')   IS NOT NULL AS leads, "
-                "  to_regclass('public.events')  IS NOT NULL AS events"
-            ))).first()
-        return {
-            "ok": True,
-            "configured": True,
-            "ping": (pong == 1),
-            "tables": {"tenants": bool(row.tenants), "leads": bool(row.leads), "events": bool(row.events)}
-        }
+        async for piece in upstream:
+            flight.push(piece)
+        flight.finish()
+    except asyncio.CancelledError:
+        flight.finish(RuntimeError("stream cancelado"))
+        raise
     except Exception as e:
-        log.error(f"DB healthcheck failed: {e}")
-        return {"ok": False, "configured": True, "error": str(e)}
+        flight.finish(e)
+    finally:
+        await upstream.aclose()
+        if LLM_STREAM_FLIGHTS.get(flight.key) is flight:
+            LLM_STREAM_FLIGHTS.pop(flight.key, None)
 
-@app.post("/v1/tenants", dependencies=[Depends(require_admin)])
-async def upsert_tenant(body: TenantIn):
-    if not db_engine:
-        raise HTTPException(503, "Database not configured")
-    async with db_engine.begin() as conn:
-        row = (await conn.execute(
-            text("""
-                INSERT INTO tenants (slug, name, whatsapp, settings)
-                VALUES (:slug, :name, :whatsapp, CAST(:settings AS JSONB))
-                ON CONFLICT (slug) DO UPDATE
-                  SET name = EXCLUDED.name,
-                      whatsapp = EXCLUDED.whatsapp,
-                      settings = EXCLUDED.settings,
-                      updated_at = NOW()
-                RETURNING id, slug, name, whatsapp, settings
-            """),
-            {"slug": body.slug, "name": body.name, "whatsapp": body.whatsapp, "settings": json.dumps(body.settings)}
-        )).first()
-    return dict(row._mapping)
 
-@app.get("/v1/widget/bootstrap")
-async def widget_bootstrap(tenant: str):
-    if tenant and not valid_slug(tenant):
-        raise HTTPException(400, "Invalid tenant")
-    if not db_engine:
-        # Modo sin DB: entregar algo básico
-        return {
-            "tenant": {"slug": tenant, "name": tenant or "zIA", "whatsapp": None, "settings": {}},
-            "ui": {"suggestions": ["Probar funciones","Integraciones","Contactar por WhatsApp"]}
-        }
-    async with db_engine.connect() as conn:
-        t = (await conn.execute(
-            text("SELECT id, slug, name, whatsapp, settings FROM tenants WHERE slug=:slug"),
-            {"slug": tenant}
-        )).first()
-    if not t:
-        raise HTTPException(404, f"Tenant '{tenant}' no encontrado")
-    tenant_obj = dict(t._mapping)
-    # Pre-carga de catálogo para que el frontend pueda mostrar chips/estado si quiere
-    try:
-        items = await fetch_catalog_for_tenant(tenant_obj)
-        has_catalog = bool(items)
-    except Exception:
-        has_catalog = False
-    settings = tenant_obj.get("settings") or {}
-    widget_chips = settings.get("widget_chips")
-    if not widget_chips:
-        widget_chips = []
-        if has_catalog:
-            widget_chips.append("Ver catálogo")
-        widget_chips.append("Solicitar cotización")
-        if tenant_obj.get("whatsapp"):
-            widget_chips.append("Contactar por WhatsApp")
-        if not widget_chips:
-            widget_chips = ["Solicitar cotización", "Más información"]
-    return {
-        "tenant": tenant_obj,
-        "ui": {
-            "suggestions": widget_chips
-        },
-        "catalog": {"present": has_catalog}
-    }
+async def llm_complete(messages: list[dict], channel: str = "web", tenant: Optional[dict] = None) -> str:
+    """Completion no-streaming. Lanza OpenAIError si falla; cada canal decide su fallback."""
+    if USE_MOCK:
+        last = next((m for m in reversed(messages) if m["role"] == "user"), {"content": ""})
+        return f"(mock) Recibí: {last['content']}"
+    route = route_llm_request(channel, messages, tenant)
+    cache_key, cache_ttl = llm_cache_key_for(tenant, messages, route_signature(route))
+    if cache_key:
+        cached = llm_cache_get(cache_key)
+        if cached is not None:
+            return cached
+
+    flight_key = llm_request_key((tenant or {}).get("slug") or "public", messages, route_signature(route))
+    if not flight_key:
+        return await _llm_complete_upstream(messages, channel, tenant, route)
+    flight_key = f"{channel}|{flight_key}"
+
+    fut = LLM_INFLIGHT.get(flight_key)
+    if fut is None:
+        LLM_SINGLEFLIGHT_STATS["leaders"] += 1
+        # La llamada corre en su propia task: si el primer solicitante se cancela, los demás siguen
+        fut = asyncio.ensure_future(_llm_complete_upstream(messages, channel, tenant, route))
+        LLM_INFLIGHT[flight_key] = fut
+        fut.add_done_callback(lambda f, k=flight_key: LLM_INFLIGHT.pop(k, None) if LLM_INFLIGHT.get(k) is f else None)
+        fut.add_done_callback(_consume_exception)
+    else:
+        LLM_SINGLEFLIGHT_STATS["followers"] += 1
 
-@app.options("/v1/chat/stream")
-async def options_stream():
-    return Response(status_code=204)
+    answer = await asyncio.shield(fut)
+    if cache_key:
+        llm_cache_put(cache_key, answer, cache_ttl)
+    return answer
 
-@app.options("/v1/widget/bootstrap")
-async def options_bootstrap():
-    return Response(status_code=204)
 
-@app.options("/v1/events")
-async def options_events():
-    return Response(status_code=204)
+async def llm_stream(messages: list[dict], channel: str = "web_stream", tenant: Optional[dict] = None):
+    """
+    Genera los fragmentos de texto de una completion en streaming.
+    Si ya hay un stream idéntico en curso se suscribe a él; el stream upstream
+    se cancela cuando se va el último suscriptor (desconexión del cliente).
+    """
+    route = route_llm_request(channel, messages, tenant)
+    cache_key, cache_ttl = llm_cache_key_for(tenant, messages, route_signature(route))
+    if cache_key:
+        cached = llm_cache_get(cache_key)
+        if cached is not None:
+            for i in range(0, len(cached), LLM_CACHE_REPLAY_CHUNK):
+                yield cached[i:i + LLM_CACHE_REPLAY_CHUNK]
+            return
+
+    flight_key = llm_request_key((tenant or {}).get("slug") or "public", messages, route_signature(route))
+    if not flight_key:
+        upstream = _llm_stream_upstream(messages, channel, tenant, route)
+        try:
+            async for piece in upstream:
+                yield piece
+        finally:
+            await upstream.aclose()
+        return
+    flight_key = f"{channel}|{flight_key}"
+
+    flight = LLM_STREAM_FLIGHTS.get(flight_key)
+    if flight is None:
+        LLM_SINGLEFLIGHT_STATS["leaders"] += 1
+        flight = LLMStreamFlight(flight_key)
+        LLM_STREAM_FLIGHTS[flight_key] = flight
+        flight.task = asyncio.create_task(_run_stream_flight(flight, messages, channel, tenant, route))
+        flight.task.add_done_callback(_consume_exception)
+    else:
+        LLM_SINGLEFLIGHT_STATS["followers"] += 1
+
+    parts: list[str] = []
+    flight.subscribers += 1
+    try:
+        async for piece in flight.follow():
+            parts.append(piece)
+            yield piece
+    finally:
+        flight.subscribers -= 1
+        if flight.subscribers <= 0 and not flight.done and flight.task:
+            # Se saca ya del mapa: una petición idéntica que llegue mientras el upstream
+            # se cierra arranca un stream nuevo en vez de suscribirse al que muere
+            if LLM_STREAM_FLIGHTS.get(flight_key) is flight:
+                LLM_STREAM_FLIGHTS.pop(flight_key, None)
+            flight.task.cancel()
+    # Solo se cachea si el stream terminó completo (no en desconexión)
+    if cache_key:
+        llm_cache_put(cache_key, "".join(parts), cache_ttl)
+
 
 # ── Chat sin streaming ─────────────────────────────────────────────────
-def generate_answer(messages: list[dict]) -> str:
-    if USE_MOCK:
-        last = next((m for m in reversed(messages) if m["role"] == "user"), {"content": ""})
-        return f"(mock) Recibí: {last['content']}"
+async def generate_answer(messages: list[dict], channel: str = "web", tenant: Optional[dict] = None) -> str:
     try:
-        resp = client.chat.completions.create(model=OPENAI_MODEL, messages=messages)
-        return resp.choices[0].message.content
+        return await llm_complete(messages, channel=channel, tenant=tenant)
+    except LLMOverloadedError as e:
+        if channel == "web":
+            raise HTTPException(status_code=429, detail="Too many requests", headers={"Retry-After": str(e.retry_after)})
+        return llm_degraded_reply(tenant)
     except OpenAIError as e:
         log.error(f"OpenAI error: {e}")
         raise HTTPException(status_code=502, detail="AI service error")
 
 @app.post("/v1/chat", response_model=ChatOut)
-async def chat(input: ChatIn, request: Request, tenant: str = Query(default="")):
-    key = input.sessionId or get_client_ip(request)
-    if is_rate_limited(key):
-        raise HTTPException(status_code=429, detail="Too many requests")
+async def chat(input: ChatIn, request: Request, response: Response, tenant: str = Query(default="")):
+    rl_key = input.sessionId or get_client_ip(request)
+    enforce_rate_limit("chat", rl_key, response)
+    t = await fetch_tenant(tenant)
+    enforce_tenant_rate_limit("chat", rl_key, t, response)
+    await hydrate_session(input.sessionId)
     sid = ensure_session(input.sessionId)
     add_message(sid, "user", input.message)
-    t = await fetch_tenant(tenant)
-    asyncio.create_task(store_event(tenant or "public", sid, "msg_in", {"text": (input.message or "")[:MAX_TEXT_LENGTH]}))
-    asyncio.create_task(log_message(tenant or "public", sid, "web", "in", input.message or "", author="user"))
+    await store_event(tenant or "public", sid, "msg_in", {"text": (input.message or "")[:MAX_TEXT_LENGTH]})
+    await log_message(tenant or "public", sid, "web", "in", input.message or "", author="user")
     if t and not tenant_bot_enabled(t):
         off_msg = ((t.get("settings") or {}).get("bot_off_message") or "El asistente está en pausa. Escríbenos por WhatsApp o email y te respondemos.")
         add_message(sid, "assistant", off_msg)
-        asyncio.create_task(log_message(tenant or "public", sid, "web", "out", off_msg, author="assistant"))
+        await log_message(tenant or "public", sid, "web", "out", off_msg, author="assistant")
         return ChatOut(sessionId=sid, answer=off_msg)
     catalog_items = await fetch_catalog_for_tenant(t)
-    catalog_summary = summarize_catalog_for_prompt(catalog_items)
-    system_prompt = build_system_for_tenant(t)
-    if catalog_summary:
-        system_prompt = f"{system_prompt}\n\n{catalog_summary}"
-    messages = build_messages_with_history(sid, system_prompt)
-    answer = generate_answer(messages)
+    system_prompt = build_system_for_tenant(t, include_faq=False)
+    messages = await build_messages_with_history(
+        sid, system_prompt, tenant=t, catalog_items=catalog_items, faq=tenant_faq_entries(t)
+    )
+    answer = await generate_answer(messages, channel="web", tenant=t)
     add_message(sid, "assistant", answer)
-    asyncio.create_task(store_event(tenant or "public", sid, "msg_out", {"text": answer[:MAX_TEXT_LENGTH]}))
-    asyncio.create_task(log_message(tenant or "public", sid, "web", "out", answer, author="assistant"))
+    await store_event(tenant or "public", sid, "msg_out", {"text": answer[:MAX_TEXT_LENGTH]})
+    await log_message(tenant or "public", sid, "web", "out", answer, author="assistant")
     return ChatOut(sessionId=sid, answer=answer)
 
 # ── Eventos (analytics) ────────────────────────────────────────────────
 @app.post("/v1/events")
-async def track_event(body: EventIn, request: Request, tenant: str = Query(default="")):
+async def track_event(body: EventIn, request: Request, response: Response, tenant: str = Query(default="")):
     if tenant and not valid_slug(tenant):
         raise HTTPException(400, "Invalid tenant")
+    rl_key = body.sessionId or get_client_ip(request)
+    enforce_rate_limit("events", rl_key, response)
+    # Los eventos no necesitan el tenant: su límite propio aplica si ya está en caché
+    enforce_tenant_rate_limit("events", rl_key, TENANT_CACHE.peek(tenant) if tenant else None, response)
     etype = (body.type or "").strip().lower()
     if not etype:
         raise HTTPException(400, "Missing event type")
@@ -2499,13 +5721,94 @@ async def track_event(body: EventIn, request: Request, tenant: str = Query(defau
     if not db_engine:
         log.info(f"[event][no-db] tenant={tenant} sid={sid} type={etype} payload={body.payload}")
         return {"ok": True, "stored": False}
-    async with db_engine.begin() as conn:
-        await conn.execute(
-            text("""INSERT INTO events (tenant_slug, session_id, type, payload)
-                    VALUES (:tenant, :sid, :type, CAST(:payload AS JSONB))"""),
-            {"tenant": tenant or "public", "sid": sid, "type": etype, "payload": json.dumps(body.payload or {})}
-        )
-    return {"ok": True, "stored": True}
+    stored = await store_event(tenant or "public", sid, etype, body.payload)
+    return {"ok": True, "stored": stored}
+
+# ── Turnos por conversación (webhooks) ─────────────────────────────────
+# WhatsApp/Messenger/IG entregan cada mensaje en su propia petición; si el
+# usuario manda varios seguidos se procesarían en paralelo (carreras en el flujo
+# y en el orden de MESSAGES, una llamada al LLM por mensaje). Cada sesión tiene
+# un buzón: los turnos se atienden en orden de llegada y, al tomar el turno, se
+# juntan todos los mensajes pendientes en uno solo (una sola respuesta). Con
+# debounce (INBOUND_DEBOUNCE_MS o settings.inbound_debounce_ms) se espera a que
+# la conversación quede en silencio ese tiempo antes de responder. Mientras hay
+# un flujo activo (citas, contacto) no se junta: cada mensaje es su propio paso.
+INBOUND_DEBOUNCE_MS = env_int("INBOUND_DEBOUNCE_MS", 0)
+INBOUND_MAX_BATCH = env_int("INBOUND_MAX_BATCH", 5)
+
+
+class _Mailbox:
+    __slots__ = ("lock", "pending", "users", "last_at")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()     # FIFO: los turnos salen en orden de llegada
+        self.pending: list[list] = []  # [texto, tomado]
+        self.users = 0
+        self.last_at = 0.0
+
+
+class ConversationMailbox:
+    def __init__(self):
+        self.boxes: Dict[str, _Mailbox] = {}
+        self.stats = {"turns": 0, "messages": 0, "merged": 0, "max_batch": 0}
+
+    @asynccontextmanager
+    async def turn(self, key: str, text_in: str, debounce_ms: int = 0, merge=True):
+        """
+        Entra al turno de `key`. Produce la lista de textos a responder juntos, o
+        None si este mensaje ya lo tomó (y responde) el turno de otra petición.
+        `merge` puede ser un callable: se evalúa al tomar el turno.
+        """
+        box = self.boxes.get(key)
+        if box is None:
+            box = self.boxes[key] = _Mailbox()
+        entry = [text_in, False]
+        box.pending.append(entry)
+        box.users += 1
+        box.last_at = time.monotonic()
+        self.stats["messages"] += 1
+        try:
+            async with box.lock:
+                if entry[1]:
+                    self.stats["merged"] += 1
+                    yield None
+                    return
+                while debounce_ms > 0:
+                    wait = box.last_at + debounce_ms / 1000 - time.monotonic()
+                    if wait <= 0:
+                        break
+                    await asyncio.sleep(wait)
+                limit = max(1, INBOUND_MAX_BATCH) if (merge() if callable(merge) else merge) else 1
+                batch, box.pending = box.pending[:limit], box.pending[limit:]
+                for e in batch:
+                    e[1] = True
+                self.stats["turns"] += 1
+                self.stats["max_batch"] = max(self.stats["max_batch"], len(batch))
+                yield [e[0] for e in batch]
+        finally:
+            box.users -= 1
+            if box.users == 0 and self.boxes.get(key) is box:
+                self.boxes.pop(key, None)
+
+    def snapshot(self) -> dict:
+        return {"active": len(self.boxes), **self.stats}
+
+
+INBOUND_MAILBOX = ConversationMailbox()
+
+
+def inbound_debounce_ms(tenant: Optional[dict]) -> int:
+    try:
+        v = int(((tenant or {}).get("settings") or {}).get("inbound_debounce_ms") or 0)
+    except (TypeError, ValueError):
+        v = 0
+    return v if v > 0 else INBOUND_DEBOUNCE_MS
+
+
+def session_in_flow(sid: str) -> bool:
+    flow = (SESSIONS.get(sid) or {}).get("contact_flow")
+    return bool(flow is not None and flow.stage)
+
 
 # ── Meta Webhooks: GET verify + POST events ────────────────────────────
 
@@ -2695,7 +5998,7 @@ async def meta_webhook_events(request: Request, payload: Dict[str, Any] = Body(.
                 log.info(f"[{rid}] DM received - obj={obj}, sender={sender_id}, recipient={recipient_id_event}, page_id={page_id}, ig_user_id={ig_user_id}, business_ids={business_ids}")
 
                 mid = str(msg.get("mid", ""))
-                if meta_message_seen(mid):
+                if await meta_message_seen(mid):
                     log.debug(f"[{rid}] DM dedupe mid={mid}")
                     continue
                 if msg.get("is_echo"):
@@ -2708,61 +6011,32 @@ async def meta_webhook_events(request: Request, payload: Dict[str, Any] = Body(.
 
                 # PROTECCIÓN ANTI-LOOP: Detectar si el mensaje viene de otra cuenta de negocio
                 # Verificar si el sender_id es un IG User ID o Page ID de otro tenant
-                if sender_id and db_engine:
-                    async with db_engine.connect() as conn:
-                        result = await conn.execute(
-                            text("""
-                                SELECT tenant_slug, page_name
-                                FROM facebook_pages
-                                WHERE page_id = :sender_id OR ig_user_id = :sender_id
-                                LIMIT 1
-                            """),
-                            {"sender_id": sender_id}
-                        )
-                        sender_page = result.mappings().first()
-
-                        if sender_page:
-                            log.warning(
-                                f"[{rid}] 🚫 DM LOOP DETECTED: sender={sender_id} pertenece a "
-                                f"{sender_page['page_name']} (tenant={sender_page['tenant_slug']}). "
-                                f"Ignorando para evitar loop infinito."
-                            )
-                            continue
+                sender_page = business_account_for(sender_id)
+                if sender_page:
+                    log.warning(
+                        f"[{rid}] 🚫 DM LOOP DETECTED: sender={sender_id} pertenece a "
+                        f"{sender_page['page_name']} (tenant={sender_page['tenant_slug']}). "
+                        f"Ignorando para evitar loop infinito."
+                    )
+                    continue
                 text_in = (msg.get("text") or "").strip()
                 if not text_in:
                     continue
 
                 # PROTECCIÓN ANTI-LOOP: Detectar patrones de mensajes rápidos (posible loop)
-                session_key = f"{tenant_slug}:{sender_id}"
-                now = time.time()
-
-                if session_key not in RECENT_MESSAGES:
-                    RECENT_MESSAGES[session_key] = []
-
-                # Limpiar mensajes antiguos (más de 30 segundos)
-                RECENT_MESSAGES[session_key] = [
-                    ts for ts in RECENT_MESSAGES[session_key]
-                    if now - ts < 30
-                ]
-
-                # Agregar timestamp actual
-                RECENT_MESSAGES[session_key].append(now)
-
-                # Si hay muchos mensajes en poco tiempo, es un loop
-                if len(RECENT_MESSAGES[session_key]) >= LOOP_DETECTION_THRESHOLD:
+                loop_threshold, loop_window = loop_detection_params(t)
+                burst = LOOP_DETECTOR.hit(f"{tenant_slug}:{sender_id}", loop_threshold, loop_window)
+                if burst:
                     log.error(
-                        f"[{rid}] 🚨 LOOP DETECTION: {len(RECENT_MESSAGES[session_key])} mensajes "
-                        f"en 30 segundos desde sender={sender_id}. IGNORANDO para evitar loop."
+                        f"[{rid}] 🚨 LOOP DETECTION: {burst} mensajes "
+                        f"en {loop_window} segundos desde sender={sender_id}. IGNORANDO para evitar loop."
                     )
-                    # Limpiar el tracking para evitar acumulación
-                    RECENT_MESSAGES[session_key] = []
+                    LOOP_DETECTOR.record_block(tenant_slug)
+                    await store_event(tenant_slug, f"fb:{tenant_slug}:{sender_id}", "dm_loop_blocked", {
+                        "sender": sender_id, "obj": obj, "messages": burst, "window_seconds": loop_window,
+                    })
                     continue
 
-                # Limpiar entradas antiguas del OrderedDict
-                if len(RECENT_MESSAGES) > 1000:
-                    for _ in range(100):
-                        RECENT_MESSAGES.popitem(last=False)
-
                 participant_id = sender_id or recipient_id_event
                 if participant_id in business_ids and recipient_id_event and recipient_id_event not in business_ids:
                     participant_id = recipient_id_event
@@ -2774,172 +6048,184 @@ async def meta_webhook_events(request: Request, payload: Dict[str, Any] = Body(.
                         f"obj={obj} sender={sender_id} recipient={recipient_id_event}"
                     )
                     continue
+                await hydrate_session(f"fb:{tenant_slug}:{participant_id}")
                 sid = ensure_session(f"fb:{tenant_slug}:{participant_id}")
-                add_message(sid, "user", text_in)
-                asyncio.create_task(store_event(tenant_slug, sid, f"{obj}_in", {"from": sender_id, "text": text_in}))
+                await store_event(tenant_slug, sid, f"{obj}_in", {"from": sender_id, "text": text_in})
                 channel_label = "instagram_dm" if obj == "instagram" else "facebook_dm"
-                asyncio.create_task(log_message(tenant_slug, sid, channel_label, "in", text_in, author=sender_id, page_id=page_id))
+                await log_message(tenant_slug, sid, channel_label, "in", text_in, author=sender_id, page_id=page_id)
 
-                # Si la conversación está pausada, no responder automáticamente
-                if is_session_paused(sid):
-                    log.info(f"[{rid}] bot pausado para {sid}, no responde auto")
-                    continue
+                async with INBOUND_MAILBOX.turn(
+                    sid, text_in, inbound_debounce_ms(t), merge=lambda: not session_in_flow(sid)
+                ) as turn_texts:
+                    if turn_texts is None:
+                        log.debug(f"[{rid}] DM {sid}: mensaje agregado al turno en curso")
+                        continue
+                    for piece in turn_texts:
+                        add_message(sid, "user", piece)
+                    text_in = "\n".join(turn_texts)
 
-                if not bot_active:
-                    log.debug(f"[{rid}] bot off, no auto-reply slug={tenant_slug}")
-                    continue
+                    # Si la conversación está pausada, no responder automáticamente
+                    if is_session_paused(sid):
+                        log.info(f"[{rid}] bot pausado para {sid}, no responde auto")
+                        continue
 
-                # ── Flujos completos (mismo comportamiento que WhatsApp) ──────────
-                text_dm = text_in.lower()
-                wa_url = tenant_whatsapp_url(t)
-                answer = None
+                    if not bot_active:
+                        log.debug(f"[{rid}] bot off, no auto-reply slug={tenant_slug}")
+                        continue
 
-                # 1) Fast-path: intención de compra por plan (starter/meta)
-                if any(k in text_dm for k in ["compr", "compra", "pagar", "pago", "checkout", "suscrib"]) and \
-                        ("starter" in text_dm or "meta" in text_dm):
-                    plan = "starter" if "starter" in text_dm else "meta"
-                    try:
-                        prices = _tenant_stripe_prices(t)
-                        if plan not in prices:
-                            prices = await ensure_prices_for_tenant(t)
-                        price_id = prices[plan]
-                        _sess = await _create_checkout_for_any(t, price_id=price_id, qty=1, mode="subscription")
-                        answer = f"Listo ✅ Aquí tienes tu enlace para suscribirte al plan {plan.title()}: {_sess['url']}"
-                        asyncio.create_task(store_event(tenant_slug, sid, "checkout_link_out", {"plan": plan, "url": _sess["url"]}))
-                    except Exception as e:
-                        log.warning(f"[{rid}] meta checkout plan falló: {e}")
-
-                # 2) Flujo de citas (Google Calendar)
-                if answer is None:
-                    answer = await handle_booking_flow_wa(sid, text_in, t, tenant_slug)
-
-                product_image_url: str | None = None
-                carousel_elements: list = []
-
-                # 3) Catálogo + LLM + detalles de producto
-                if answer is None:
-                    catalog_items = await fetch_catalog_for_tenant(t)
-                    catalog_summary = summarize_catalog_for_prompt(catalog_items)
-                    system_prompt = build_system_for_tenant(t, page_settings=page_settings)
-                    if catalog_summary:
-                        system_prompt = f"{system_prompt}\n\n{catalog_summary}"
-                    messages_ctx = build_messages_with_history(sid, system_prompt)
-                    try:
-                        client_rt = client.with_options(timeout=12.0)
-                        resp = client_rt.chat.completions.create(model=OPENAI_MODEL, messages=messages_ctx)
-                        answer = resp.choices[0].message.content or "Gracias por escribir. Te atiendo enseguida."
-                    except Exception as e:
-                        log.warning(f"[{rid}] meta LLM error: {e}")
-                        answer = "Gracias por escribir. Te atiendo enseguida."
-
-                    if catalog_items:
-                        answer_lc = answer.lower()
-                        top_products = _find_top_products(f"{text_in} {answer}", catalog_items, top_n=5)
-                        mentioned = [p for p in top_products if (p.get("name") or "").lower() in answer_lc]
-                        if mentioned:
-                            import re as _re
-                            answer = _re.sub(
-                                r"[.!]?\s*(también\s+puedo\s+ayudarte\s+a\s+(cotizarlo|agendar\s+una?\s+demo)[^.!?]*[.!?]?)",
-                                "", answer, flags=_re.IGNORECASE,
-                            ).strip()
-
-                            if obj != "instagram":  # Facebook Messenger (obj == "page")
-                                # Messenger: carrusel con imagen, precio y botones
-                                for p in mentioned[:10]:
-                                    raw = p.get("raw") or {}
-                                    variants = (raw.get("variants") or [])[:1]
-                                    store_url = (p.get("url") or "").rsplit("/products/", 1)[0]
-                                    variant_id = (variants[0] if variants else {}).get("id")
-                                    cart_url = f"{store_url}/cart/{variant_id}:1" if variant_id and store_url else None
-                                    subtitle = (p.get("price_display") or "")[:80]
-                                    elem: dict = {"title": (p.get("name") or "")[:80]}
-                                    if subtitle:
-                                        elem["subtitle"] = subtitle
-                                    if p.get("image"):
-                                        elem["image_url"] = p["image"]
-                                    buttons = []
-                                    if p.get("url"):
-                                        buttons.append({"type": "web_url", "url": p["url"], "title": "Ver producto"})
-                                    if cart_url:
-                                        buttons.append({"type": "web_url", "url": cart_url, "title": "🛒 Agregar al carrito"})
-                                    if buttons:
-                                        elem["buttons"] = buttons[:3]
-                                    carousel_elements.append(elem)
-                            else:
-                                # Instagram DMs: texto + imagen (no soporta Generic Template)
-                                extra_lines = []
-                                for p in mentioned:
-                                    raw = p.get("raw") or {}
-                                    variants = (raw.get("variants") or [])[:3]
-                                    store_url = (p.get("url") or "").rsplit("/products/", 1)[0]
-                                    line = f"\n\n*{p.get('name', '')}*"
-                                    if p.get("url"):
-                                        line += f"\n🛍 Ver: {p['url']}"
-                                    if len(variants) > 1:
-                                        for v in variants:
-                                            v_price_raw = v.get("price", "")
-                                            try:
-                                                v_price = f"${float(v_price_raw):,.2f}" if v_price_raw else ""
-                                            except (ValueError, TypeError):
-                                                v_price = v_price_raw
-                                            v_id = v.get("id")
-                                            cart_url = f"{store_url}/cart/{v_id}:1" if v_id and store_url else None
-                                            line += f"\n• *{v.get('title','')}* — {v_price}"
-                                            if cart_url:
-                                                line += f"\n  🛒 {cart_url}"
-                                    else:
+                    # ── Flujos completos (mismo comportamiento que WhatsApp) ──────────
+                    text_dm = text_in.lower()
+                    wa_url = tenant_whatsapp_url(t)
+                    answer = None
+
+                    # 1) Fast-path: intención de compra por plan (starter/meta)
+                    if any(k in text_dm for k in ["compr", "compra", "pagar", "pago", "checkout", "suscrib"]) and \
+                            ("starter" in text_dm or "meta" in text_dm):
+                        plan = "starter" if "starter" in text_dm else "meta"
+                        try:
+                            prices = _tenant_stripe_prices(t)
+                            if plan not in prices:
+                                prices = await ensure_prices_for_tenant(t)
+                            price_id = prices[plan]
+                            _sess = await _create_checkout_for_any(t, price_id=price_id, qty=1, mode="subscription")
+                            answer = f"Listo ✅ Aquí tienes tu enlace para suscribirte al plan {plan.title()}: {_sess['url']}"
+                            await store_event(tenant_slug, sid, "checkout_link_out", {"plan": plan, "url": _sess["url"]})
+                        except Exception as e:
+                            log.warning(f"[{rid}] meta checkout plan falló: {e}")
+
+                    # 2) Flujo de citas (Google Calendar)
+                    if answer is None:
+                        answer = await handle_booking_flow_wa(sid, text_in, t, tenant_slug)
+
+                    product_image_url: str | None = None
+                    carousel_elements: list = []
+
+                    # 3) Catálogo + LLM + detalles de producto
+                    if answer is None:
+                        catalog_items = await fetch_catalog_for_tenant(t)
+                        system_prompt = build_system_for_tenant(t, page_settings=page_settings, include_faq=False)
+                        messages_ctx = await build_messages_with_history(
+                            sid, system_prompt, tenant=t, catalog_items=catalog_items,
+                            faq=tenant_faq_entries(t, page_settings),
+                        )
+                        try:
+                            dm_channel = "instagram_dm" if obj == "instagram" else "facebook_dm"
+                            answer = await llm_complete(messages_ctx, channel=dm_channel, tenant=t) or "Gracias por escribir. Te atiendo enseguida."
+                        except LLMOverloadedError:
+                            log.warning(f"[{rid}] meta LLM saturado, respuesta degradada")
+                            answer = llm_degraded_reply(t)
+                        except Exception as e:
+                            log.warning(f"[{rid}] meta LLM error: {e}")
+                            answer = "Gracias por escribir. Te atiendo enseguida."
+
+                        if catalog_items:
+                            answer_lc = answer.lower()
+                            top_products = _find_top_products(f"{text_in} {answer}", catalog_items, top_n=5)
+                            mentioned = [p for p in top_products if (p.get("name") or "").lower() in answer_lc]
+                            if mentioned:
+                                import re as _re
+                                answer = _re.sub(
+                                    r"[.!]?\s*(también\s+puedo\s+ayudarte\s+a\s+(cotizarlo|agendar\s+una?\s+demo)[^.!?]*[.!?]?)",
+                                    "", answer, flags=_re.IGNORECASE,
+                                ).strip()
+
+                                if obj != "instagram":  # Facebook Messenger (obj == "page")
+                                    # Messenger: carrusel con imagen, precio y botones
+                                    for p in mentioned[:10]:
+                                        raw = p.get("raw") or {}
+                                        variants = (raw.get("variants") or [])[:1]
+                                        store_url = (p.get("url") or "").rsplit("/products/", 1)[0]
                                         variant_id = (variants[0] if variants else {}).get("id")
                                         cart_url = f"{store_url}/cart/{variant_id}:1" if variant_id and store_url else None
-                                        if p.get("price_display"):
-                                            line += f"\nPrecio: {p['price_display']}"
+                                        subtitle = (p.get("price_display") or "")[:80]
+                                        elem: dict = {"title": (p.get("name") or "")[:80]}
+                                        if subtitle:
+                                            elem["subtitle"] = subtitle
+                                        if p.get("image"):
+                                            elem["image_url"] = p["image"]
+                                        buttons = []
+                                        if p.get("url"):
+                                            buttons.append({"type": "web_url", "url": p["url"], "title": "Ver producto"})
                                         if cart_url:
-                                            line += f"\n🛒 Agregar al carrito: {cart_url}"
-                                    extra_lines.append(line)
-                                answer += "".join(extra_lines)
-                                product_image_url = mentioned[0].get("image") if mentioned else None
-
-                # 4) Agregar link de WhatsApp si el usuario lo solicita explícitamente
-                if wa_url and any(k in text_dm for k in ["whats", "whatsapp"]):
-                    digits_in = norm_phone(text_in)
-                    if digits_in and 8 <= len(digits_in) <= 15:
-                        # Usuario compartió su número: redirigir con privacidad
-                        answer = (
-                            "Gracias por compartir tus datos. Para resguardar tu privacidad, "
-                            f"tú inicias la conversación desde aquí 👉 {wa_url}"
+                                            buttons.append({"type": "web_url", "url": cart_url, "title": "🛒 Agregar al carrito"})
+                                        if buttons:
+                                            elem["buttons"] = buttons[:3]
+                                        carousel_elements.append(elem)
+                                else:
+                                    # Instagram DMs: texto + imagen (no soporta Generic Template)
+                                    extra_lines = []
+                                    for p in mentioned:
+                                        raw = p.get("raw") or {}
+                                        variants = (raw.get("variants") or [])[:3]
+                                        store_url = (p.get("url") or "").rsplit("/products/", 1)[0]
+                                        line = f"\n\n*{p.get('name', '')}*"
+                                        if p.get("url"):
+                                            line += f"\n🛍 Ver: {p['url']}"
+                                        if len(variants) > 1:
+                                            for v in variants:
+                                                v_price_raw = v.get("price", "")
+                                                try:
+                                                    v_price = f"${float(v_price_raw):,.2f}" if v_price_raw else ""
+                                                except (ValueError, TypeError):
+                                                    v_price = v_price_raw
+                                                v_id = v.get("id")
+                                                cart_url = f"{store_url}/cart/{v_id}:1" if v_id and store_url else None
+                                                line += f"\n• *{v.get('title','')}* — {v_price}"
+                                                if cart_url:
+                                                    line += f"\n  🛒 {cart_url}"
+                                        else:
+                                            variant_id = (variants[0] if variants else {}).get("id")
+                                            cart_url = f"{store_url}/cart/{variant_id}:1" if variant_id and store_url else None
+                                            if p.get("price_display"):
+                                                line += f"\nPrecio: {p['price_display']}"
+                                            if cart_url:
+                                                line += f"\n🛒 Agregar al carrito: {cart_url}"
+                                        extra_lines.append(line)
+                                    answer += "".join(extra_lines)
+                                    product_image_url = mentioned[0].get("image") if mentioned else None
+
+                    # 4) Agregar link de WhatsApp si el usuario lo solicita explícitamente
+                    if wa_url and any(k in text_dm for k in ["whats", "whatsapp"]):
+                        digits_in = norm_phone(text_in)
+                        if digits_in and 8 <= len(digits_in) <= 15:
+                            # Usuario compartió su número: redirigir con privacidad
+                            answer = (
+                                "Gracias por compartir tus datos. Para resguardar tu privacidad, "
+                                f"tú inicias la conversación desde aquí 👉 {wa_url}"
+                            )
+                        else:
+                            answer += f"\n\n📱 WhatsApp: {wa_url}"
+
+                    add_message(sid, "assistant", answer)
+                    await store_event(tenant_slug, sid, f"{obj}_out", {"to": sender_id, "text": answer[:MAX_TEXT_LENGTH]})
+                    await log_message(tenant_slug, sid, channel_label, "out", answer, author="bot", page_id=page_id)
+                    # Enviar respuesta solo si tenemos token (desde DB)
+                    if not page_token:
+                        log.warning(
+                            f"[{rid}] DM skip: falta page_token slug={tenant_slug} owner={owner_id} obj={obj}"
                         )
                     else:
-                        answer += f"\n\n📱 WhatsApp: {wa_url}"
-
-                add_message(sid, "assistant", answer)
-                asyncio.create_task(store_event(tenant_slug, sid, f"{obj}_out", {"to": sender_id, "text": answer[:MAX_TEXT_LENGTH]}))
-                asyncio.create_task(log_message(tenant_slug, sid, channel_label, "out", answer, author="bot", page_id=page_id))
-                # Enviar respuesta solo si tenemos token (desde DB)
-                if not page_token:
-                    log.warning(
-                        f"[{rid}] DM skip: falta page_token slug={tenant_slug} owner={owner_id} obj={obj}"
-                    )
-                else:
-                    try:
-                        platform = "instagram" if obj == "instagram" else "facebook"
-                        log.info(f"[{rid}] Sending message - platform={platform}, participant_id={participant_id}, page_token={(page_token or '')[:20]}...")
-                        await meta_send_text_with_refresh(tenant_slug, participant_id, answer, platform=platform, page_token=page_token)
-                        log.info(f"[{rid}] Message sent successfully to {participant_id}")
-                        # Messenger: carrusel de productos
-                        if obj != "instagram" and carousel_elements:
-                            try:
-                                await meta_send_carousel(page_token, participant_id, carousel_elements)
-                                log.info(f"[{rid}] Carousel ({len(carousel_elements)} cards) sent to {participant_id}")
-                            except Exception as ce:
-                                log.warning(f"[{rid}] meta carousel error: {ce}")
-                        # Instagram: imagen del primer producto
-                        elif product_image_url:
-                            try:
-                                await meta_send_image(page_token, participant_id, product_image_url)
-                                log.info(f"[{rid}] Product image sent to {participant_id}")
-                            except Exception as img_err:
-                                log.warning(f"[{rid}] meta image send error: {img_err}")
-                    except Exception as e:
-                        log.error(f"[{rid}] meta send error to participant={participant_id}, platform={platform}: {e}")
+                        try:
+                            platform = "instagram" if obj == "instagram" else "facebook"
+                            log.info(f"[{rid}] Sending message - platform={platform}, participant_id={participant_id}, page_token={(page_token or '')[:20]}...")
+                            await meta_send_text_with_refresh(tenant_slug, participant_id, answer, platform=platform, page_token=page_token)
+                            log.info(f"[{rid}] Message sent successfully to {participant_id}")
+                            # Messenger: carrusel de productos
+                            if obj != "instagram" and carousel_elements:
+                                try:
+                                    await meta_send_carousel(page_token, participant_id, carousel_elements)
+                                    log.info(f"[{rid}] Carousel ({len(carousel_elements)} cards) sent to {participant_id}")
+                                except Exception as ce:
+                                    log.warning(f"[{rid}] meta carousel error: {ce}")
+                            # Instagram: imagen del primer producto
+                            elif product_image_url:
+                                try:
+                                    await meta_send_image(page_token, participant_id, product_image_url)
+                                    log.info(f"[{rid}] Product image sent to {participant_id}")
+                                except Exception as img_err:
+                                    log.warning(f"[{rid}] meta image send error: {img_err}")
+                        except Exception as e:
+                            log.error(f"[{rid}] meta send error to participant={participant_id}, platform={platform}: {e}")
 
             # Feed / Comments
             for ch in entry.get("changes", []):
@@ -2953,7 +6239,7 @@ async def meta_webhook_events(request: Request, payload: Dict[str, Any] = Body(.
                     str(value.get("verb", "")),
                     str(value.get("comment_id") or value.get("id") or "")
                 )
-                if meta_event_seen(dedupe_key):
+                if await meta_event_seen(dedupe_key):
                     log.debug(f"[{rid}] dedupe skip {dedupe_key}")
                     continue
 
@@ -2998,12 +6284,7 @@ async def meta_webhook_events(request: Request, payload: Dict[str, Any] = Body(.
                             },
                         ]
                         try:
-                            client_reply = client.with_options(timeout=10.0)
-                            resp = client_reply.chat.completions.create(
-                                model=OPENAI_MODEL,
-                                messages=reply_messages,
-                            )
-                            candidate = (resp.choices[0].message.content or "").strip()
+                            candidate = (await llm_complete(reply_messages, channel="facebook_comment", tenant=t)).strip()
                             if candidate:
                                 public_reply = candidate
                         except Exception as e:
@@ -3018,7 +6299,7 @@ async def meta_webhook_events(request: Request, payload: Dict[str, Any] = Body(.
                     else:
                         try:
                             await fb_reply_comment(page_token, comment_id, public_reply)
-                            asyncio.create_task(log_message(tenant_slug, sid, "facebook_comment", "out", public_reply, author="bot", page_id=page_id))
+                            await log_message(tenant_slug, sid, "facebook_comment", "out", public_reply, author="bot", page_id=page_id)
                         except Exception as e:
                             log.error(f"[{rid}] fb_reply_comment error: {e}")
 
@@ -3028,11 +6309,11 @@ async def meta_webhook_events(request: Request, payload: Dict[str, Any] = Body(.
                         except Exception as e:
                             log.error(f"[{rid}] private reply error: {e}")
 
-                    asyncio.create_task(store_event(
+                    await store_event(
                         tenant_slug, sid, "page_comment_in",
                         {"comment_id": comment_id, "author_id": author_id, "text": text_in}
-                    ))
-                    asyncio.create_task(log_message(tenant_slug, sid, "facebook_comment", "in", text_in, author=author_id, page_id=page_id))
+                    )
+                    await log_message(tenant_slug, sid, "facebook_comment", "in", text_in, author=author_id, page_id=page_id)
 
                 # Instagram comments
                 if obj == "instagram" and field == "comments":
@@ -3072,12 +6353,7 @@ async def meta_webhook_events(request: Request, payload: Dict[str, Any] = Body(.
                             },
                         ]
                         try:
-                            client_reply = client.with_options(timeout=10.0)
-                            resp = client_reply.chat.completions.create(
-                                model=OPENAI_MODEL,
-                                messages=reply_messages,
-                            )
-                            candidate = (resp.choices[0].message.content or "").strip()
+                            candidate = (await llm_complete(reply_messages, channel="instagram_comment", tenant=t)).strip()
                             if candidate:
                                 public_reply = candidate
                         except Exception as e:
@@ -3092,7 +6368,7 @@ async def meta_webhook_events(request: Request, payload: Dict[str, Any] = Body(.
                     else:
                         try:
                             await ig_reply_comment(page_token, ig_comment_id, public_reply)
-                            asyncio.create_task(log_message(tenant_slug, sid, "instagram_comment", "out", public_reply, author="bot", page_id=page_id))
+                            await log_message(tenant_slug, sid, "instagram_comment", "out", public_reply, author="bot", page_id=page_id)
                         except Exception as e:
                             log.error(f"[{rid}] ig_reply_comment error: {e}")
 
@@ -3102,11 +6378,11 @@ async def meta_webhook_events(request: Request, payload: Dict[str, Any] = Body(.
                         except Exception as e:
                             log.error(f"[{rid}] IG private reply error: {e}")
 
-                    asyncio.create_task(store_event(
+                    await store_event(
                         tenant_slug, sid, "instagram_comment_in",
                         {"comment_id": ig_comment_id, "author_id": author_id, "text": text_in}
-                    ))
-                    asyncio.create_task(log_message(tenant_slug, sid, "instagram_comment", "in", text_in, author=author_id, page_id=page_id))
+                    )
+                    await log_message(tenant_slug, sid, "instagram_comment", "in", text_in, author=author_id, page_id=page_id)
 
         return {"ok": True}
     except Exception as e:
@@ -3216,31 +6492,33 @@ async def meta_send_text_with_refresh(tenant_slug: str, recipient_id: str, text:
 async def chat_stream(input: ChatIn, request: Request, tenant: str = Query(default="")):
     if tenant and not valid_slug(tenant):
         raise HTTPException(400, "Invalid tenant")
-    key = input.sessionId or get_client_ip(request)
-    if is_rate_limited(key):
-        raise HTTPException(status_code=429, detail="Too many requests")
+    rl_key = input.sessionId or get_client_ip(request)
+    rl_headers = enforce_rate_limit("chat_stream", rl_key)
+    t = await fetch_tenant(tenant)
+    rl_headers.update(enforce_tenant_rate_limit("chat_stream", rl_key, t))
+    if LLM_ADMISSION.overloaded():
+        raise HTTPException(status_code=429, detail="Too many requests",
+                            headers={"Retry-After": str(LLM_ADMISSION.retry_after())})
 
+    await hydrate_session(input.sessionId)
     sid = ensure_session(input.sessionId)
     add_message(sid, "user", input.message)
-    asyncio.create_task(store_event(tenant or "public", sid, "msg_in", {"text": (input.message or "")[:MAX_TEXT_LENGTH]}))
-    asyncio.create_task(log_message(tenant or "public", sid, "web", "in", input.message or "", author="user"))
+    await store_event(tenant or "public", sid, "msg_in", {"text": (input.message or "")[:MAX_TEXT_LENGTH]})
+    await log_message(tenant or "public", sid, "web", "in", input.message or "", author="user")
 
-    t = await fetch_tenant(tenant)
     catalog_items = await fetch_catalog_for_tenant(t)
-    catalog_summary = summarize_catalog_for_prompt(catalog_items)
-    system_prompt = build_system_for_tenant(t)
-    if catalog_summary:
-        system_prompt = f"{system_prompt}\n\n{catalog_summary}"
-    messages = build_messages_with_history(sid, system_prompt)
+    system_prompt = build_system_for_tenant(t, include_faq=False)
+    messages = await build_messages_with_history(
+        sid, system_prompt, tenant=t, catalog_items=catalog_items, faq=tenant_faq_entries(t)
+    )
 
     async def event_generator():
+        final_text = ""
         try:
             yield sse_event("ok", event="ping")
 
             text_lc = (input.message or "").lower()
-            purchase_intent = any(k in text_lc for k in [
-                "compr", "compra", "adquir", "pagar", "pago", "orden", "checkout", "suscrib"
-            ])
+            purchase_intent = wants_purchase(text_lc)
             flow = get_flow(sid)
             booking_cfg = calendar_cfg_from_tenant(t)
             if flow.get("stage"):
@@ -3253,7 +6531,7 @@ async def chat_stream(input: ChatIn, request: Request, tenant: str = Query(defau
             if t and not tenant_bot_enabled(t):
                 off_msg = ((t.get("settings") or {}).get("bot_off_message") or "El asistente está en pausa. Escríbenos por WhatsApp o envíanos un correo y te respondemos enseguida.")
                 add_message(sid, "assistant", off_msg)
-                asyncio.create_task(log_message(tenant or "public", sid, "web", "out", off_msg, author="assistant"))
+                await log_message(tenant or "public", sid, "web", "out", off_msg, author="assistant")
                 yield sse_event(json.dumps({"content": off_msg}), event="delta")
                 yield sse_event(json.dumps({"done": True, "sessionId": sid}), event="done")
                 return
@@ -3264,7 +6542,7 @@ async def chat_stream(input: ChatIn, request: Request, tenant: str = Query(defau
             if _stripped in {"probar funciones", "probar función", "probar funcion"}:
                 _msg = "¿En qué canal quieres probarlo?"
                 add_message(sid, "assistant", _msg)
-                asyncio.create_task(log_message(tenant or "public", sid, "web", "out", _msg, author="assistant"))
+                await log_message(tenant or "public", sid, "web", "out", _msg, author="assistant")
                 yield sse_event(json.dumps({"content": _msg}), event="delta")
                 yield sse_event(json.dumps({"chips": ["En Meta / Acid IA", "Por WhatsApp", "Aquí en la web"], "whatsapp": None, "showWhatsAppBubble": False}), event="ui")
                 yield sse_event(json.dumps({"done": True, "sessionId": sid}), event="done")
@@ -3273,7 +6551,7 @@ async def chat_stream(input: ChatIn, request: Request, tenant: str = Query(defau
             if _stripped in {"en meta / acid ia", "en meta/acid ia", "meta / acid ia", "meta/acid ia"}:
                 _msg = "En Meta (Facebook e Instagram) el bot puede responder DMs y comentarios con IA.\n\nPuedes simular cualquiera de estos flujos aquí en la web:"
                 add_message(sid, "assistant", _msg)
-                asyncio.create_task(log_message(tenant or "public", sid, "web", "out", _msg, author="assistant"))
+                await log_message(tenant or "public", sid, "web", "out", _msg, author="assistant")
                 yield sse_event(json.dumps({"content": _msg}), event="delta")
                 yield sse_event(json.dumps({"chips": ["Solicitar cotización", "Agendar una demo", "Ver catálogo"], "whatsapp": None, "showWhatsAppBubble": False}), event="ui")
                 yield sse_event(json.dumps({"done": True, "sessionId": sid}), event="done")
@@ -3284,7 +6562,7 @@ async def chat_stream(input: ChatIn, request: Request, tenant: str = Query(defau
                 _wa_link = f"https://wa.me/{_wa_num}" if _wa_num else None
                 _msg = "Por WhatsApp el bot puede:\n\n🗓 Agendar citas con Google Calendar\n🛍 Mostrar catálogo y recibir pedidos\n💳 Generar links de pago (Stripe)\n🔔 Enviar notificaciones proactivas (ej. órdenes Shopify)\n💬 Responder consultas con IA\n\nEscríbenos directamente para probarlo:"
                 add_message(sid, "assistant", _msg)
-                asyncio.create_task(log_message(tenant or "public", sid, "web", "out", _msg, author="assistant"))
+                await log_message(tenant or "public", sid, "web", "out", _msg, author="assistant")
                 yield sse_event(json.dumps({"content": _msg}), event="delta")
                 yield sse_event(json.dumps({"chips": [], "whatsapp": _wa_link, "showWhatsAppBubble": bool(_wa_link)}), event="ui")
                 yield sse_event(json.dumps({"done": True, "sessionId": sid}), event="done")
@@ -3293,7 +6571,7 @@ async def chat_stream(input: ChatIn, request: Request, tenant: str = Query(defau
             if _stripped in {"aquí en la web", "aqui en la web", "probar aquí (web)", "probar aqui (web)", "probar aqui"}:
                 _msg = "Aquí puedes probar todos los flujos del widget web. Elige uno:"
                 add_message(sid, "assistant", _msg)
-                asyncio.create_task(log_message(tenant or "public", sid, "web", "out", _msg, author="assistant"))
+                await log_message(tenant or "public", sid, "web", "out", _msg, author="assistant")
                 yield sse_event(json.dumps({"content": _msg}), event="delta")
                 yield sse_event(json.dumps({"chips": ["Solicitar cotización", "Agendar una demo", "Ver catálogo", "Quiero suscribirme"], "whatsapp": None, "showWhatsAppBubble": False}), event="ui")
                 yield sse_event(json.dumps({"done": True, "sessionId": sid}), event="done")
@@ -3310,7 +6588,7 @@ async def chat_stream(input: ChatIn, request: Request, tenant: str = Query(defau
                     "🔗 *API abierta* — conecta cualquier sistema externo via webhooks"
                 )
                 add_message(sid, "assistant", _msg)
-                asyncio.create_task(log_message(tenant or "public", sid, "web", "out", _msg, author="assistant"))
+                await log_message(tenant or "public", sid, "web", "out", _msg, author="assistant")
                 yield sse_event(json.dumps({"content": _msg}), event="delta")
                 _t_settings = (t or {}).get("settings") or {}
                 _wchips = _t_settings.get("widget_chips") or ["Solicitar cotización", "Contactar por WhatsApp"]
@@ -3355,10 +6633,10 @@ async def chat_stream(input: ChatIn, request: Request, tenant: str = Query(defau
                         "label": "Pagar suscripción"
                     }), event="ui")
                     yield sse_event(json.dumps({}), event="done")
-                    asyncio.create_task(store_event(
+                    await store_event(
                         tenant or "public", sid, "checkout_link_out",
                         {"plan": plan, "url": session["url"]}
-                    ))
+                    )
                     return
                 except Exception as e:
                     log.warning(f"checkout por plan falló: {e}")
@@ -3374,7 +6652,7 @@ async def chat_stream(input: ChatIn, request: Request, tenant: str = Query(defau
                         yield sse_event(json.dumps({"content": f"Perfecto. Te dejo el enlace para completar la compra de {name}."}), event="delta")
                         yield sse_event(json.dumps({"checkout_url": session.get("url"), "label": "Comprar ahora"}), event="ui")
                         yield sse_event(json.dumps({}), event="done")
-                        asyncio.create_task(store_event(tenant or "public", sid, "checkout_link_out", {"product": item.get("product_id"), "url": session.get("url")}))
+                        await store_event(tenant or "public", sid, "checkout_link_out", {"product": item.get("product_id"), "url": session.get("url")})
                         return
                     except Exception as e:
                         log.warning(f"no se pudo crear checkout por intent: {e}")
@@ -3388,7 +6666,7 @@ async def chat_stream(input: ChatIn, request: Request, tenant: str = Query(defau
                             yield sse_event(json.dumps({"content": f"Puedo procesarlo ya. Aquí tienes el enlace para {name}."}), event="delta")
                             yield sse_event(json.dumps({"checkout_url": session.get("url"), "label": "Comprar ahora"}), event="ui")
                             yield sse_event(json.dumps({}), event="done")
-                            asyncio.create_task(store_event(tenant or "public", sid, "checkout_link_out", {"product": safe_items[0].get("product_id"), "url": session.get("url")}))
+                            await store_event(tenant or "public", sid, "checkout_link_out", {"product": safe_items[0].get("product_id"), "url": session.get("url")})
                             return
                         except Exception as e:
                             log.warning(f"checkout directo (1 item) falló: {e}")
@@ -3465,24 +6743,11 @@ async def chat_stream(input: ChatIn, request: Request, tenant: str = Query(defau
                             "calendar_event_id": event_data.get("id"),
                         },
                     )
-                    if db_engine:
-                        try:
-                            async with db_engine.begin() as conn:
-                                await conn.execute(
-                                    text("""INSERT INTO events (tenant_slug, session_id, type, payload)
-                                            VALUES (:tenant, :sid, 'booking_created', CAST(:payload AS JSONB))"""),
-                                    {
-                                        "tenant": tenant or "public",
-                                        "sid": sid,
-                                        "payload": json.dumps({
-                                            "calendar_event_id": event_data.get("id"),
-                                            "calendar_link": event_data.get("html_link"),
-                                            "lead_id": lead.get("id"),
-                                        }),
-                                    },
-                                )
-                        except Exception as e:
-                            log.warning(f"event booking_created not stored: {e}")
+                    await store_event(tenant or "public", sid, "booking_created", {
+                        "calendar_event_id": event_data.get("id"),
+                        "calendar_link": event_data.get("html_link"),
+                        "lead_id": lead.get("id"),
+                    })
 
                     confirm_date = answers.get("date")
                     confirm_time = answers.get("time")
@@ -3560,16 +6825,7 @@ async def chat_stream(input: ChatIn, request: Request, tenant: str = Query(defau
                 contact = norm_phone(value) if flow["method"] in {"whatsapp","llamada"} else value.strip().lower()
                 lead = await save_lead(tenant or "public", sid, flow["name"], flow["method"], contact, meta={"source":"widget"})
 
-                try:
-                    if db_engine:
-                        async with db_engine.begin() as conn:
-                            await conn.execute(
-                                text("""INSERT INTO events (tenant_slug, session_id, type, payload)
-                                        VALUES (:tenant, :sid, 'lead_saved', CAST(:payload AS JSONB))"""),
-                                {"tenant": tenant or "public", "sid": sid, "payload": json.dumps({"lead_id": lead.get("id")})}
-                            )
-                except Exception as e:
-                    log.warning(f"event lead_saved not stored: {e}")
+                await store_event(tenant or "public", sid, "lead_saved", {"lead_id": lead.get("id")})
 
                 base = f"Listo, registré tus datos: {flow['name']} · {flow['method']}."
                 if flow["method"] == "whatsapp":
@@ -3597,6 +6853,7 @@ async def chat_stream(input: ChatIn, request: Request, tenant: str = Query(defau
                         SESSIONS[sid]["last_lead_id"] = lead.get("id")
                     except Exception:
                         pass
+                    mark_session_dirty(sid)
                     flow["stage"] = "ask_slot"
                     yield sse_event(json.dumps({"lead":{"id": lead.get("id"), "status":"saved"}}), event="ui")
                     yield sse_event(json.dumps({}), event="done")
@@ -3616,12 +6873,7 @@ async def chat_stream(input: ChatIn, request: Request, tenant: str = Query(defau
                                 text("UPDATE leads SET meta = COALESCE(meta,'{}'::jsonb) || CAST(:add AS JSONB) WHERE id = :id"),
                                 {"add": json.dumps({"preferred_slot": slot_text}), "id": lead_id}
                             )
-                        async with db_engine.begin() as conn:
-                            await conn.execute(
-                                text("""INSERT INTO events (tenant_slug, session_id, type, payload)
-                                        VALUES (:tenant, :sid, 'lead_slot', CAST(:payload AS JSONB))"""),
-                                {"tenant": tenant or "public", "sid": sid, "payload": json.dumps({"lead_id": lead_id, "slot": slot_text})}
-                            )
+                        await store_event(tenant or "public", sid, "lead_slot", {"lead_id": lead_id, "slot": slot_text})
                 except Exception as e:
                     log.warning(f"no se pudo guardar preferred_slot: {e}")
                 yield sse_event(json.dumps({"content": f"Perfecto, anoté: {slot_text}. Cuando gustes podemos confirmar por aquí o por WhatsApp."}), event="delta")
@@ -3636,45 +6888,30 @@ async def chat_stream(input: ChatIn, request: Request, tenant: str = Query(defau
                     yield sse_event(json.dumps({"content": ch}), event="delta")
                     await asyncio.sleep(0)
                 add_message(sid, "assistant", full)
-                asyncio.create_task(log_message(tenant or "public", sid, "web", "out", full, author="assistant"))
+                await log_message(tenant or "public", sid, "web", "out", full, author="assistant")
                 ui = suggest_ui_for_text(input.message, t)
                 yield sse_event(json.dumps(ui), event="ui")
                 yield sse_event(json.dumps({"done": True, "sessionId": sid}), event="done")
                 return
 
             final_text = ""
-            client_rt = client.with_options(timeout=60.0)
-            stream = None
-            for attempt in range(2):
-                try:
-                    stream = client_rt.chat.completions.create(
-                        model=OPENAI_MODEL,
-                        messages=messages,
-                        stream=True
-                    )
-                    break
-                except Exception as e:
-                    if attempt == 1:
-                        raise
-                    await asyncio.sleep(0.7)
-
-            if stream is None:
-                raise RuntimeError("No se pudo iniciar stream")
-
-            for chunk in stream:
-                piece = getattr(chunk.choices[0].delta, "content", None)
-                if piece:
+            pieces = coalesce_deltas(llm_stream(messages, channel="web_stream", tenant=t))
+            try:
+                async for piece in pieces:
                     final_text += piece
                     yield sse_event(json.dumps({"content": piece}), event="delta")
-                    await asyncio.sleep(0)
-                if await request.is_disconnected():
-                    add_message(sid, "assistant", final_text)
-                    asyncio.create_task(log_message(tenant or "public", sid, "web", "out", final_text, author="assistant"))
-                    return
+                    if await request.is_disconnected():
+                        # Cliente se fue: cortar la petición upstream para no seguir pagando tokens
+                        add_message(sid, "assistant", final_text)
+                        await log_message(tenant or "public", sid, "web", "out", final_text, author="assistant")
+                        return
+            finally:
+                # Cierra la conexión con OpenAI también si el generador es cancelado
+                await pieces.aclose()
 
             add_message(sid, "assistant", final_text)
-            asyncio.create_task(store_event(tenant or "public", sid, "msg_out", {"text": final_text[:MAX_TEXT_LENGTH]}))
-            asyncio.create_task(log_message(tenant or "public", sid, "web", "out", final_text, author="assistant"))
+            await store_event(tenant or "public", sid, "msg_out", {"text": final_text[:MAX_TEXT_LENGTH]})
+            await log_message(tenant or "public", sid, "web", "out", final_text, author="assistant")
             ui = suggest_ui_for_text(input.message, t)
 
             # Tarjetas de productos: mostrar si el bot mencionó algún producto del catálogo
@@ -3701,6 +6938,14 @@ async def chat_stream(input: ChatIn, request: Request, tenant: str = Query(defau
             yield sse_event(json.dumps(ui), event="ui")
             yield sse_event(json.dumps({"done": True, "sessionId": sid}), event="done")
 
+        except LLMOverloadedError as e:
+            log.warning(f"[chat] LLM saturado sid={sid}")
+            if final_text:
+                # Ya salió parte de la respuesta: el aviso no debe pegarse al texto
+                yield sse_event(json.dumps({"error": "overloaded", "retryAfter": e.retry_after}), event="error")
+            else:
+                yield sse_event(json.dumps({"content": llm_degraded_reply(t)}), event="delta")
+            yield sse_event(json.dumps({"done": True, "sessionId": sid, "retryAfter": e.retry_after}), event="done")
         except Exception as e:
             log.error(f"SSE ERROR: {e}")
             yield sse_event(json.dumps({"error": str(e)}), event="error")
@@ -3708,15 +6953,20 @@ async def chat_stream(input: ChatIn, request: Request, tenant: str = Query(defau
     return StreamingResponse(
         event_generator(),
         media_type="text/event-stream",
-        headers={"Cache-Control":"no-cache","Connection":"keep-alive","X-Accel-Buffering":"no"}
+        headers={"Cache-Control":"no-cache","Connection":"keep-alive","X-Accel-Buffering":"no", **rl_headers}
     )
 
 
 # ── Auth endpoints ─────────────────────────────────────────────────────
 @app.post("/auth/login", response_model=AuthTokenOut)
-async def auth_login(body: LoginIn):
+async def auth_login(body: LoginIn, request: Request, response: Response):
+    enforce_rate_limit("auth_login", get_client_ip(request), response=response)
+    # Por email solo cuentan los fallos: un tercero no puede bloquear la cuenta de otro con logins válidos
+    email_key = f"email:{str(body.email).lower()}"
+    enforce_rate_limit("auth_login", email_key, peek=True)
     user = await fetch_user_by_email(body.email)
     if not user or not verify_password(body.password, user.get("password_hash", "")):
+        count_rate_limit_hit("auth_login", email_key)
         raise HTTPException(status_code=401, detail="Credenciales inválidas")
     token = create_access_token(user["id"], user["tenant_slug"])
     if db_engine:
@@ -3800,6 +7050,7 @@ async def auth_reset_password(body: ResetPasswordIn):
             """),
             {"password_hash": new_password_hash, "id": user_id}
         )
+    await invalidate_principal(row.email)
 
     return {"ok": True, "message": "Contraseña actualizada correctamente."}
 
@@ -3997,6 +7248,7 @@ async def google_oauth_callback(
             text("UPDATE tenants SET settings = :settings, updated_at = NOW() WHERE slug = :slug"),
             {"settings": json.dumps(settings), "slug": tenant_slug}
         )
+    await invalidate_tenant(tenant_slug)
 
     return Response(
         status_code=302,
@@ -4031,6 +7283,7 @@ async def google_oauth_disconnect(current = Depends(require_user)):
             text("UPDATE tenants SET settings = :settings, updated_at = NOW() WHERE slug = :slug"),
             {"settings": json.dumps(settings), "slug": tenant_slug}
         )
+    await invalidate_tenant(tenant_slug)
 
     return {"ok": True}
 
@@ -4390,6 +7643,8 @@ async def facebook_oauth_callback(
                         {"settings": json.dumps(settings), "slug": tenant_slug}
                     )
                     log.info(f"   ✅ fb_user_id guardado en settings")
+        await invalidate_tenant(tenant_slug)
+        await notify_pages_changed()
     else:
         log.error(f"❌ db_engine no disponible, no se pudo guardar la configuración")
 
@@ -4452,6 +7707,8 @@ async def facebook_oauth_disconnect(current = Depends(require_user)):
                     "slug": tenant_slug
                 }
             )
+        await invalidate_tenant(tenant_slug)
+        await notify_pages_changed()
 
     return {"success": True, "message": "Facebook desconectado correctamente"}
 
@@ -4664,6 +7921,7 @@ async def facebook_activate_page(page_id: str, current = Depends(require_user)):
             """),
             {"tenant": tenant_slug, "page_id": page_id}
         )
+    await notify_pages_changed()
 
     return {"success": True, "message": f"Página {page_id} activada"}
 
@@ -4745,6 +8003,7 @@ async def facebook_assign_page_to_tenant(
             """),
             {"tenant_slug": tenant_slug, "page_id": page_id}
         )
+    await notify_pages_changed()
 
     return {"success": True, "message": f"Página asignada a tenant '{tenant_slug}'"}
 
@@ -4795,6 +8054,7 @@ async def facebook_update_page_settings(
             """),
             {"page_id": page_id, "settings": json.dumps(settings)}
         )
+    await notify_pages_changed()
 
     return {"success": True, "message": "Configuración de página actualizada"}
 
@@ -4880,6 +8140,8 @@ async def admin_create_user(body: UserCreateIn):
             """),
             {"tenant": tenant_slug, "email": body.email.strip().lower(), "hash": password_hash}
         )
+    # El usuario pudo cambiar de tenant: sus tokens viejos ya no deben validar
+    await invalidate_principal(body.email)
     return {"ok": True}
 
 
@@ -4928,6 +8190,8 @@ async def admin_reset_users(body: AdminResetUsersIn):
                 "password_hash": acid_password_hash
             }
         )).mappings().first()
+    # Usuarios borrados o reasignados: ningún principal cacheado sigue siendo válido
+    await invalidate_all_tenants()
 
     return {
         "ok": True,
@@ -4968,6 +8232,7 @@ async def tenant_update_settings(body: TenantSettingsUpdate, current = Depends(r
                 text("UPDATE tenants SET whatsapp = :wa, updated_at = NOW() WHERE slug = :slug"),
                 {"wa": body.whatsapp.strip() if body.whatsapp else None, "slug": tenant_slug}
             )
+        await invalidate_tenant(tenant_slug)
 
     if body.settings:
         await merge_tenant_settings(tenant_slug, body.settings)
@@ -5095,6 +8360,7 @@ async def update_tenant_settings(
             text("UPDATE tenants SET settings = :settings WHERE slug = :slug"),
             {"settings": json.dumps(new_settings), "slug": tenant_slug}
         )
+    await invalidate_tenant(tenant_slug)
 
     return {"ok": True, "settings": new_settings}
 
@@ -5206,14 +8472,9 @@ async def admin_send_message(
             await twilio_send_whatsapp(tenant_slug, to_e164, message)
         except Exception as e:
             raise HTTPException(500, f"Error enviando WhatsApp: {e}")
-        if db_engine:
-            async with db_engine.begin() as conn:
-                await conn.execute(
-                    text("""INSERT INTO messages (tenant_slug, session_id, channel, direction, author, content, payload)
-                            VALUES (:tenant, :sid, 'whatsapp', 'out', 'admin', :content, :payload)"""),
-                    {"tenant": tenant_slug, "sid": session_id, "content": message,
-                     "payload": json.dumps({"admin_reply": True})}
-                )
+        # Síncrono: el inbox relee la conversación apenas responde este endpoint
+        await log_message(tenant_slug, session_id, "whatsapp", "out", message, author="admin",
+                          payload={"admin_reply": True}, sync=True)
         return {"ok": True, "platform": "wa", "to": to_e164}
 
     # ── Facebook / Instagram ───────────────────────────────────────────
@@ -5306,23 +8567,9 @@ async def admin_send_message(
     try:
         result = await meta_send_text(page_token, recipient_id, message, platform, messaging_type=messaging_type, tag=tag)
 
-        # Guardar el mensaje en la base de datos
-        async with db_engine.connect() as conn:
-            await conn.execute(
-                text("""
-                    INSERT INTO messages (tenant_slug, session_id, channel, direction, author, content, payload, page_id)
-                    VALUES (:tenant, :session_id, :channel, 'out', 'admin', :content, :payload, :page_id)
-                """),
-                {
-                    "tenant": tenant_slug,
-                    "session_id": session_id,
-                    "channel": f"{platform}_dm",
-                    "content": message,
-                    "payload": json.dumps({"admin_reply": True, "meta_response": result}),
-                    "page_id": page_id
-                }
-            )
-            await conn.commit()
+        # Guardar el mensaje en la base de datos (síncrono: el inbox lo relee enseguida)
+        await log_message(tenant_slug, session_id, f"{platform}_dm", "out", message, author="admin",
+                          payload={"admin_reply": True, "meta_response": result}, page_id=page_id, sync=True)
 
         return {
             "ok": True,
@@ -5359,6 +8606,7 @@ async def admin_get_conversation_bot_state(session_id: str = Query(...), current
     sid_tenant = session_tenant_from_sid(sid)
     if not sid_tenant or sid_tenant != current["tenant_slug"]:
         raise HTTPException(403, "No tienes acceso a esta conversación")
+    await hydrate_session(sid)
     return {"ok": True, "session_id": sid, "bot_enabled": not is_session_paused(sid)}
 
 
@@ -5941,127 +9189,137 @@ async def twilio_whatsapp_webhook(request: Request, tenant: str = Query(default=
     text_lc = body_txt.lower()
     phone = norm_phone(from_raw)
     sid_session = f"wa:{phone}"
+    await hydrate_session(sid_session)
     sid = ensure_session(sid_session)
-    add_message(sid, "user", body_txt)
-    asyncio.create_task(store_event(tenant or "public", sid, "wa_in", {"from": from_raw, "text": body_txt}))
-    asyncio.create_task(log_message(tenant or "public", sid, "whatsapp", "in", body_txt, author=from_raw))
+    await store_event(tenant or "public", sid, "wa_in", {"from": from_raw, "text": body_txt})
+    await log_message(tenant or "public", sid, "whatsapp", "in", body_txt, author=from_raw)
 
     t = await fetch_tenant(tenant)
 
-    if t and not tenant_bot_enabled(t):
-        off_msg = ((t.get("settings") or {}).get("bot_off_message") or "El asistente está en pausa. Escríbenos directamente por WhatsApp al enlace habitual.")
-        add_message(sid, "assistant", off_msg)
-        asyncio.create_task(store_event(tenant or "public", sid, "wa_out", {"to": from_raw, "text": off_msg[:MAX_TEXT_LENGTH]}))
-        asyncio.create_task(log_message(tenant or "public", sid, "whatsapp", "out", off_msg, author="bot"))
-        twiml = MessagingResponse()
-        twiml.message(off_msg)
-        return Response(str(twiml), media_type="application/xml")
-
-    # Fast-path: "quiero suscribirme al plan starter/meta"
-    if any(k in text_lc for k in ["compr", "compra", "pagar", "pago", "checkout", "suscrib"]) and ("starter" in text_lc or "meta" in text_lc):
-        plan = "starter" if "starter" in text_lc else "meta"
-        try:
-            prices = _tenant_stripe_prices(t)
-            if plan not in prices:
-                prices = await ensure_prices_for_tenant(t)
-            price_id = prices[plan]
-            session = await _create_checkout_for_any(t, price_id=price_id, qty=1, mode="subscription")
-            answer = f"Listo ✅ Aquí tienes tu enlace de suscripción al plan {plan.title()}: {session['url']}"
-            add_message(sid, "assistant", answer)
-            asyncio.create_task(store_event(tenant or "public", sid, "wa_out", {"to": from_raw, "text": answer[:MAX_TEXT_LENGTH]}))
-            asyncio.create_task(log_message(tenant or "public", sid, "whatsapp", "out", answer, author="bot"))
+    async with INBOUND_MAILBOX.turn(
+        sid, body_txt, inbound_debounce_ms(t), merge=lambda: not session_in_flow(sid)
+    ) as turn_texts:
+        if turn_texts is None:
+            # Otro request de esta conversación ya responde este mensaje
+            return Response("<Response></Response>", media_type="application/xml")
+        for piece in turn_texts:
+            add_message(sid, "user", piece)
+        body_txt = "\n".join(turn_texts)
+        text_lc = body_txt.lower()
+
+        if t and not tenant_bot_enabled(t):
+            off_msg = ((t.get("settings") or {}).get("bot_off_message") or "El asistente está en pausa. Escríbenos directamente por WhatsApp al enlace habitual.")
+            add_message(sid, "assistant", off_msg)
+            await store_event(tenant or "public", sid, "wa_out", {"to": from_raw, "text": off_msg[:MAX_TEXT_LENGTH]})
+            await log_message(tenant or "public", sid, "whatsapp", "out", off_msg, author="bot")
             twiml = MessagingResponse()
-            twiml.message(answer)
+            twiml.message(off_msg)
             return Response(str(twiml), media_type="application/xml")
-        except Exception as e:
-            log.warning(f"WA fast-path checkout falló: {e}")
-            # si falla, sigue al comportamiento normal con LLM
 
+        # Fast-path: "quiero suscribirme al plan starter/meta"
+        if any(k in text_lc for k in ["compr", "compra", "pagar", "pago", "checkout", "suscrib"]) and ("starter" in text_lc or "meta" in text_lc):
+            plan = "starter" if "starter" in text_lc else "meta"
+            try:
+                prices = _tenant_stripe_prices(t)
+                if plan not in prices:
+                    prices = await ensure_prices_for_tenant(t)
+                price_id = prices[plan]
+                session = await _create_checkout_for_any(t, price_id=price_id, qty=1, mode="subscription")
+                answer = f"Listo ✅ Aquí tienes tu enlace de suscripción al plan {plan.title()}: {session['url']}"
+                add_message(sid, "assistant", answer)
+                await store_event(tenant or "public", sid, "wa_out", {"to": from_raw, "text": answer[:MAX_TEXT_LENGTH]})
+                await log_message(tenant or "public", sid, "whatsapp", "out", answer, author="bot")
+                twiml = MessagingResponse()
+                twiml.message(answer)
+                return Response(str(twiml), media_type="application/xml")
+            except Exception as e:
+                log.warning(f"WA fast-path checkout falló: {e}")
+                # si falla, sigue al comportamiento normal con LLM
 
-    # Flujo de citas (tiene prioridad sobre el LLM)
-    booking_reply = await handle_booking_flow_wa(sid, body_txt, t, tenant or "public")
-    if booking_reply is not None:
-        add_message(sid, "assistant", booking_reply)
-        asyncio.create_task(log_message(tenant or "public", sid, "whatsapp", "out", booking_reply, author="bot"))
-        twiml = MessagingResponse()
-        twiml.message(booking_reply)
-        return Response(str(twiml), media_type="application/xml")
 
-    catalog_items = await fetch_catalog_for_tenant(t)
-    catalog_summary = summarize_catalog_for_prompt(catalog_items)
-    system_prompt = build_system_for_tenant(t)
-    if catalog_summary:
-        system_prompt = f"{system_prompt}\n\n{catalog_summary}"
-    messages = build_messages_with_history(sid, system_prompt)
-    answer = generate_answer(messages)
-
-    # Si el bot mencionó algún producto del catálogo, adjuntar detalles como texto
-    if catalog_items:
-        answer_lc = answer.lower()
-        top_products = _find_top_products(f"{body_txt} {answer}", catalog_items, top_n=2)
-        mentioned = [p for p in top_products if (p.get("name") or "").lower() in answer_lc]
-        if mentioned:
-            # Quitar sugerencias de demo/cotización cuando hay producto concreto
-            import re as _re
-            answer = _re.sub(
-                r"[.!]?\s*(también\s+puedo\s+ayudarte\s+a\s+(cotizarlo|agendar\s+una?\s+demo)[^.!?]*[.!?]?)",
-                "",
-                answer,
-                flags=_re.IGNORECASE
-            ).strip()
-
-            extra_lines = []
-            for p in mentioned:
-                raw = p.get("raw") or {}
-                variants = (raw.get("variants") or [])[:3]
-                store_url = (p.get("url") or "").rsplit("/products/", 1)[0]
-
-                line = f"\n\n*{p.get('name', '')}*"
-                if p.get("url"):
-                    line += f"\n🛍 Ver producto: {p['url']}"
-
-                if len(variants) > 1:
-                    # Mostrar hasta 3 presentaciones con precio y carrito
-                    for v in variants:
-                        v_title = v.get("title", "")
-                        v_price_raw = v.get("price", "")
-                        try:
-                            v_price = f"${float(v_price_raw):,.2f} MXN" if v_price_raw else ""
-                        except (ValueError, TypeError):
-                            v_price = v_price_raw
-                        v_id = v.get("id")
-                        cart_url = f"{store_url}/cart/{v_id}:1" if v_id and store_url else None
-                        line += f"\n\n• *{v_title}* — {v_price}"
+        # Flujo de citas (tiene prioridad sobre el LLM)
+        booking_reply = await handle_booking_flow_wa(sid, body_txt, t, tenant or "public")
+        if booking_reply is not None:
+            add_message(sid, "assistant", booking_reply)
+            await log_message(tenant or "public", sid, "whatsapp", "out", booking_reply, author="bot")
+            twiml = MessagingResponse()
+            twiml.message(booking_reply)
+            return Response(str(twiml), media_type="application/xml")
+
+        catalog_items = await fetch_catalog_for_tenant(t)
+        system_prompt = build_system_for_tenant(t, include_faq=False)
+        messages = await build_messages_with_history(
+            sid, system_prompt, tenant=t, catalog_items=catalog_items, faq=tenant_faq_entries(t)
+        )
+        answer = await generate_answer(messages, channel="whatsapp", tenant=t)
+
+        # Si el bot mencionó algún producto del catálogo, adjuntar detalles como texto
+        if catalog_items:
+            answer_lc = answer.lower()
+            top_products = _find_top_products(f"{body_txt} {answer}", catalog_items, top_n=2)
+            mentioned = [p for p in top_products if (p.get("name") or "").lower() in answer_lc]
+            if mentioned:
+                # Quitar sugerencias de demo/cotización cuando hay producto concreto
+                import re as _re
+                answer = _re.sub(
+                    r"[.!]?\s*(también\s+puedo\s+ayudarte\s+a\s+(cotizarlo|agendar\s+una?\s+demo)[^.!?]*[.!?]?)",
+                    "",
+                    answer,
+                    flags=_re.IGNORECASE
+                ).strip()
+
+                extra_lines = []
+                for p in mentioned:
+                    raw = p.get("raw") or {}
+                    variants = (raw.get("variants") or [])[:3]
+                    store_url = (p.get("url") or "").rsplit("/products/", 1)[0]
+
+                    line = f"\n\n*{p.get('name', '')}*"
+                    if p.get("url"):
+                        line += f"\n🛍 Ver producto: {p['url']}"
+
+                    if len(variants) > 1:
+                        # Mostrar hasta 3 presentaciones con precio y carrito
+                        for v in variants:
+                            v_title = v.get("title", "")
+                            v_price_raw = v.get("price", "")
+                            try:
+                                v_price = f"${float(v_price_raw):,.2f} MXN" if v_price_raw else ""
+                            except (ValueError, TypeError):
+                                v_price = v_price_raw
+                            v_id = v.get("id")
+                            cart_url = f"{store_url}/cart/{v_id}:1" if v_id and store_url else None
+                            line += f"\n\n• *{v_title}* — {v_price}"
+                            if cart_url:
+                                line += f"\n  🛒 {cart_url}"
+                    else:
+                        # Producto de una sola presentación
+                        variant_id = (variants[0] if variants else {}).get("id")
+                        cart_url = f"{store_url}/cart/{variant_id}:1" if variant_id and store_url else None
+                        if p.get("price_display"):
+                            line += f"\nPrecio: {p['price_display']}"
                         if cart_url:
-                            line += f"\n  🛒 {cart_url}"
-                else:
-                    # Producto de una sola presentación
-                    variant_id = (variants[0] if variants else {}).get("id")
-                    cart_url = f"{store_url}/cart/{variant_id}:1" if variant_id and store_url else None
-                    if p.get("price_display"):
-                        line += f"\nPrecio: {p['price_display']}"
-                    if cart_url:
-                        line += f"\n🛒 Agregar al carrito: {cart_url}"
-
-                extra_lines.append(line)
-            answer += "".join(extra_lines)
-
-            # Imagen del primer producto mencionado
-            product_image_url = mentioned[0].get("image") if mentioned else None
+                            line += f"\n🛒 Agregar al carrito: {cart_url}"
+
+                    extra_lines.append(line)
+                answer += "".join(extra_lines)
+
+                # Imagen del primer producto mencionado
+                product_image_url = mentioned[0].get("image") if mentioned else None
+            else:
+                product_image_url = None
         else:
             product_image_url = None
-    else:
-        product_image_url = None
 
-    add_message(sid, "assistant", answer)
-    asyncio.create_task(store_event(tenant or "public", sid, "wa_out", {"to": from_raw, "text": answer[:MAX_TEXT_LENGTH]}))
-    asyncio.create_task(log_message(tenant or "public", sid, "whatsapp", "out", answer, author="bot"))
+        add_message(sid, "assistant", answer)
+        await store_event(tenant or "public", sid, "wa_out", {"to": from_raw, "text": answer[:MAX_TEXT_LENGTH]})
+        await log_message(tenant or "public", sid, "whatsapp", "out", answer, author="bot")
 
-    twiml = MessagingResponse()
-    msg = twiml.message(answer)
-    if product_image_url:
-        msg.media(product_image_url)
-    return Response(str(twiml), media_type="application/xml")
+        twiml = MessagingResponse()
+        msg = twiml.message(answer)
+        if product_image_url:
+            msg.media(product_image_url)
+        return Response(str(twiml), media_type="application/xml")
 
 @app.options("/v1/admin/export/leads.csv")
 async def options_export_leads():
@@ -6708,10 +9966,10 @@ async def shopify_orders_webhook(request: Request, tenant: str = Query(...)):
     if len(items) > 3:
         items_txt += f" y {len(items) - 3} más"
 
-    asyncio.create_task(store_event(
+    await store_event(
         tenant, f"shopify:{order_number}", "shopify_order_in",
         {"order_number": order_number, "total": total, "currency": currency},
-    ))
+    )
 
     result: dict = {"ok": True, "order_number": order_number}
 
@@ -6728,7 +9986,7 @@ async def shopify_orders_webhook(request: Request, tenant: str = Query(...)):
         )
         try:
             await _acidia_send_whatsapp(f"+{notify_phone}", msg_tenant)
-            asyncio.create_task(log_message(tenant, f"shopify:{order_number}", "whatsapp", "out", msg_tenant, author="acidia-bot"))
+            await log_message(tenant, f"shopify:{order_number}", "whatsapp", "out", msg_tenant, author="acidia-bot")
             result["tenant_notified"] = True
             result["tenant_to"] = f"+{notify_phone}"
             log.info(f"[shopify-webhook] notificación tenant → +{notify_phone} (orden #{order_number})")
@@ -6752,8 +10010,8 @@ async def shopify_orders_webhook(request: Request, tenant: str = Query(...)):
         )
         try:
             await twilio_send_whatsapp(tenant, f"+{customer_phone}", msg_customer)
-            asyncio.create_task(store_event(tenant, f"shopify:{order_number}", "shopify_order_wa_out", {"to": customer_phone, "order_number": order_number}))
-            asyncio.create_task(log_message(tenant, f"shopify:{order_number}", "whatsapp", "out", msg_customer, author="bot"))
+            await store_event(tenant, f"shopify:{order_number}", "shopify_order_wa_out", {"to": customer_phone, "order_number": order_number})
+            await log_message(tenant, f"shopify:{order_number}", "whatsapp", "out", msg_customer, author="bot")
             result["customer_notified"] = True
             result["customer_to"] = f"+{customer_phone}"
             log.info(f"[shopify-webhook] notificación cliente → +{customer_phone} (orden #{order_number})")
@@ -7009,6 +10267,7 @@ async def process_new_tenant_from_payment(
                     "subscription_id": stripe_subscription_id
                 }
             )
+        await invalidate_tenant(business_slug)
 
         # 5. Enviar emails de notificación
         # Email al cliente
@@ -7270,6 +10529,7 @@ async def create_user_manual(body: UserCreateIn, request: Request):
             }
         )
         user_id = result.fetchone()[0]
+    await invalidate_tenant(tenant_slug)
 
     log.info(f"Usuario manual creado: {email} para tenant {tenant_slug} por admin {current.get('email')}")
 
@@ -7398,6 +10658,7 @@ async def admin_toggle_tenant_bot(slug: str, request: Request):
             text("UPDATE tenants SET settings = CAST(:s AS JSONB), updated_at = NOW() WHERE slug = :slug"),
             {"s": json.dumps(settings), "slug": slug}
         )
+    await invalidate_tenant(slug)
     log.info(f"[admin] bot_enabled={new_val} para tenant={slug} por {current.get('email')}")
     return {"slug": slug, "bot_enabled": new_val}
 
@@ -7422,6 +10683,7 @@ async def admin_delete_tenant(slug: str, request: Request):
             raise HTTPException(404, "Tenant no encontrado")
         await conn.execute(text("DELETE FROM users WHERE tenant_slug = :slug"), {"slug": slug})
         await conn.execute(text("DELETE FROM tenants WHERE slug = :slug"), {"slug": slug})
+    await invalidate_tenant(slug)
 
     log.info(f"[admin] tenant={slug} eliminado por {current.get('email')}")
     return {"ok": True, "deleted": slug}
@@ -7484,7 +10746,7 @@ async def stripe_webhook(request: Request):
             log.info(f"Procesando nuevo tenant desde checkout: {business_slug} (reg: {registration_id})")
 
             # Procesar el nuevo tenant de forma asíncrona
-            asyncio.create_task(process_new_tenant_from_payment(
+            TASKS.spawn("provision_tenant", process_new_tenant_from_payment(
                 registration_id=registration_id,
                 business_slug=business_slug,
                 plan=plan,
@@ -7494,15 +10756,15 @@ async def stripe_webhook(request: Request):
             ))
         else:
             # Checkout normal (no es un nuevo tenant)
-            asyncio.create_task(store_event(tenant_slug, sid or "stripe", "stripe_checkout_completed",
-                                            {"subscription": sub_id, "customer": cust_id}))
+            await store_event(tenant_slug, sid or "stripe", "stripe_checkout_completed",
+                              {"subscription": sub_id, "customer": cust_id})
 
     elif etype == "invoice.paid":
-        asyncio.create_task(store_event(tenant_slug, "stripe", "stripe_invoice_paid",
-                                        {"invoice": data.get("id")}))
+        await store_event(tenant_slug, "stripe", "stripe_invoice_paid",
+                          {"invoice": data.get("id")})
     elif etype.startswith("customer.subscription."):
-        asyncio.create_task(store_event(tenant_slug, "stripe", etype.replace(".", "_"),
-                                        {"subscription": data.get("id")}))
+        await store_event(tenant_slug, "stripe", etype.replace(".", "_"),
+                          {"subscription": data.get("id")})
 
     return {"ok": True}
 
@@ -0,0 +1,27 @@
+import os
+import sys
+
+import pytest
+
+# main crea el cliente de OpenAI al importarse; ninguna prueba llama a la API
+os.environ.setdefault("OPENAI_API_KEY", "test")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+pytest.importorskip("fastapi")
+pytest.importorskip("sqlalchemy")
+pytest.importorskip("openai")
+
+import main  # noqa: E402
+
+
+@pytest.fixture
+def shared_store(monkeypatch):
+    """Store de sesiones compartido (LocalKV) y estado de sesiones limpio."""
+    store = main.RedisSessionStore(main.LocalKV())
+    monkeypatch.setattr(main, "SESSION_STORE", store)
+    yield store
+    for sid in list(main.SESSIONS):
+        main.drop_session(sid)
+    main.DIRTY_SESSIONS.clear()
+    main.EVICTED_SESSIONS.clear()
+    main.PAUSED_SESSIONS.clear()
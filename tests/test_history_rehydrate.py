@@ -0,0 +1,53 @@
+import asyncio
+
+import main
+
+
+def test_failed_rehydrate_is_retried_next_turn(monkeypatch):
+    calls = []
+
+    async def load_rows(sid):
+        calls.append(sid)
+        if len(calls) == 1:
+            raise OSError("db down")
+        return [main.ChatMessage(main.Role.USER, "turno viejo", 1)], None
+
+    monkeypatch.setattr(main, "db_engine", object())
+    monkeypatch.setattr(main, "_load_history_rows", load_rows)
+    sid = main.ensure_session("s-history")
+    try:
+        asyncio.run(main.ensure_history_loaded(sid))
+        assert not main.SESSIONS[sid].get("history_loaded")
+        assert main.MESSAGES[sid] == []
+
+        asyncio.run(main.ensure_history_loaded(sid))
+        assert main.SESSIONS[sid]["history_loaded"] is True
+        assert [m.content for m in main.MESSAGES[sid]] == ["turno viejo"]
+
+        asyncio.run(main.ensure_history_loaded(sid))
+        assert len(calls) == 2
+    finally:
+        main.drop_session(sid)
+
+
+def test_concurrent_rehydrates_share_one_query(monkeypatch):
+    calls = []
+
+    async def load_rows(sid):
+        calls.append(sid)
+        await asyncio.sleep(0.01)
+        return [], None
+
+    monkeypatch.setattr(main, "db_engine", object())
+    monkeypatch.setattr(main, "_load_history_rows", load_rows)
+    sid = main.ensure_session("s-history-2")
+
+    async def scenario():
+        await asyncio.gather(*(main.ensure_history_loaded(sid) for _ in range(5)))
+
+    try:
+        asyncio.run(scenario())
+        assert calls == [sid]
+        assert main.SESSIONS[sid]["history_loaded"] is True
+    finally:
+        main.drop_session(sid)
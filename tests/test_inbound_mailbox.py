@@ -0,0 +1,88 @@
+import asyncio
+
+import main
+
+
+async def _deliver(mailbox, key, text, answered, merge=True, debounce_ms=0, work=0.01):
+    async with mailbox.turn(key, text, debounce_ms, merge=merge) as texts:
+        if texts is None:
+            return None
+        await asyncio.sleep(work)   # la respuesta tarda: llegan más mensajes
+        answered.append(texts)
+        return texts
+
+
+def test_burst_is_answered_once_in_order():
+    mailbox = main.ConversationMailbox()
+    answered = []
+
+    async def scenario():
+        first = asyncio.create_task(_deliver(mailbox, "k", "hola", answered))
+        await asyncio.sleep(0)
+        rest = [asyncio.create_task(_deliver(mailbox, "k", t, answered)) for t in ("quiero", "una cita")]
+        return await first, await asyncio.gather(*rest)
+
+    first, rest = asyncio.run(scenario())
+    assert first == ["hola"]
+    # El segundo turno junta los dos pendientes; el tercero ya fue respondido
+    assert rest == [["quiero", "una cita"], None]
+    assert answered == [["hola"], ["quiero", "una cita"]]
+    assert mailbox.boxes == {}
+    assert mailbox.stats["merged"] == 1
+
+
+def test_no_merge_during_flow_keeps_one_turn_per_message():
+    mailbox = main.ConversationMailbox()
+    answered = []
+
+    async def scenario():
+        tasks = [asyncio.create_task(_deliver(mailbox, "k", t, answered, merge=lambda: False))
+                 for t in ("Ana", "ana@example.com", "mañana")]
+        await asyncio.gather(*tasks)
+
+    asyncio.run(scenario())
+    assert answered == [["Ana"], ["ana@example.com"], ["mañana"]]
+
+
+def test_conversations_do_not_block_each_other():
+    mailbox = main.ConversationMailbox()
+    answered = []
+
+    async def scenario():
+        slow = asyncio.create_task(_deliver(mailbox, "a", "lento", answered, work=0.2))
+        await asyncio.sleep(0)
+        await asyncio.wait_for(_deliver(mailbox, "b", "rápido", answered), 0.1)
+        await slow
+
+    asyncio.run(scenario())
+    assert answered == [["rápido"], ["lento"]]
+
+
+def test_debounce_waits_for_silence():
+    mailbox = main.ConversationMailbox()
+    answered = []
+
+    async def scenario():
+        first = asyncio.create_task(_deliver(mailbox, "k", "uno", answered, debounce_ms=50, work=0))
+        await asyncio.sleep(0.02)
+        second = asyncio.create_task(_deliver(mailbox, "k", "dos", answered, debounce_ms=50, work=0))
+        return await asyncio.gather(first, second)
+
+    results = asyncio.run(scenario())
+    assert results == [["uno", "dos"], None]
+    assert answered == [["uno", "dos"]]
+
+
+def test_batch_is_capped(monkeypatch):
+    monkeypatch.setattr(main, "INBOUND_MAX_BATCH", 2)
+    mailbox = main.ConversationMailbox()
+    answered = []
+
+    async def scenario():
+        first = asyncio.create_task(_deliver(mailbox, "k", "m0", answered))
+        await asyncio.sleep(0)
+        rest = [asyncio.create_task(_deliver(mailbox, "k", f"m{i}", answered)) for i in range(1, 4)]
+        await asyncio.gather(first, *rest)
+
+    asyncio.run(scenario())
+    assert answered == [["m0"], ["m1", "m2"], ["m3"]]
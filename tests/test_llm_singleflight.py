@@ -0,0 +1,139 @@
+import asyncio
+import gc
+
+import pytest
+
+import main
+
+MESSAGES = [{"role": "system", "content": "Eres el asistente de Acme."},
+            {"role": "user", "content": "¿Cuánto cuesta el plan básico?"}]
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    calls = []
+    state = {"error": None, "delay": 0.02}
+
+    async def fake_upstream(messages, channel, tenant, route):
+        calls.append(channel)
+        await asyncio.sleep(state["delay"])
+        if state["error"]:
+            raise state["error"]
+        return "Cuesta 10 USD"
+
+    monkeypatch.setattr(main, "USE_MOCK", False)
+    monkeypatch.setattr(main, "_llm_complete_upstream", fake_upstream)
+    return calls, state
+
+
+def test_identical_requests_share_one_call(upstream):
+    calls, _ = upstream
+
+    async def scenario():
+        return await asyncio.gather(*(main.llm_complete(MESSAGES, channel="web") for _ in range(4)))
+
+    assert asyncio.run(scenario()) == ["Cuesta 10 USD"] * 4
+    assert calls == ["web"]
+    assert main.LLM_INFLIGHT == {}
+
+
+def test_cancelled_leader_does_not_cancel_followers(upstream):
+    calls, _ = upstream
+
+    async def scenario():
+        leader = asyncio.create_task(main.llm_complete(MESSAGES, channel="web"))
+        await asyncio.sleep(0.005)
+        follower = asyncio.create_task(main.llm_complete(MESSAGES, channel="web"))
+        await asyncio.sleep(0.005)
+        leader.cancel()
+        return await follower
+
+    assert asyncio.run(scenario()) == "Cuesta 10 USD"
+    assert calls == ["web"]
+
+
+def test_upstream_error_reaches_followers_and_is_consumed(upstream):
+    calls, state = upstream
+    state["error"] = RuntimeError("upstream 500")
+
+    async def scenario():
+        results = await asyncio.gather(*(main.llm_complete(MESSAGES, channel="web") for _ in range(3)),
+                                       return_exceptions=True)
+        assert all(isinstance(r, RuntimeError) for r in results)
+
+        # Si todos los solicitantes se van, el error del líder no queda sin leer
+        orphan = asyncio.create_task(main.llm_complete(MESSAGES, channel="web"))
+        await asyncio.sleep(0.005)
+        orphan.cancel()
+        await asyncio.sleep(0.03)
+
+    unretrieved = []
+    loop_handler = lambda loop, ctx: unretrieved.append(ctx)
+
+    async def run():
+        asyncio.get_running_loop().set_exception_handler(loop_handler)
+        await scenario()
+        gc.collect()   # "exception was never retrieved" se reporta al recolectar el future
+
+    asyncio.run(run())
+    assert unretrieved == []
+    assert calls == ["web", "web"]
+    assert main.LLM_INFLIGHT == {}
+
+
+def test_different_channels_do_not_share(upstream):
+    calls, _ = upstream
+
+    async def scenario():
+        await asyncio.gather(main.llm_complete(MESSAGES, channel="web"),
+                             main.llm_complete(MESSAGES, channel="whatsapp"))
+
+    asyncio.run(scenario())
+    assert sorted(calls) == ["web", "whatsapp"]
+
+
+@pytest.fixture
+def stream_upstream(monkeypatch):
+    calls = []
+
+    async def fake_stream(messages, channel, tenant, route):
+        calls.append(channel)
+        try:
+            for piece in ("Cuesta ", "10 ", "USD"):
+                await asyncio.sleep(0.01)
+                yield piece
+        finally:
+            await asyncio.sleep(0.02)   # cerrar la conexión upstream no es instantáneo
+
+    monkeypatch.setattr(main, "_llm_stream_upstream", fake_stream)
+    return calls
+
+
+async def _collect(gen):
+    return [piece async for piece in gen]
+
+
+def test_identical_streams_share_deltas(stream_upstream):
+    async def scenario():
+        first = asyncio.create_task(_collect(main.llm_stream(MESSAGES)))
+        await asyncio.sleep(0.015)   # el segundo llega con el stream ya empezado
+        second = asyncio.create_task(_collect(main.llm_stream(MESSAGES)))
+        return await asyncio.gather(first, second)
+
+    first, second = asyncio.run(scenario())
+    assert first == second == ["Cuesta ", "10 ", "USD"]
+    assert stream_upstream == ["web_stream"]
+    assert main.LLM_STREAM_FLIGHTS == {}
+
+
+def test_reconnect_after_disconnect_starts_a_new_stream(stream_upstream):
+    async def scenario():
+        gen = main.llm_stream(MESSAGES)
+        assert await gen.__anext__() == "Cuesta "
+        await gen.aclose()           # el cliente se desconecta...
+        # ...y recarga mientras el upstream anterior todavía se está cerrando
+        return await _collect(main.llm_stream(MESSAGES))
+
+    assert asyncio.run(scenario()) == ["Cuesta ", "10 ", "USD"]
+    assert stream_upstream == ["web_stream", "web_stream"]
+    assert main.LLM_STREAM_FLIGHTS == {}
@@ -0,0 +1,30 @@
+import main
+
+
+def test_evicted_sessions_do_not_pin_the_expiry_heap(monkeypatch):
+    monkeypatch.setattr(main, "SESSION_MAX_ENTRIES", 50)
+    before = set(main.SESSIONS)
+    try:
+        for i in range(2000):
+            main.ensure_session(f"s-burst-{i}")
+        assert len(main.SESSIONS) <= 50
+        assert len(main.SESSION_EXPIRY_HEAP) <= 2 * len(main.SESSIONS)
+        assert all(isinstance(e[2], str) and len(e) == 3 for e in main.SESSION_EXPIRY_HEAP)
+        # Las sesiones sin mensajes también cuentan en el gauge
+        assert main.SESSION_CACHE_STATS["bytes"] == sum(main.SESSION_BYTES.values()) > 0
+    finally:
+        for sid in set(main.SESSIONS) - before:
+            main.drop_session(sid)
+
+
+def test_idle_sessions_expire_and_active_ones_are_rescheduled(monkeypatch):
+    sid_idle, sid_active = main.ensure_session("s-idle"), main.ensure_session("s-active")
+    try:
+        later = main.now_ms() + main.SESSION_IDLE_MINUTES * 60_000 + 1
+        main.SESSIONS[sid_active]["lastActiveAt"] = later
+        assert main.expire_idle_sessions(later) >= 1
+        assert sid_idle not in main.SESSIONS and sid_idle not in main.SESSION_EXPIRY_SEQ
+        assert sid_active in main.SESSIONS
+    finally:
+        main.drop_session(sid_idle)
+        main.drop_session(sid_active)
@@ -0,0 +1,158 @@
+import asyncio
+import json
+
+import main
+
+
+def _remote_save(store, sid, rev, mutate):
+    """Simula a otro worker: toma lo guardado en `rev`, lo cambia y guarda rev+1."""
+    async def run():
+        raw = await store.kv.get(f"zia:sess:{sid}")
+        state = json.loads(raw.partition(":")[2])
+        mutate(state)
+        return await store.save_many([(sid, rev, json.dumps(state))])
+    return run()
+
+
+def test_reads_do_not_mark_session_dirty(shared_store):
+    sid = main.ensure_session("s-read")
+    main.get_flow(sid)
+    main.ensure_session(sid)
+    assert sid not in main.DIRTY_SESSIONS
+
+    main.get_flow(sid)["stage"] = "ask_name"
+    assert sid in main.DIRTY_SESSIONS
+
+
+def test_nested_flow_change_is_flushed_with_its_step(shared_store):
+    sid = main.ensure_session("s-nested")
+    flow = main.get_flow(sid)
+    flow.setdefault("booking_answers", {})["name"] = "Ana"
+    flow["booking_index"] = 1
+    assert asyncio.run(main.flush_dirty_sessions()) == 1
+    raw = asyncio.run(shared_store.kv.get(f"zia:sess:{sid}"))
+    state = json.loads(raw.partition(":")[2])
+    assert state["session"]["contact_flow"]["booking_answers"] == {"name": "Ana"}
+    assert "_sid" not in state["session"]["contact_flow"]
+
+
+def test_save_is_compare_and_set(shared_store):
+    sid = main.ensure_session("s-cas")
+    main.add_message(sid, "user", "hola")
+    assert asyncio.run(main.flush_dirty_sessions()) == 1
+    assert main.SESSION_REVS[sid] == 1
+
+    # Una escritura con la rev vieja no pisa la nueva
+    assert asyncio.run(shared_store.save_many([(sid, 0, "{}")])) == [sid]
+    raw = asyncio.run(shared_store.kv.get(f"zia:sess:{sid}"))
+    assert raw.startswith("1:") and "hola" in raw
+
+
+def test_conflict_merges_both_writers(shared_store):
+    sid = main.ensure_session("s-merge")
+    main.add_message(sid, "user", "hola")
+    asyncio.run(main.flush_dirty_sessions())
+
+    def other_worker(state):
+        ts = state["messages"][-1]["ts"] + 5
+        state["messages"].append({"role": "assistant", "content": "respuesta remota", "ts": ts})
+        state["session"]["summary"] = "resumen remoto"
+    assert asyncio.run(_remote_save(shared_store, sid, 1, other_worker)) == []
+
+    # Mientras tanto este worker también cambió la sesión sobre la rev 1
+    main.add_message(sid, "user", "segundo mensaje")
+    main.get_flow(sid)["name"] = "Ana"
+    assert asyncio.run(main.flush_dirty_sessions()) == 0
+    assert main.SESSION_STORE_STATS["conflicts"] >= 1
+    assert main.SESSION_REVS[sid] == 2
+
+    contents = [m.content for m in main.MESSAGES[sid]]
+    assert {"hola", "respuesta remota", "segundo mensaje"} <= set(contents)
+    assert main.SESSIONS[sid]["summary"] == "resumen remoto"
+    assert main.get_flow(sid)["name"] == "Ana"
+
+    # La mezcla sale en el flush siguiente, encima de la rev remota
+    assert asyncio.run(main.flush_dirty_sessions()) == 1
+    raw = asyncio.run(shared_store.kv.get(f"zia:sess:{sid}"))
+    assert raw.startswith("3:")
+    state = json.loads(raw.partition(":")[2])
+    assert state["session"]["contact_flow"]["name"] == "Ana"
+    assert "respuesta remota" in raw and "segundo mensaje" in raw
+
+
+def test_hydrate_replaces_clean_copy(shared_store):
+    sid = main.ensure_session("s-hydrate")
+    main.add_message(sid, "user", "hola")
+    asyncio.run(main.flush_dirty_sessions())
+    asyncio.run(_remote_save(shared_store, sid, 1, lambda s: s["session"].update(summary="nuevo")))
+
+    main.SESSION_LOADED_AT[sid] = 0
+    asyncio.run(main.hydrate_session(sid))
+    assert main.SESSIONS[sid]["summary"] == "nuevo"
+    assert main.SESSION_REVS[sid] == 2
+    assert asyncio.run(main.flush_dirty_sessions()) == 0   # nada local que reescribir
+
+
+def test_hydrate_keeps_unsaved_local_changes(shared_store):
+    sid = main.ensure_session("s-unsaved")
+    main.add_message(sid, "user", "hola")
+    asyncio.run(main.flush_dirty_sessions())
+    asyncio.run(_remote_save(shared_store, sid, 1, lambda s: s["session"].update(summary="remoto")))
+
+    main.get_flow(sid)["stage"] = "ask_contact"   # sin flush todavía
+    main.SESSION_LOADED_AT[sid] = 0
+    asyncio.run(main.hydrate_session(sid))
+    assert main.SESSIONS[sid]["summary"] == "remoto"
+    assert main.get_flow(sid)["stage"] == "ask_contact"
+    assert sid in main.DIRTY_SESSIONS
+
+
+def test_paused_key_expires(shared_store):
+    asyncio.run(shared_store.set_paused("s-paused", True))
+    _, expires = shared_store.kv._data["zia:paused:s-paused"]
+    assert expires > 0
+
+
+def _stored_state(store, sid):
+    raw = asyncio.run(store.kv.get(f"zia:sess:{sid}"))
+    return raw.partition(":")[0], json.loads(raw.partition(":")[2])
+
+
+def test_evicted_dirty_session_is_still_flushed(shared_store):
+    sid = main.ensure_session("s-evicted")
+    main.get_flow(sid)["stage"] = "ask_contact"   # último paso, sin flush
+    main.drop_session(sid)                        # desalojo por LRU o inactividad
+    assert sid in main.EVICTED_SESSIONS
+
+    assert asyncio.run(main.flush_dirty_sessions()) == 1
+    assert main.EVICTED_SESSIONS == {}
+    rev, state = _stored_state(shared_store, sid)
+    assert rev == "1" and state["session"]["contact_flow"]["stage"] == "ask_contact"
+    assert sid not in main.SESSION_REVS
+
+
+def test_evicted_session_returning_before_flush_keeps_its_changes(shared_store):
+    sid = main.ensure_session("s-back")
+    main.add_message(sid, "user", "hola")
+    main.drop_session(sid)
+
+    main.ensure_session(sid)
+    assert [m.content for m in main.MESSAGES[sid]] == ["hola"]
+    assert sid in main.DIRTY_SESSIONS and sid not in main.EVICTED_SESSIONS
+    assert asyncio.run(main.flush_dirty_sessions()) == 1
+
+
+def test_evicted_session_conflict_is_merged(shared_store):
+    sid = main.ensure_session("s-evicted-merge")
+    main.add_message(sid, "user", "hola")
+    asyncio.run(main.flush_dirty_sessions())
+    asyncio.run(_remote_save(shared_store, sid, 1, lambda s: s["session"].update(summary="remoto")))
+
+    main.get_flow(sid)["name"] = "Ana"
+    main.drop_session(sid)
+    assert asyncio.run(main.flush_dirty_sessions()) == 0   # conflicto: se mezcla y queda aparcada
+    assert asyncio.run(main.flush_dirty_sessions()) == 1
+    rev, state = _stored_state(shared_store, sid)
+    assert rev == "3"
+    assert state["session"]["summary"] == "remoto"
+    assert state["session"]["contact_flow"]["name"] == "Ana"
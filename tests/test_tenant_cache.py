@@ -0,0 +1,108 @@
+import asyncio
+import json
+
+import pytest
+
+import main
+
+
+def _slow_loader(calls, delay=0.02):
+    async def load(slug):
+        calls.append(slug)
+        await asyncio.sleep(delay)
+        return {"slug": slug, "settings": {"n": len(calls)}}
+    return load
+
+
+def test_misses_are_coalesced():
+    cache = main.TenantCache(30_000, 10)
+    calls = []
+
+    async def scenario():
+        return await asyncio.gather(*(cache.get("acme", _slow_loader(calls)) for _ in range(5)))
+
+    results = asyncio.run(scenario())
+    assert calls == ["acme"]
+    assert all(r == results[0] for r in results)
+    assert cache.stats["coalesced"] == 4
+
+
+def test_cancelled_leader_does_not_cancel_waiters():
+    cache = main.TenantCache(30_000, 10)
+    calls = []
+
+    async def scenario():
+        leader = asyncio.create_task(cache.get("acme", _slow_loader(calls)))
+        await asyncio.sleep(0.005)
+        waiter = asyncio.create_task(cache.get("acme", _slow_loader(calls)))
+        await asyncio.sleep(0.005)
+        leader.cancel()
+        value = await waiter
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return value
+
+    assert asyncio.run(scenario())["slug"] == "acme"
+    assert calls == ["acme"]
+    assert cache.peek("acme") is not None
+
+
+def test_loader_error_reaches_every_waiter():
+    cache = main.TenantCache(30_000, 10)
+
+    async def failing(slug):
+        await asyncio.sleep(0.005)
+        raise RuntimeError("db down")
+
+    async def scenario():
+        return await asyncio.gather(*(cache.get("acme", failing) for _ in range(3)), return_exceptions=True)
+
+    results = asyncio.run(scenario())
+    assert all(isinstance(r, RuntimeError) for r in results)
+    assert cache.inflight == {} and cache.peek("acme") is None
+
+
+def test_invalidation_during_load_is_not_cached():
+    cache = main.TenantCache(30_000, 10)
+    calls = []
+
+    async def scenario():
+        first = asyncio.create_task(cache.get("acme", _slow_loader(calls)))
+        await asyncio.sleep(0.005)
+        cache.invalidate("acme")     # un UPDATE llegó mientras se leía
+        await first
+        assert cache.peek("acme") is None
+        return await cache.get("acme", _slow_loader(calls))
+
+    value = asyncio.run(scenario())
+    assert calls == ["acme", "acme"]
+    assert value["settings"]["n"] == 2
+
+
+def test_returned_values_are_copies():
+    cache = main.TenantCache(30_000, 10)
+
+    async def scenario():
+        a = await cache.get("acme", _slow_loader([], 0))
+        a["name"] = "mutado"
+        return await cache.get("acme", _slow_loader([], 0))
+
+    assert "name" not in asyncio.run(scenario())
+
+
+def test_notify_dispatch_and_own_notices(monkeypatch):
+    cache = main.TenantCache(30_000, 10)
+    monkeypatch.setattr(main, "TENANT_CACHE", cache)
+    cache.entries["acme"] = (main.now_ms(), {"slug": "acme"})
+    cache.entries["otro"] = (main.now_ms(), {"slug": "otro"})
+
+    # Los avisos propios ya se aplicaron al publicar
+    main._on_tenant_notify(json.dumps({"kind": "tenant", "key": "acme", "src": main.WORKER_ID}))
+    assert cache.peek("acme") is not None
+
+    main._on_tenant_notify(json.dumps({"kind": "tenant", "key": "acme", "src": "otro-worker"}))
+    assert cache.peek("acme") is None and cache.peek("otro") is not None
+
+    # Un payload ilegible vacía todo
+    main._on_tenant_notify("acme|123")
+    assert cache.entries == {}
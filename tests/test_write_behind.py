@@ -0,0 +1,147 @@
+import asyncio
+
+import pytest
+from sqlalchemy.exc import IntegrityError, OperationalError
+
+import main
+
+
+class FakeEngine:
+    """Registra las filas de cada transacción confirmada; permite inyectar fallos."""
+
+    def __init__(self):
+        self.committed: list[tuple[str, int]] = []   # (tabla, filas) por INSERT
+        self.transient_failures = 0
+        self.transactions = 0
+
+    def begin(self):
+        return _FakeTx(self)
+
+
+class _FakeTx:
+    def __init__(self, engine):
+        self.engine = engine
+        self.pending = []
+
+    async def __aenter__(self):
+        self.engine.transactions += 1
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.engine.committed.extend(self.pending)
+        return False
+
+    async def execute(self, stmt, params):
+        if self.engine.transient_failures:
+            self.engine.transient_failures -= 1
+            raise OperationalError("INSERT", {}, ConnectionResetError("conexión cerrada"))
+        if any(v == "BAD" for v in params.values()):
+            raise IntegrityError("INSERT", {}, ValueError("fila inválida"))
+        table = str(stmt).split()[2]
+        self.pending.append((table, sum(1 for k in params if k.startswith("session_id_"))))
+
+
+@pytest.fixture
+def engine(monkeypatch):
+    eng = FakeEngine()
+    monkeypatch.setattr(main, "db_engine", eng)
+    monkeypatch.setattr(main, "WRITE_BEHIND_RETRY_MS", 1)
+    return eng
+
+
+def _event(sid, etype="x"):
+    return ("events", {"tenant_slug": "t", "session_id": sid, "type": etype, "payload": "{}"})
+
+
+def _rows(engine, table=None):
+    return sum(n for t, n in engine.committed if table in (None, t))
+
+
+def test_rows_are_batched_per_table(engine, monkeypatch):
+    monkeypatch.setattr(main, "WRITE_BEHIND_BATCH_ROWS", 4)
+    writer = main.WriteBehindWriter()
+
+    async def scenario():
+        writer.start()
+        for i in range(10):
+            await writer.put(*_event(f"s{i}"))
+        await writer.put("messages", {"tenant_slug": "t", "session_id": "s", "channel": "web",
+                                      "direction": "in", "content": "hola", "payload": "{}"})
+        await writer.close()
+
+    asyncio.run(scenario())
+    assert _rows(engine, "events") == 10
+    assert _rows(engine, "messages") == 1
+    assert max(n for _, n in engine.committed) <= 4
+    assert writer.stats["rows_written"] == 11 and writer.stats["dropped"] == 0
+
+
+def test_bad_row_only_loses_itself(engine):
+    writer = main.WriteBehindWriter()
+    batch = [_event("a"), _event("b", "BAD"), _event("c"),
+             ("messages", {"tenant_slug": "t", "session_id": "m", "channel": "web",
+                           "direction": "in", "content": "hola", "payload": "{}"})]
+    asyncio.run(writer.flush(batch))
+    assert _rows(engine, "events") == 2
+    assert _rows(engine, "messages") == 1
+    assert writer.stats["dropped"] == 1
+    assert writer.stats["rows_written"] == 3
+
+
+def test_transient_error_is_retried(engine):
+    engine.transient_failures = 2
+    writer = main.WriteBehindWriter()
+    asyncio.run(writer.flush([_event("a"), _event("b")]))
+    assert _rows(engine) == 2
+    assert writer.stats["retries"] == 2
+    assert writer.stats["dropped"] == 0
+
+
+def test_transient_error_gives_up_after_retries(engine, monkeypatch):
+    monkeypatch.setattr(main, "WRITE_BEHIND_RETRIES", 2)
+    engine.transient_failures = 10
+    writer = main.WriteBehindWriter()
+    asyncio.run(writer.flush([_event("a"), _event("b")]))
+    assert _rows(engine) == 0
+    assert engine.transactions == 3
+    assert writer.stats["dropped"] == 2
+
+
+def test_put_restarts_a_dead_writer(engine):
+    writer = main.WriteBehindWriter()
+
+    async def scenario():
+        writer.start()
+        writer.task.cancel()
+        await asyncio.sleep(0)
+        assert await writer.put(*_event("a"))
+        assert writer.stats["restarts"] == 1
+        await writer.close()
+
+    asyncio.run(scenario())
+    assert _rows(engine) == 1
+
+
+def test_full_queue_drops_after_deadline(engine, monkeypatch):
+    monkeypatch.setattr(main, "WRITE_BEHIND_MAX_QUEUE", 2)
+    monkeypatch.setattr(main, "WRITE_BEHIND_PUT_TIMEOUT_MS", 20)
+    writer = main.WriteBehindWriter()
+    writer.closing = True   # sin writer que vacíe la cola
+
+    async def scenario():
+        assert await writer.put(*_event("a"))
+        assert await writer.put(*_event("b"))
+        return await writer.put(*_event("c"))
+
+    assert asyncio.run(scenario()) is False
+    assert writer.stats["backpressure_dropped"] == 1
+    assert writer.queue.qsize() == 2
+
+
+def test_sync_write_raises_on_data_error(engine):
+    writer = main.WriteBehindWriter()
+    with pytest.raises(IntegrityError):
+        asyncio.run(writer.write_now(*_event("a", "BAD")))
+    asyncio.run(writer.write_now(*_event("b")))
+    assert _rows(engine) == 1